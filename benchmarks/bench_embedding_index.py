@@ -0,0 +1,78 @@
+"""
+Benchmark of `peakidentify.EmbeddingIndex` queries against the linear scan of
+`SpectralLibrary.screen`, on synthetic libraries of growing size. Each compound is a random
+set of Lorentzian peaks, so the libraries are built offline. The time to build each index
+and the average query time, over unknowns made from library compounds with added noise, are
+printed with the share of queries whose compound was the first candidate.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_embedding_index.py --sizes 1000 10000
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import timeit
+import numpy as np
+from ramannoodles import peakidentify
+
+X_DATA = np.arange(400, 4000, 2.0)
+
+
+def synthetic_library(n_compounds, seed=0):
+    """Returns a library of compounds with 3 to 15 Lorentzian peaks each"""
+    generator = np.random.RandomState(seed)
+    library = {}
+    for i in range(n_compounds):
+        n_peaks = generator.randint(3, 16)
+        centers = generator.uniform(450, 3950, n_peaks)
+        widths = generator.uniform(3, 30, n_peaks)
+        heights = generator.uniform(0.1, 1, n_peaks)
+        y_data = (heights / (1 + ((X_DATA[:, None] - centers) / widths)**2)).sum(axis=1)
+        library['compound {}'.format(i)] = {'title': 'compound {}'.format(i), 'x': X_DATA,
+                                            'y': y_data}
+    return library
+
+
+def main():
+    """Builds an index and a SpectralLibrary of each size and times queries on both"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--queries', type=int, default=20)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        print('{:>8} {:>10} {:>14} {:>14} {:>10} {:>10}'.format(
+            'library', 'build (s)', 'query (ms)', 'screen (ms)', 'index hit', 'screen hit'))
+        for size in args.sizes:
+            library = synthetic_library(size)
+            labels = list(library)
+            generator = np.random.RandomState(1)
+            picks = generator.choice(size, args.queries, replace=False)
+            unknowns = np.array([library[labels[pick]]['y'] for pick in picks])
+            unknowns += generator.normal(0, 0.01, unknowns.shape)
+
+            start = timeit.default_timer()
+            index = peakidentify.EmbeddingIndex(os.path.join(directory, '{}.hdf5'.format(size)))
+            index.update(library)
+            build = timeit.default_timer() - start
+            spectral_library = peakidentify.SpectralLibrary(library)
+
+            start = timeit.default_timer()
+            found = [index.query(X_DATA, unknown, top=1)[0][0] for unknown in unknowns]
+            query = (timeit.default_timer() - start) / len(unknowns)
+            start = timeit.default_timer()
+            screened = [spectral_library.screen(X_DATA, unknown, top=1, max_shift=0)[0][0]
+                        for unknown in unknowns]
+            screen = (timeit.default_timer() - start) / len(unknowns)
+            expected = [labels[pick] for pick in picks]
+            print('{:>8} {:>10.2f} {:>14.2f} {:>14.2f} {:>10.2f} {:>10.2f}'.format(
+                size, build, 1e3*query, 1e3*screen,
+                np.mean(np.array(found) == expected), np.mean(np.array(screened) == expected)))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Benchmark of the `spectrafit.initial_guess` starting values. Every spectrum is fit twice with
+each `model_fit` backend: once from the fixed `set_params` defaults (sigma 50, amplitude 1,
+fraction 0.5) and once from the peak shapes estimated by `initial_guess`. The number of
+model evaluations, the wall time and the final chi-square of each fit are printed. The
+spectra are synthetic ones with 5 and 20 peaks and compounds from the bundled NIST library.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_initial_guess.py
+"""
+
+import pickle
+import timeit
+from bench_model_fit import synthetic_spectrum
+from ramannoodles import spectrafit
+
+
+def spectra():
+    """Yields the label, x and baselined y data of every benchmark spectrum"""
+    for n_peaks in (5, 20):
+        yield ('synthetic, {} peaks'.format(n_peaks),) + synthetic_spectrum(n_peaks)
+    with open('raman_spectra/shoyu_data_dict.p', 'rb') as library_file:
+        library = pickle.load(library_file)
+    for title in ('WATER', 'CARBON MONOXIDE', 'CARBON DIOXIDE', 'FORMIC ACID'):
+        yield title, library[title]['x'], spectrafit.subtract_baseline(library[title]['y'])
+
+
+def main():
+    """Fits every spectrum from the default and from the estimated starting values"""
+    print('{:>20} {:>6} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        'spectrum', 'peaks', 'backend', 'nfev', 'nfev', 'time (s)', 'time (s)', 'chisqr'))
+    print('{:>20} {:>6} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+        '', '', '', 'default', 'guess', 'default', 'guess', 'guess'))
+    for label, x_data, y_data in spectra():
+        peaks, peak_list = spectrafit.peak_detect(x_data, y_data)
+        guesses = spectrafit.initial_guess(x_data, y_data, peak_list)
+        for backend in ('lmfit', 'analytic'):
+            results = []
+            for previous in (None, guesses):
+                mod, pars = spectrafit.set_params(peaks, previous)
+                start = timeit.default_timer()
+                out = spectrafit.model_fit(x_data, y_data, mod, pars, backend=backend)
+                results.append((out.nfev, timeit.default_timer() - start, out.chisqr))
+            print('{:>20} {:>6} {:>9} {:>10} {:>10} {:>10.3f} {:>10.3f} {:>10.4g}'.format(
+                label, len(peaks), backend, results[0][0], results[1][0], results[0][1],
+                results[1][1], results[1][2]))
+
+
+if __name__ == '__main__':
+    main()
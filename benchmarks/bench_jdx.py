@@ -0,0 +1,49 @@
+"""
+Benchmark of `shoyu.read_jdx` against the jcamp package reader it replaced. Each bundled
+NIST .jdx file in raman_spectra/ is read repeatedly with both, and the whole directory is
+read with `shoyu.read_jdx_dir`. The jcamp reader is only timed when jcamp is installed.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_jdx.py
+"""
+
+import os
+import timeit
+from ramannoodles import shoyu
+
+try:
+    import jcamp
+    JCAMP_READER = getattr(jcamp, 'JCAMP_reader', None) or getattr(jcamp, 'jcamp_readfile',
+                                                                   None) or jcamp.readfile
+except ImportError:
+    JCAMP_READER = None
+
+DIRECTORY = 'raman_spectra'
+
+
+def best_time(function, number=20, repeat=3):
+    """Returns the best per-call time of `function` in milliseconds"""
+    return 1e3*min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main():
+    """Times both readers on every bundled file, then the parallel directory read"""
+    filenames = sorted(os.path.join(DIRECTORY, name) for name in os.listdir(DIRECTORY)
+                       if name.endswith('.jdx'))
+    print('{:>34} {:>14} {:>14}'.format('file', 'read_jdx (ms)', 'jcamp (ms)'))
+    for filename in filenames:
+        jcamp_time = float('nan')
+        if JCAMP_READER is not None:
+            jcamp_time = best_time(lambda filename=filename: JCAMP_READER(filename), number=5)
+        print('{:>34} {:>14.3f} {:>14.3f}'.format(
+            filename, best_time(lambda filename=filename: shoyu.read_jdx(filename)),
+            jcamp_time))
+    for workers in (1, None):
+        print('read_jdx_dir, {} workers: {:.3f} ms'.format(
+            workers or os.cpu_count(),
+            best_time(lambda workers=workers: shoyu.read_jdx_dir(DIRECTORY, workers),
+                      number=3)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Benchmark of `dataprep.load_spectrum` against the pandas readers it replaced. A synthetic
+two-column spectrum is written as .csv, .txt and .xlsx files, and each format is read
+repeatedly with pandas and with `load_spectrum`. For .xlsx the first, converting read into
+the .npy cache and the later cached reads are timed separately.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_loaders.py
+"""
+
+import os
+import shutil
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+from ramannoodles import dataprep
+
+
+def best_time(function, number=20, repeat=3):
+    """Returns the best per-call time of `function` in milliseconds"""
+    return 1e3*min(timeit.repeat(function, number=number, repeat=repeat)) / number
+
+
+def main():
+    """Writes a 2000 point spectrum in each format and times every reader on it"""
+    directory = tempfile.mkdtemp()
+    cache_dir = os.path.join(directory, 'cache')
+    try:
+        # rounded to the precision that the spectrometer exports
+        x_data = np.linspace(250, 3500, 2000).round(2)
+        y_data = np.random.RandomState(0).uniform(0, 700, len(x_data)).round(6)
+        data = pd.DataFrame({'x': x_data, 'y': y_data})
+        files = {extension: os.path.join(directory, 'spectrum.' + extension)
+                 for extension in ('csv', 'txt', 'xlsx')}
+        data.to_csv(files['csv'], header=False, index=False)
+        np.savetxt(files['txt'], data.to_numpy(), fmt='%.6f', delimiter='\t')
+        data.to_excel(files['xlsx'], header=False, index=False)
+
+        readers = [
+            ('csv', 'pandas', lambda: pd.read_csv(files['csv'], header=None, names=('x', 'y'))),
+            ('csv', 'load_spectrum', lambda: dataprep.load_spectrum(files['csv'])),
+            ('txt', 'pandas', lambda: pd.read_csv(files['txt'], header=None, sep=r'\s+',
+                                                  names=('x', 'y'))),
+            ('txt', 'load_spectrum', lambda: dataprep.load_spectrum(files['txt'])),
+            ('xlsx', 'pandas', lambda: pd.read_excel(files['xlsx'], header=None,
+                                                     names=('x', 'y'))),
+        ]
+        print('{:>6} {:>22} {:>10}'.format('format', 'reader', 'time (ms)'))
+        for extension, reader, function in readers:
+            number = 3 if extension == 'xlsx' else 20
+            print('{:>6} {:>22} {:>10.3f}'.format(extension, reader,
+                                                  best_time(function, number=number)))
+        # the first read with a cache converts the workbook, later reads use the .npy file
+        start = timeit.default_timer()
+        dataprep.load_spectrum(files['xlsx'], cache_dir)
+        seconds = timeit.default_timer() - start
+        print('{:>6} {:>22} {:>10.3f}'.format('xlsx', 'load_spectrum (convert)', 1e3*seconds))
+        print('{:>6} {:>22} {:>10.3f}'.format(
+            'xlsx', 'load_spectrum (cached)',
+            best_time(lambda: dataprep.load_spectrum(files['xlsx'], cache_dir))))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+"""
+Benchmark of the two `spectrafit.model_fit` backends. Synthetic spectra with an increasing
+number of pseudo-Voigt peaks are fit with the default lmfit backend (finite difference
+Jacobian) and with the analytic Jacobian backend, and the wall time, number of model
+evaluations and final chi-square of each are printed. The windowed `fit_local` mode is then
+timed on spectra with more and more peaks.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_model_fit.py
+"""
+
+import timeit
+import numpy as np
+from ramannoodles import spectrafit
+
+
+def synthetic_spectrum(n_peaks, spacing=None, seed=0):
+    """
+    Returns x and y data for a noisy spectrum with `n_peaks` well defined peaks. The peaks are
+    spread evenly between 300 and 3900 cm^-1, or placed `spacing` apart on an axis long enough
+    to hold them all.
+    """
+    rng = np.random.RandomState(seed)
+    if spacing is None:
+        centers = np.linspace(300, 3900, n_peaks)
+    else:
+        centers = 300 + spacing*np.arange(n_peaks)
+    x_data = np.arange(centers[0] - 100, centers[-1] + 100, 1.25)
+    y_data = spectrafit.pseudo_voigt(x_data, rng.uniform(20, 60, (n_peaks, 1)),
+                                     centers[:, None], rng.uniform(5, 20, (n_peaks, 1)),
+                                     rng.uniform(0, 1, (n_peaks, 1))).sum(axis=0)
+    y_data = y_data + rng.normal(0, 0.005, len(x_data))
+    return x_data, y_data
+
+
+def main():
+    """Times both backends for 5, 10 and 20 peak spectra, then fit_local up to 80 peaks"""
+    print('{:>6} {:>9} {:>10} {:>8} {:>12}'.format('peaks', 'backend', 'time (s)',
+                                                   'nfev', 'chisqr'))
+    for n_peaks in (5, 10, 20):
+        x_data, y_data = synthetic_spectrum(n_peaks)
+        peaks = spectrafit.peak_detect(x_data, y_data)[0]
+        mod, pars = spectrafit.set_params(peaks)
+        for backend in ('lmfit', 'analytic'):
+            start = timeit.default_timer()
+            out = spectrafit.model_fit(x_data, y_data, mod, pars, backend=backend)
+            seconds = timeit.default_timer() - start
+            print('{:>6} {:>9} {:>10.3f} {:>8} {:>12.4g}'.format(len(peaks), backend, seconds,
+                                                                 out.nfev, out.chisqr))
+
+    # windowed fitting should scale close to linearly with the number of peaks
+    print()
+    print('{:>6} {:>9} {:>10} {:>10}'.format('peaks', 'points', 'windows', 'time (s)'))
+    for n_peaks in (10, 20, 40, 80):
+        x_data, y_data = synthetic_spectrum(n_peaks, spacing=300)
+        peaks = spectrafit.peak_detect(x_data, y_data)[0]
+        windows = spectrafit.peak_windows(x_data, y_data, peaks)
+        start = timeit.default_timer()
+        spectrafit.fit_local(x_data, y_data, peaks)
+        seconds = timeit.default_timer() - start
+        print('{:>6} {:>9} {:>10} {:>10.3f}'.format(len(peaks), len(x_data), len(windows),
+                                                    seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,204 @@
+"""
+Benchmark suite for the hot paths of spectrafit, peakidentify and dataprep, for tracking
+performance regressions. It times:
+
+- `subtract_baseline` and `peak_detect` on a synthetic spectrum
+- `set_params` + `model_fit` on spectra with 5, 20 and 50 peaks, for both backends
+- `compound_report` on water from the bundled NIST library
+- `peak_assignment` of a two compound mixture against libraries of 8, 100 and 1000 compounds
+- `SpectralLibrary.unmix` and `SpectralLibrary.screen` of the same mixture against libraries
+  of the same sizes
+- `add_experiment` ingestion of a synthetic experiment file
+
+Everything runs offline, on synthetic spectra and raman_spectra/shoyu_data_dict.p, which
+holds the bundled NIST .jdx spectra. The libraries of 100 and 1000 compounds repeat the 8
+bundled compounds under new titles, so only 8 reference fits are needed. They are made once,
+before any timing. Cases marked slow (the lmfit fits of 20 or more peaks and everything that
+fits a NIST compound) take minutes and are skipped with --quick.
+
+The best time of each case can be stored as a baseline and later runs compared against it.
+Baselines are plain JSON files in benchmarks/baselines/ and depend on the machine, so
+compare runs from the same machine only. A case that is slower than its baseline by more
+than the threshold (20% by default) is reported as a regression, and the exit code is 1.
+
+With ramannoodles installed (`pip install -e .`), run from the root of the repository with:
+    python benchmarks/bench_suite.py --save before
+    python benchmarks/bench_suite.py --compare before
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import pickle
+import platform
+import shutil
+import tempfile
+import timeit
+import numpy as np
+from bench_model_fit import synthetic_spectrum
+from ramannoodles import dataprep
+from ramannoodles import peakidentify
+from ramannoodles import shoyu
+from ramannoodles import spectrafit
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+LIBRARY_FILE = 'raman_spectra/shoyu_data_dict.p'
+
+
+def baseline_cases():
+    """Baseline subtraction and peak detection on a 3000 point spectrum with a drifting base"""
+    x_data, y_data = synthetic_spectrum(20)
+    y_data = 100*y_data + 1e-5*(x_data - 2000)**2
+    yield 'subtract_baseline', lambda: spectrafit.subtract_baseline(y_data), False
+    yield 'peak_detect', lambda: spectrafit.peak_detect(x_data, y_data, height=10,
+                                                        prominence=20), False
+
+
+def model_fit_cases():
+    """Peak parameters and fits for 5, 20 and 50 peaks, with both model_fit backends"""
+    for n_peaks in (5, 20, 50):
+        x_data, y_data = synthetic_spectrum(n_peaks)
+        peaks = spectrafit.peak_detect(x_data, y_data)[0]
+        for backend in ('lmfit', 'analytic'):
+            def fit(backend=backend, peaks=peaks, x_data=x_data, y_data=y_data):
+                mod, pars = spectrafit.set_params(peaks)
+                return spectrafit.model_fit(x_data, y_data, mod, pars, backend=backend)
+            yield ('model_fit[{} peaks, {}]'.format(n_peaks, backend), fit,
+                   backend == 'lmfit' and n_peaks >= 20)
+
+
+def peakidentify_cases(cache_dir):
+    """compound_report of water, then peak_assignment, unmix and screen against 8, 100 and
+    1000 compounds"""
+    with open(LIBRARY_FILE, 'rb') as library_file:
+        library = list(pickle.load(library_file).values())
+    water = next(compound for compound in library if compound['title'] == 'WATER')
+    cache = spectrafit.FitCache(cache_dir, max_entries=len(library) + 1)
+    yield 'compound_report', lambda: spectrafit.compound_report(water), True
+    unknown_x, unknown_y = None, None
+    for n_compounds in (8, 100, 1000):
+        compounds = [dict(library[i % len(library)], title='{} {}'.format(
+            library[i % len(library)]['title'], i)) for i in range(n_compounds)]
+        def assign(compounds=compounds):
+            # the fits and the mixture are only made once, outside of the timing
+            nonlocal unknown_x, unknown_y
+            if unknown_x is None:
+                for compound in library:
+                    peakidentify.reference_peaks(compound, cache)
+                unknown_x, unknown_y = shoyu_mixture(library)
+                spectrafit.data_report(unknown_x, unknown_y, cache=cache)
+            with contextlib.redirect_stdout(io.StringIO()):
+                peakidentify.peak_assignment(unknown_x, unknown_y, compounds, plot=False,
+                                             fit_cache=cache)
+        yield 'peak_assignment[{} compounds]'.format(n_compounds), assign, True
+    mixture_x, mixture_y = shoyu_mixture(library)
+    for n_compounds in (8, 100, 1000):
+        spectral_library = peakidentify.SpectralLibrary(
+            {'{} {}'.format(library[i % len(library)]['title'], i): library[i % len(library)]
+             for i in range(n_compounds)})
+        yield ('unmix[{} compounds]'.format(n_compounds),
+               lambda spectral_library=spectral_library: spectral_library.unmix(
+                   mixture_x, mixture_y), False)
+        yield ('screen[{} compounds]'.format(n_compounds),
+               lambda spectral_library=spectral_library: spectral_library.screen(
+                   mixture_x, mixture_y), False)
+
+
+def shoyu_mixture(library):
+    """Returns the spectrum of water mixed with carbon monoxide"""
+    compounds = {compound['title']: compound for compound in library}
+    return shoyu.combine_spectra(compounds['WATER'], compounds['CARBON MONOXIDE'])
+
+
+def dataprep_cases(directory):
+    """add_experiment of a synthetic 5 peak spectrum saved as a .csv experiment file"""
+    x_data, y_data = synthetic_spectrum(5)
+    exp_filename = os.path.join(directory, 'SYN_300C_25s.csv')
+    np.savetxt(exp_filename, np.column_stack((x_data, 100*y_data)), delimiter=',')
+    hdf5_filename = os.path.join(directory, 'bench_suite.hdf5')
+    def ingest():
+        dataprep.new_hdf5(hdf5_filename[:-5])
+        dataprep.add_experiment(hdf5_filename, exp_filename)
+        os.remove(hdf5_filename)
+    yield 'add_experiment', ingest, False
+
+
+def run(quick=False, match=None, cache_dir=None):
+    """Times every case and returns the best time of each, in seconds"""
+    directory = tempfile.mkdtemp()
+    cache_dir = cache_dir or os.path.join(directory, 'reference_cache')
+    cases = [baseline_cases(), model_fit_cases(), peakidentify_cases(cache_dir),
+             dataprep_cases(directory)]
+    results = {}
+    try:
+        for group in cases:
+            for name, function, slow in group:
+                if (quick and slow) or (match and match not in name):
+                    continue
+                # warm up, then take more repeats of the fast cases
+                start = timeit.default_timer()
+                function()
+                seconds = timeit.default_timer() - start
+                repeat = 1 if seconds > 5 else 3 if seconds > 0.5 else 5
+                number = max(1, int(0.2 / max(seconds, 1e-6)))
+                results[name] = min(timeit.repeat(function, number=number,
+                                                  repeat=repeat)) / number
+                print('{:<36} {:>12.4g} s'.format(name, results[name]), flush=True)
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def save(results, name):
+    """Stores the results as the baseline called `name`"""
+    os.makedirs(BASELINE_DIR, exist_ok=True)
+    path = os.path.join(BASELINE_DIR, name + '.json')
+    with open(path, 'w') as baseline_file:
+        json.dump({'machine': platform.node(), 'python': platform.python_version(),
+                   'numpy': np.__version__, 'results': results},
+                  baseline_file, indent=2, sort_keys=True)
+    print('baseline saved to {}'.format(path))
+
+
+def compare(results, name, threshold):
+    """Prints the results next to the baseline called `name` and returns the regressions"""
+    with open(os.path.join(BASELINE_DIR, name + '.json')) as baseline_file:
+        baseline = json.load(baseline_file)['results']
+    regressions = []
+    print()
+    print('{:<36} {:>12} {:>12} {:>8}'.format('case', 'baseline (s)', 'now (s)', 'ratio'))
+    for case, seconds in results.items():
+        if case not in baseline:
+            continue
+        ratio = seconds / baseline[case]
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(case)
+            flag = '  REGRESSION'
+        print('{:<36} {:>12.4g} {:>12.4g} {:>8.2f}{}'.format(case, baseline[case], seconds,
+                                                           ratio, flag))
+    return regressions
+
+
+def main():
+    """Runs the suite and saves or compares the results, as given on the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--quick', action='store_true', help='skip the slow cases')
+    parser.add_argument('--match', help='only run the cases whose name contains this')
+    parser.add_argument('--save', metavar='NAME', help='store the results as a baseline')
+    parser.add_argument('--compare', metavar='NAME', help='compare against a baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown reported as a regression (default 0.2)')
+    parser.add_argument('--cache-dir', help='keep the peak fits between runs')
+    args = parser.parse_args()
+    results = run(args.quick, args.match, args.cache_dir)
+    if args.save:
+        save(results, args.save)
+    if args.compare and compare(results, args.compare, args.threshold):
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
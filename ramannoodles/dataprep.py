@@ -1,10 +1,23 @@
 """docstring"""
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import h5py
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 from ramannoodles import spectrafit
 
 
+# columns of the peak tables, in the order of the rows returned by spectrafit.export_fit_data
+PEAK_COLUMNS = ('fraction', 'sigma', 'center', 'amplitude', 'fwhm', 'height')
+
+
 def new_hdf5(new_filename):
     """docstring"""
     # handling input errors
@@ -16,7 +29,8 @@ def new_hdf5(new_filename):
     hdf5.close()
 
 
-def add_calibration(hdf5_filename, data_filename, label=None):
+def add_calibration(hdf5_filename, data_filename, label=None, peak_table=False,
+                    cache_dir=None):
     """docstring"""
     # handling input errors
     if not isinstance(hdf5_filename, str):
@@ -28,39 +42,26 @@ def add_calibration(hdf5_filename, data_filename, label=None):
     if not isinstance(data_filename, str):
         raise TypeError('Passed value of `data_filename` is not a string! Instead, it is: '
                         + str(type(data_filename)))
+    # read the data before opening the .hdf5, so a bad data file leaves it untouched
+    x_data, y_data = load_spectrum(data_filename, cache_dir)
     # r+ is read/write mode and will fail if the file does not exist
     cal_file = h5py.File(hdf5_filename, 'r+')
-    data = pd.read_excel(data_filename, header=None, names=('x', 'y'))
-    if data_filename.split('.')[-1] == 'xlsx':
-        data = pd.read_excel(data_filename, header=None, names=('x', 'y'))
-    elif data_filename.split('.')[-1] == 'csv':
-        data = pd.read_csv(data_filename, header=None, names=('x', 'y'))
-    else:
-        print('data file type not recognized')
-    # ensure that the data is listed from smallest wavenumber first
-    if data['x'][:1].values > data['x'][-1:].values:
-        data = data.iloc[::-1]
-        data.reset_index(inplace=True, drop=True)
-    else:
-        pass
     # peak detection and data fitting
-    fit_result = spectrafit.fit_data(data['x'].values, data['y'].values)
+    fit_result = spectrafit.fit_data(x_data, y_data)
     # write data to .hdf5 using custom label if provided
-    if label is not None:
-        cal_file['{}/wavenumber'.format(label)] = data['x']
-        cal_file['{}/counts'.format(label)] = data['y']
-        for i, _ in enumerate(fit_result):
-            cal_file['{}/Peak_{}'.format(label, i+1)] = fit_result[i]
-    else:
+    if label is None:
         label = (data_filename.split('/')[-1]).split('.')[0]
-        cal_file['{}/wavenumber'.format(label)] = data['x']
-        cal_file['{}/counts'.format(label)] = data['y']
+    cal_file['{}/wavenumber'.format(label)] = x_data
+    cal_file['{}/counts'.format(label)] = y_data
+    if peak_table:
+        write_peak_table(cal_file[label], fit_result)
+    else:
         for i, _ in enumerate(fit_result):
             cal_file['{}/Peak_{}'.format(label, i+1)] = fit_result[i]
     cal_file.close()
 
 
-def add_experiment(hdf5_filename, exp_filename):
+def add_experiment(hdf5_filename, exp_filename, peak_table=False, cache_dir=None):
     """docstring"""
     # handling input errors
     if not isinstance(hdf5_filename, str):
@@ -74,40 +75,643 @@ def add_experiment(hdf5_filename, exp_filename):
                         + str(type(exp_filename)))
     # r+ is read/write mode and will fail if the file does not exist
     exp_file = h5py.File(hdf5_filename, 'r+')
-    if exp_filename.split('.')[-1] == 'xlsx':
-        data = pd.read_excel(exp_filename, header=None, names=('x', 'y'))
-    elif exp_filename.split('.')[-1] == 'csv':
-        data = pd.read_csv(exp_filename, header=None, names=('x', 'y'))
-    else:
-        print('data file type not recognized')
-    # ensure that the data is listed from smallest wavenumber first
-    if data['x'][:1].values > data['x'][-1:].values:
-        data = data.iloc[::-1]
-        data.reset_index(inplace=True, drop=True)
-    else:
-        pass
+    # read and fit the data, then write it to .hdf5
+    write_experiment(exp_file, *fit_experiment(exp_filename, cache_dir=cache_dir),
+                     peak_table=peak_table)
+    exp_file.close()
+
+
+def add_experiments(hdf5_filename, exp_filenames, workers=None, warm_start=False,
+                    peak_table=False, cache_dir=None):
+    """
+    Adds many experiment files to an .hdf5 file. Each file is read and fit by `fit_experiment`
+    in a pool of `workers` processes, and the results are written by a single writer while the
+    .hdf5 file is held open for the whole batch, instead of opening and closing it per file.
+
+    Args:
+        hdf5_filename (str): The .hdf5 file the experiments are added to.
+        exp_filenames (list): The experiment files to add. As in `add_experiment`, the
+                              temperature and time are taken from the end of each filename.
+        workers (int): (Optional) The number of processes used to read and fit the files.
+                       Defaults to the number of processors on the machine.
+        warm_start (boolean): (Optional) If True, the files are treated as consecutive time
+                       points and fit in order in this process, each one starting from the
+                       fit of the one before it with `spectrafit.fit_warm`. Peaks are only
+                       detected again when a peak appears or vanishes.
+        peak_table (boolean): (Optional) If True, the peaks of each spectrum are written as
+                       one table, see `write_peak_table`.
+        cache_dir (str): (Optional) The directory of converted .xlsx files, see
+                       `load_spectrum`.
+
+    Returns:
+        None
+    """
+    # handling input errors
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+        raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                        + hdf5_filename.split('/')[-1].split('.')[-1])
+    if not isinstance(exp_filenames, list):
+        raise TypeError('Passed value of `exp_filenames` is not a list! Instead, it is: '
+                        + str(type(exp_filenames)))
+    for i, _ in enumerate(exp_filenames):
+        if not isinstance(exp_filenames[i], str):
+            raise TypeError('Passed value of `exp_filenames[{}]` is not a string! Instead, it is: '
+                            .format(i) + str(type(exp_filenames[i])))
+    if workers is not None and not isinstance(workers, int):
+        raise TypeError('Passed value of `workers` is not an int! Instead, it is: '
+                        + str(type(workers)))
+    if not isinstance(warm_start, bool):
+        raise TypeError('Passed value of `warm_start` is not a boolean! Instead, it is: '
+                        + str(type(warm_start)))
+    # r+ is read/write mode and will fail if the file does not exist
+    exp_file = h5py.File(hdf5_filename, 'r+')
+    try:
+        if warm_start:
+            # each fit starts from the previous one, so the files are fit one at a time
+            fit_result = None
+            for exp_filename in exp_filenames:
+                result = fit_experiment(exp_filename, previous=fit_result, cache_dir=cache_dir)
+                write_experiment(exp_file, *result, peak_table=peak_table)
+                fit_result = result[-1]
+            return
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # results arrive in order, so they are written as soon as each fit finishes
+            for result in executor.map(fit_experiment, exp_filenames, repeat(None),
+                                       repeat(cache_dir)):
+                write_experiment(exp_file, *result, peak_table=peak_table)
+    finally:
+        exp_file.close()
+
+
+def fit_experiment(exp_filename, previous=None, cache_dir=None):
+    """
+    Reads an experiment file and fits its spectrum with `spectrafit.fit_data`. This does not
+    touch any .hdf5 file, so it can run in a separate process.
+
+    Args:
+        exp_filename (str): The .xlsx, .csv or .txt experiment file. The temperature and time
+                            are the last two underscore separated fields of the filename.
+        previous (list): (Optional) The fit_result of the previous time point, used to warm
+                         start the fit.
+        cache_dir (str): (Optional) The directory of converted .xlsx files, see
+                         `load_spectrum`.
+
+    Returns:
+        temp (str): The temperature label taken from the filename.
+        time (str): The time label taken from the filename.
+        x_data (numpy array): The wavenumbers, in increasing order.
+        y_data (numpy array): The counts.
+        fit_result (list): The fitted peaks from `spectrafit.fit_data`.
+    """
+    x_data, y_data = load_spectrum(exp_filename, cache_dir)
     # peak detection and data fitting
-    fit_result = spectrafit.fit_data(data['x'].values, data['y'].values)
-    # extract experimental parameters from filename
-    specs = exp_filename.split('/')[-1].split('.')[:-1]
-    if len(specs) > 1:
-        spec = ''
-        for _,element in enumerate(specs):
-            spec = str(spec+element)
-        specs = spec
+    fit_result = spectrafit.fit_data(x_data, y_data, previous=previous)
+    # extract experimental parameters from filename, dropping the extension and any
+    # other '.' in the name
+    specs = ''.join(exp_filename.split('/')[-1].split('.')[:-1])
     specs = specs.split('_')
-    specs
     time = specs[-1]
     temp = specs[-2]
-    # write data to .hdf5
-    exp_file['{}/{}/wavenumber'.format(temp, time)] = data['x']
-    exp_file['{}/{}/counts'.format(temp, time)] = data['y']
+    return temp, time, x_data, y_data, fit_result
+
+
+def load_spectrum(data_filename, cache_dir=None):
+    """
+    Reads the two columns, wavenumber and counts, of a spectrum file into float64 arrays.
+    .csv and .txt files are parsed directly with np.loadtxt rather than through pandas.
+    .xlsx files still need the pandas Excel parser, which is slow, so if `cache_dir` is given
+    the parsed columns are saved there as a binary .npy file named by the sha256 hash of the
+    workbook, and later reads of the same workbook load that file instead.
+
+    Args:
+        data_filename (str): The .csv, .txt or .xlsx file, without a header row. .txt files
+                             may be separated by any whitespace.
+        cache_dir (str): (Optional) The directory of converted .xlsx files. If None, .xlsx
+                         files are always parsed.
+
+    Returns:
+        x_data (numpy array): The wavenumbers, in increasing order.
+        y_data (numpy array): The counts.
+    """
+    # handling input errors
+    if not isinstance(data_filename, str):
+        raise TypeError('Passed value of `data_filename` is not a string! Instead, it is: '
+                        + str(type(data_filename)))
+    if cache_dir is not None and not isinstance(cache_dir, str):
+        raise TypeError('Passed value of `cache_dir` is not a string! Instead, it is: '
+                        + str(type(cache_dir)))
+    extension = data_filename.split('/')[-1].split('.')[-1]
+    if extension == 'csv':
+        data = np.loadtxt(data_filename, delimiter=',', usecols=(0, 1), ndmin=2)
+    elif extension == 'txt':
+        data = np.loadtxt(data_filename, usecols=(0, 1), ndmin=2)
+    elif extension == 'xlsx':
+        data = _load_xlsx(data_filename, cache_dir)
+    else:
+        raise TypeError('`data_filename` is not type = .csv, .txt or .xlsx! Instead, it is: '
+                        + extension)
+    # ensure that the data is listed from smallest wavenumber first
+    if data[0, 0] > data[-1, 0]:
+        data = data[::-1]
+    x_data = np.ascontiguousarray(data[:, 0], dtype=np.float64)
+    y_data = np.ascontiguousarray(data[:, 1], dtype=np.float64)
+    return x_data, y_data
+
+
+def _load_xlsx(data_filename, cache_dir):
+    """Parses the first two columns of an .xlsx file, through the .npy cache if one is given."""
+    if cache_dir is None:
+        return pd.read_excel(data_filename, header=None, usecols=[0, 1]).to_numpy(np.float64)
+    with open(data_filename, 'rb') as workbook:
+        key = hashlib.sha256(workbook.read()).hexdigest()
+    path = os.path.join(cache_dir, key + '.npy')
+    if os.path.isfile(path):
+        try:
+            return np.load(path)
+        except (OSError, ValueError):
+            # an unreadable entry is simply converted again and replaced
+            pass
+    data = pd.read_excel(data_filename, header=None, usecols=[0, 1]).to_numpy(np.float64)
+    os.makedirs(cache_dir, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as cache_file:
+        np.save(cache_file, data)
+    os.replace(temporary, path)
+    return data
+
+
+def write_experiment(exp_file, temp, time, x_data, y_data, fit_result, peak_table=False):
+    """
+    Writes the output of `fit_experiment` into an open .hdf5 file under `temp/time`.
+
+    Args:
+        exp_file (h5py.File): The .hdf5 file, opened in a writable mode.
+        temp (str): The temperature label of the experiment.
+        time (str): The time label of the experiment.
+        x_data (numpy array): The wavenumbers.
+        y_data (numpy array): The counts.
+        fit_result (list): The fitted peaks from `spectrafit.fit_data`.
+        peak_table (boolean): (Optional) If True, the peaks are written as one table with
+                              `write_peak_table` instead of one Peak_NN dataset per peak.
+
+    Returns:
+        None
+    """
+    exp_file['{}/{}/wavenumber'.format(temp, time)] = x_data
+    exp_file['{}/{}/counts'.format(temp, time)] = y_data
+    if peak_table:
+        write_peak_table(exp_file['{}/{}'.format(temp, time)], fit_result)
+        return
     for i, _ in enumerate(fit_result):
         if i < 9:
             exp_file['{}/{}/Peak_0{}'.format(temp, time, i+1)] = fit_result[i]
         else:
             exp_file['{}/{}/Peak_{}'.format(temp, time, i+1)] = fit_result[i]
-    exp_file.close()
+
+
+def write_peak_table(group, fit_result):
+    """
+    Writes the fitted peaks of a spectrum into an .hdf5 group as a single `peaks` table,
+    with one row per peak and the columns named in its `columns` attribute, instead of as one
+    small Peak_NN dataset per peak. The table is chunked, compressed and can be extended
+    along its rows, so a file holds a few objects per spectrum however many peaks are fit.
+
+    Args:
+        group (h5py.Group): The group of the spectrum, opened in a writable mode.
+        fit_result (list): The fitted peaks from `spectrafit.fit_data`, one row per peak
+                           with the values listed in `PEAK_COLUMNS`.
+
+    Returns:
+        None
+    """
+    table = np.asarray(fit_result, dtype=np.float64).reshape(-1, len(PEAK_COLUMNS))
+    peaks = group.create_dataset('peaks', data=table, maxshape=(None, len(PEAK_COLUMNS)),
+                                 chunks=(64, len(PEAK_COLUMNS)), compression='gzip',
+                                 shuffle=True)
+    peaks.attrs['columns'] = PEAK_COLUMNS
+
+
+def read_peaks(group):
+    """
+    Reads the fitted peaks of a spectrum from its .hdf5 group in either layout, a `peaks`
+    table or one Peak_NN dataset per peak.
+
+    Args:
+        group (h5py.Group): The group of the spectrum, e.g. hdf5['300C/25s'].
+
+    Returns:
+        peaks (numpy array): One row per peak, with the columns listed in `PEAK_COLUMNS`.
+    """
+    if 'peaks' in group:
+        return group['peaks'][()]
+    names = sorted((name for name in group if name.startswith('Peak_')),
+                   key=lambda name: int(name.split('_')[-1]))
+    peaks = np.array([group[name][()] for name in names], dtype=np.float64)
+    return peaks.reshape(-1, len(PEAK_COLUMNS))
+
+
+def migrate_peak_tables(hdf5_filename):
+    """
+    Converts every spectrum of an .hdf5 file written with one Peak_NN dataset per peak to
+    the `peaks` table layout of `write_peak_table`, in place. HDF5 does not return the space
+    of deleted datasets to the file system, so run `h5repack` on the file afterwards to
+    shrink it.
+
+    Args:
+        hdf5_filename (str): The .hdf5 file to convert.
+
+    Returns:
+        count (int): The number of spectra converted.
+    """
+    # handling input errors
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+        raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                        + hdf5_filename.split('/')[-1].split('.')[-1])
+    hdf5 = h5py.File(hdf5_filename, 'r+')
+    try:
+        # find the groups first, since they cannot change while they are visited
+        groups = []
+        def _collect_spectra(name, item):
+            """adds each group holding Peak_ datasets to `groups`"""
+            if isinstance(item, h5py.Group) and any(key.startswith('Peak_') for key in item):
+                groups.append(name)
+
+        hdf5.visititems(_collect_spectra)
+        count = 0
+        for name in groups:
+            group = hdf5[name]
+            if 'peaks' in group:
+                continue
+            table = read_peaks(group)
+            for key in [key for key in group if key.startswith('Peak_')]:
+                del group[key]
+            write_peak_table(group, table)
+            count += 1
+    finally:
+        hdf5.close()
+    return count
+
+
+def stream_experiments(hdf5_filename, source, baseline=True, workers=None, max_pending=None,
+                       peak_table=False):
+    """
+    Adds spectra to an .hdf5 file as they are acquired, instead of from saved experiment files.
+    Each spectrum from `source` is baselined, has its peaks detected and is fit in a pool of
+    `workers` processes, and the results are appended to the .hdf5 file in the order the
+    spectra arrived. At most `max_pending` spectra are held in memory at a time: when that
+    many fits are unfinished, the next spectrum is not taken from `source` until the oldest
+    fit has been written, so a fast source is slowed down to the rate of fitting.
+
+    Args:
+        hdf5_filename (str): The .hdf5 file the experiments are added to.
+        source (iterable): Yields (x_data, y_data, metadata) for each spectrum. `metadata` is
+                           a dictionary with the 'temp' and 'time' labels used as group names,
+                           as taken from the filename in `add_experiment`. Any other entries
+                           are stored as attributes of the `temp/time` group.
+        baseline (boolean): (Optional) If True (default), `spectrafit.subtract_baseline` is
+                            applied before peak detection.
+        workers (int): (Optional) The number of processes used to fit the spectra. Defaults
+                       to the number of processors on the machine.
+        max_pending (int): (Optional) The number of spectra that may be waiting or being fit
+                           at once. Defaults to twice the number of workers.
+        peak_table (boolean): (Optional) If True, the peaks of each spectrum are written as
+                           one table, see `write_peak_table`.
+
+    Returns:
+        count (int): The number of spectra added.
+    """
+    # handling input errors
+    _check_stream_inputs(hdf5_filename, workers, max_pending)
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2*workers
+    pending = deque()
+    count = 0
+    # r+ is read/write mode and will fail if the file does not exist
+    exp_file = h5py.File(hdf5_filename, 'r+')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for x_data, y_data, metadata in source:
+                # checked here, so a bad spectrum fails before its fit is submitted
+                _check_stream_metadata(metadata)
+                if len(pending) >= max_pending:
+                    # backpressure: write the oldest fit before reading the next spectrum
+                    _write_stream_result(exp_file, peak_table, *pending.popleft().result())
+                    count += 1
+                pending.append(executor.submit(fit_stream_spectrum, x_data, y_data,
+                                               metadata, baseline))
+            while pending:
+                _write_stream_result(exp_file, peak_table, *pending.popleft().result())
+                count += 1
+    finally:
+        exp_file.close()
+    return count
+
+
+async def stream_experiments_async(hdf5_filename, source, baseline=True, workers=None,
+                                   max_pending=None, peak_table=False):
+    """
+    The asyncio form of `stream_experiments`, for spectra that arrive from an asynchronous
+    iterator. Fits run in a pool of processes so the event loop is not blocked, and `source`
+    is not awaited for the next spectrum while `max_pending` fits are unfinished.
+
+    Args:
+        hdf5_filename (str): The .hdf5 file the experiments are added to.
+        source (async iterable): Yields (x_data, y_data, metadata) for each spectrum, as in
+                                 `stream_experiments`.
+        baseline (boolean): (Optional) If True (default), `spectrafit.subtract_baseline` is
+                            applied before peak detection.
+        workers (int): (Optional) The number of processes used to fit the spectra. Defaults
+                       to the number of processors on the machine.
+        max_pending (int): (Optional) The number of spectra that may be waiting or being fit
+                           at once. Defaults to twice the number of workers.
+        peak_table (boolean): (Optional) If True, the peaks of each spectrum are written as
+                           one table, see `write_peak_table`.
+
+    Returns:
+        count (int): The number of spectra added.
+    """
+    # handling input errors
+    _check_stream_inputs(hdf5_filename, workers, max_pending)
+    workers = workers or os.cpu_count()
+    max_pending = max_pending or 2*workers
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    count = 0
+    # r+ is read/write mode and will fail if the file does not exist
+    exp_file = h5py.File(hdf5_filename, 'r+')
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            async for x_data, y_data, metadata in source:
+                _check_stream_metadata(metadata)
+                if len(pending) >= max_pending:
+                    # backpressure: write the oldest fit before reading the next spectrum
+                    _write_stream_result(exp_file, peak_table, *await pending.popleft())
+                    count += 1
+                pending.append(loop.run_in_executor(executor, fit_stream_spectrum, x_data,
+                                                    y_data, metadata, baseline))
+            while pending:
+                _write_stream_result(exp_file, peak_table, *await pending.popleft())
+                count += 1
+    finally:
+        exp_file.close()
+    return count
+
+
+def fit_stream_spectrum(x_data, y_data, metadata, baseline=True):
+    """
+    Baselines, detects peaks in and fits a single streamed spectrum. This does not touch any
+    .hdf5 file, so it can run in a separate process.
+
+    Args:
+        x_data (list like): The wavenumbers.
+        y_data (list like): The counts.
+        metadata (dict): The 'temp' and 'time' labels of the spectrum, and any other entries
+                         to store with it.
+        baseline (boolean): (Optional) If True (default), `spectrafit.subtract_baseline` is
+                            applied before peak detection.
+
+    Returns:
+        temp (str): The temperature label of the spectrum.
+        time (str): The time label of the spectrum.
+        x_data (numpy array): The wavenumbers, in increasing order.
+        y_data (numpy array): The counts, baselined if `baseline` is True.
+        fit_result (list): The fitted peaks from `spectrafit.fit_data`.
+        metadata (dict): The metadata, passed through for the writer.
+    """
+    _check_stream_metadata(metadata)
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    # ensure that the data is listed from smallest wavenumber first
+    if x_data[0] > x_data[-1]:
+        x_data = x_data[::-1]
+        y_data = y_data[::-1]
+    if baseline:
+        y_data = spectrafit.subtract_baseline(y_data)
+    fit_result = spectrafit.fit_data(x_data, y_data)
+    return (str(metadata['temp']), str(metadata['time']), x_data, y_data, fit_result,
+            metadata)
+
+
+def _check_stream_inputs(hdf5_filename, workers, max_pending):
+    """Checks the arguments shared by `stream_experiments` and `stream_experiments_async`."""
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+        raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                        + hdf5_filename.split('/')[-1].split('.')[-1])
+    if workers is not None and not isinstance(workers, int):
+        raise TypeError('Passed value of `workers` is not an int! Instead, it is: '
+                        + str(type(workers)))
+    if max_pending is not None and not isinstance(max_pending, int):
+        raise TypeError('Passed value of `max_pending` is not an int! Instead, it is: '
+                        + str(type(max_pending)))
+
+
+def _check_stream_metadata(metadata):
+    """Checks that the metadata of a streamed spectrum holds its 'temp' and 'time' labels."""
+    if not isinstance(metadata, dict):
+        raise TypeError('Passed value of `metadata` is not a dict! Instead, it is: '
+                        + str(type(metadata)))
+    for key in ('temp', 'time'):
+        if key not in metadata:
+            raise ValueError("Passed value of `metadata` has no '{}' label! Instead, it has: "
+                             .format(key) + str(list(metadata)))
+
+
+def _write_stream_result(exp_file, peak_table, temp, time, x_data, y_data, fit_result,
+                         metadata):
+    """Writes one streamed fit and its extra metadata, and flushes it to disk."""
+    write_experiment(exp_file, temp, time, x_data, y_data, fit_result, peak_table=peak_table)
+    group = exp_file['{}/{}'.format(temp, time)]
+    for key, value in metadata.items():
+        if key not in ('temp', 'time'):
+            group.attrs[key] = value
+    exp_file.flush()
+
+
+def _label_order(label):
+    """Sort key that orders labels such as '300C' or '25s' by their leading number."""
+    match = re.match(r'[-+]?\d*\.?\d+', label)
+    if match is None:
+        return (1, 0.0, label)
+    return (0, float(match.group()), label)
+
+
+def _experiment_labels(hdf5):
+    """Returns the sorted temperature and time labels of the spectra in an experiment file."""
+    temps = []
+    times = set()
+    for temp in hdf5:
+        if temp == 'cube' or not isinstance(hdf5[temp], h5py.Group):
+            continue
+        spectra = [time for time in hdf5[temp] if '{}/{}/counts'.format(temp, time) in hdf5]
+        if spectra:
+            temps.append(temp)
+            times.update(spectra)
+    return sorted(temps, key=_label_order), sorted(times, key=_label_order)
+
+
+def _first_spectrum(hdf5, temps, times):
+    """Returns the `temp/time` key of the first spectrum at the first temperature."""
+    return next('{}/{}'.format(temps[0], time) for time in times
+                if '{}/{}/counts'.format(temps[0], time) in hdf5)
+
+
+def write_cube(hdf5_filename):
+    """
+    Writes every spectrum of an experiment file into a single temperature x time x wavenumber
+    dataset, `cube/counts`, next to the `cube/wavenumber`, `cube/temperature` and `cube/time`
+    axes. The dataset is stored contiguously without compression, so `SpectrumCube` can map
+    it into memory and serve slices as NumPy views. Spectra are copied one at a time, and
+    temperature and time pairs without a spectrum are filled with NaN. Spectra sampled on a
+    different wavenumber axis than the first one are interpolated onto it. Run this again
+    after adding experiments to the file.
+
+    Args:
+        hdf5_filename (str): The experiment .hdf5 file.
+
+    Returns:
+        shape (tuple): The shape of the cube, (temperatures, times, wavenumbers).
+    """
+    # handling input errors
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+        raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                        + hdf5_filename.split('/')[-1].split('.')[-1])
+    hdf5 = h5py.File(hdf5_filename, 'r+')
+    try:
+        temps, times = _experiment_labels(hdf5)
+        if not temps:
+            raise ValueError('{} holds no spectra'.format(hdf5_filename))
+        wavenumber = hdf5['{}/wavenumber'.format(_first_spectrum(hdf5, temps, times))][()]
+        if 'cube' in hdf5:
+            del hdf5['cube']
+        cube = hdf5.create_group('cube')
+        cube['wavenumber'] = wavenumber
+        cube['temperature'] = temps
+        cube['time'] = times
+        # no chunks or compression, so the data sits in one block that can be mapped
+        counts = cube.create_dataset('counts', (len(temps), len(times), len(wavenumber)),
+                                     dtype=np.float64, fillvalue=np.nan)
+        for i, temp in enumerate(temps):
+            for j, time in enumerate(times):
+                key = '{}/{}'.format(temp, time)
+                if '{}/counts'.format(key) not in hdf5:
+                    continue
+                x_data = hdf5['{}/wavenumber'.format(key)][()]
+                y_data = hdf5['{}/counts'.format(key)][()]
+                if not np.array_equal(x_data, wavenumber):
+                    order = np.argsort(x_data)
+                    y_data = np.interp(wavenumber, x_data[order], y_data[order],
+                                       left=np.nan, right=np.nan)
+                counts[i, j] = y_data
+        shape = counts.shape
+    finally:
+        hdf5.close()
+    return shape
+
+
+class SpectrumCube():
+    """
+    Read-only view of all spectra in an experiment file as a temperature x time x wavenumber
+    cube, indexed like a NumPy array, e.g. cube[0] for every time point at the first
+    temperature, or cube[:, :, 100] for the kinetics of one wavenumber over the whole run.
+    Nothing is read until it is indexed. If the file holds the contiguous `cube/counts`
+    dataset written by `write_cube`, it is mapped into memory and slices are NumPy views of
+    the file. Otherwise each indexed spectrum is read from its own `counts` dataset, which
+    needs every spectrum to share one wavenumber axis. Temperatures and times are ordered by
+    the number at the start of their labels, and missing spectra read as NaN.
+
+    Args:
+        hdf5_filename (str): The experiment .hdf5 file.
+
+    Attributes:
+        temperature (list): The temperature labels, along the first axis.
+        time (list): The time labels, along the second axis.
+        wavenumber (numpy array): The wavenumbers, along the third axis.
+        shape (tuple): The shape of the cube.
+    """
+    def __init__(self, hdf5_filename):
+        # handling input errors
+        if not isinstance(hdf5_filename, str):
+            raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                            + str(type(hdf5_filename)))
+        if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+            raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                            + hdf5_filename.split('/')[-1].split('.')[-1])
+        self.filename = hdf5_filename
+        self._hdf5 = h5py.File(hdf5_filename, 'r')
+        self._counts = None
+        if 'cube' in self._hdf5:
+            cube = self._hdf5['cube']
+            self.temperature = [label.decode() for label in cube['temperature'][()]]
+            self.time = [label.decode() for label in cube['time'][()]]
+            self.wavenumber = cube['wavenumber'][()]
+            offset = cube['counts'].id.get_offset()
+            if offset is None:
+                # chunked or unallocated data can only be read through h5py
+                self._counts = cube['counts']
+            else:
+                self._counts = np.memmap(hdf5_filename, dtype=cube['counts'].dtype, mode='r',
+                                         offset=offset, shape=cube['counts'].shape)
+                self._hdf5.close()
+        else:
+            self.temperature, self.time = _experiment_labels(self._hdf5)
+            if not self.temperature:
+                raise ValueError('{} holds no spectra'.format(hdf5_filename))
+            self.wavenumber = self._hdf5['{}/wavenumber'.format(
+                _first_spectrum(self._hdf5, self.temperature, self.time))][()]
+        self.shape = (len(self.temperature), len(self.time), len(self.wavenumber))
+
+    def __getitem__(self, key):
+        if self._counts is not None:
+            return self._counts[key]
+        # read only the spectra that the key selects
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        temps = np.arange(self.shape[0])[key[0]]
+        times = np.arange(self.shape[1])[key[1]]
+        points = np.arange(self.shape[2])[key[2]]
+        cube = np.full((np.size(temps), np.size(times), np.size(points)), np.nan)
+        for i, temp in enumerate(np.atleast_1d(temps)):
+            for j, time in enumerate(np.atleast_1d(times)):
+                group = '{}/{}'.format(self.temperature[temp], self.time[time])
+                if '{}/counts'.format(group) not in self._hdf5:
+                    continue
+                if len(self._hdf5['{}/wavenumber'.format(group)]) != self.shape[2]:
+                    raise ValueError('{} has a different wavenumber axis; run write_cube to '
+                                     'resample every spectrum onto one axis'.format(group))
+                cube[i, j] = self._hdf5['{}/counts'.format(group)][()][points]
+        # drop the axes that were indexed with an integer, as NumPy does
+        return cube.reshape(np.shape(temps) + np.shape(times) + np.shape(points))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return 'SpectrumCube({}, shape={})'.format(self.filename, self.shape)
+
+    def close(self):
+        """Closes the .hdf5 file, when it is still open."""
+        if self._hdf5:
+            self._hdf5.close()
+        self._counts = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def view_hdf5(filename):
@@ -131,8 +735,14 @@ def view_hdf5(filename):
                     for _,layer_3 in enumerate(list(hdf5['{}/{}'.format(layer_1, layer_2)])):
                         if isinstance(hdf5['{}/{}/{}'.format(layer_1, layer_2, layer_3)], h5py.Group):
                             print('|    |    \033[1m{}\033[0m/...'.format(layer_3))
+                        elif layer_3 == 'peaks':
+                            # peak tables show how many peaks they hold
+                            print('|    |    peaks [{} peaks]'.format(
+                                len(hdf5['{}/{}/peaks'.format(layer_1, layer_2)])))
                         else:
                             print('|    |    {}'.format(layer_3))
+                elif layer_2 == 'peaks':
+                    print('|    peaks [{} peaks]'.format(len(hdf5['{}/peaks'.format(layer_1)])))
                 else:
                     print('|    {}'.format(layer_2))
         else:
@@ -154,12 +764,10 @@ def plot_fit(hdf5_filename, key):
     # open .hdf5
     hdf5 = h5py.File(hdf5_filename, 'r')
     # extract spectra data
-    x_data = list(hdf5['{}/wavenumber'.format(key)])
-    y_data = list(hdf5['{}/counts'.format(key)])
-    # extract fitted peak center values
-    peak_centers = []
-    for _,peak in enumerate(list(hdf5[key])[:-2]):
-        peak_centers.append(list(hdf5['{}/{}'.format(key, peak)])[2])
+    x_data = hdf5['{}/wavenumber'.format(key)][()]
+    y_data = hdf5['{}/counts'.format(key)][()]
+    # extract fitted peak center values, from either peak layout
+    peak_centers = list(read_peaks(hdf5[key])[:, PEAK_COLUMNS.index('center')])
     # plot spectra and peak center values
     plt.figure(figsize=(16,5))
     plt.plot(x_data, y_data, label = 'spectra data')
@@ -169,7 +777,7 @@ def plot_fit(hdf5_filename, key):
         else:
             plt.axvline(x=peak, color='orange', alpha=0.6)
     plt.xlabel('wavenumber ($cm^{-1}$)', fontsize=14)
-    plt.xlim(min(x_data), max(x_data))
+    plt.xlim(x_data.min(), x_data.max())
     plt.ylabel('counts', fontsize=14)
     plt.title('{} spectra from {}'.format(key, hdf5_filename), fontsize=16)
     plt.legend(fontsize=12)
\ No newline at end of file
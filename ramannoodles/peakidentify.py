@@ -4,14 +4,32 @@ to be analyzed. From that identification, it then classifies the peaks in the un
 spectra based on the fed-in known spectra.
  """
 import math
+import os
+import tempfile
+from urllib.parse import quote, unquote
+import h5py
 import numpy as np
 import matplotlib.pyplot as plt
+from scipy import fft
+from scipy import linalg
+from scipy import optimize
+from scipy.cluster import vq
+from ramannoodles import shoyu
 from ramannoodles import spectrafit
 
 
 def peak_assignment(unknown_x, unknown_y, known_compound_list,
-                    precision=0.03, plot=True):
-    """This function is a wrapper function from which all classification of peaks occurs."""
+                    precision=0.03, plot=True, fit_cache=None,
+                    method='peaks', library=None, top=None):
+    """This function is a wrapper function from which all classification of peaks occurs.
+    If `fit_cache`, a `spectrafit.FitCache`, is given, the known compounds and the unknown
+    are read from it when they were fit before (see `reference_peaks`). With
+    `method='unmix'`, no peaks are fit at all: the unknown is unmixed against a
+    `SpectralLibrary` of the known compounds, or against `library` if it is given, and the
+    contribution of each compound is printed and returned as a dictionary keyed by the
+    library labels. If `top` is given, the known compounds are first screened by
+    `SpectralLibrary.screen`, and only the `top` best correlated compounds of `library`
+    are fit and compared. A ValueError is raised when none of them is a known compound."""
 
     #Handling errors in inputs.
     if not isinstance(unknown_x, np.ndarray):
@@ -40,23 +58,69 @@ def peak_assignment(unknown_x, unknown_y, known_compound_list,
         raise TypeError("""Passed value of `plot` is not a Boolean!
         Instead, it is: """ + str(type(plot)))
 
+    if fit_cache is not None and not isinstance(fit_cache, spectrafit.FitCache):
+        raise TypeError("""Passed value of `fit_cache` is not a spectrafit.FitCache!
+        Instead, it is: """ + str(type(fit_cache)))
+
+    if not isinstance(method, str):
+        raise TypeError("""Passed value of `method` is not a string!
+        Instead, it is: """ + str(type(method)))
+
+    if method not in ('peaks', 'unmix'):
+        raise ValueError("Passed value of `method` must be 'peaks' or 'unmix', not: " + method)
+
+    if library is not None and not isinstance(library, SpectralLibrary):
+        raise TypeError("""Passed value of `library` is not a SpectralLibrary!
+        Instead, it is: """ + str(type(library)))
+
+    if top is not None and not isinstance(top, int):
+        raise TypeError("""Passed value of `top` is not an int!
+        Instead, it is: """ + str(type(top)))
+
+    if library is None and (method == 'unmix' or top is not None):
+        library = SpectralLibrary({compound['title']: compound
+                                   for compound in known_compound_list})
+
+    if method == 'unmix':
+        #One linear solve against the resampled library replaces the reference fits.
+        weights = library.unmix(unknown_x, unknown_y)[0]
+        contributions = dict(zip(library.labels, weights.tolist()))
+        print(contributions)
+        if plot:
+            plt.plot(unknown_x, unknown_y, color='black', label='Unknown Spectrum')
+            plt.plot(library.grid, weights @ library.matrix, color='red',
+                     linestyle='--', label='Library Fit')
+            plt.legend(loc=0, framealpha=1)
+            plt.xlabel('Wavenumber (cm$^{-1}$)', fontsize=12)
+            plt.ylabel('Counts', fontsize=12)
+            plt.show()
+        return contributions
+
+    if top is not None:
+        #Only the compounds best correlated with the unknown are fit and compared.
+        candidates = [label for label, _ in library.screen(unknown_x, unknown_y, top)]
+        print("The candidates screened from the library are: ")
+        print(candidates)
+        known_compound_list = _screened_compounds(library, candidates, known_compound_list)
+        if not known_compound_list:
+            raise ValueError("None of the candidates screened from the library is in "
+                             "`known_compound_list`! The candidates are: " + str(candidates))
+
     #Lets identify the peaks in the unknown spectrum.
-    unknown_peaks = spectrafit.data_report(unknown_x, unknown_y)[0]
+    unknown_peaks = spectrafit.data_report(unknown_x, unknown_y, cache=fit_cache)[0]
 
     #OK, next identify all of the peaks present in the known compound set.
-    #For efficiency, we'll also compare them against the unknown in the same for loop.
     known_compound_peaks = []
     assignment_matrix = []
 
     for i, _ in enumerate(known_compound_list):
         known_compound_peaks.append(
-            spectrafit.compound_report(known_compound_list[i])[0])
+            reference_peaks(known_compound_list[i], fit_cache)[0])
         print("The peaks that we found for "
               + str(known_compound_list[i]['title']) + " are: ")
         print(known_compound_peaks[i])
-        assignment_matrix.append(compare_unknown_to_known(unknown_peaks,
-                                                          known_compound_peaks[i],
-                                                          precision))
+    #Compare the unknown against every known compound at once.
+    assignment_matrix = list(match_library(unknown_peaks, known_compound_peaks, precision))
 
     #Ok, so that generates a full association matrix that contains everything
     #we need to assign peaks.
@@ -77,6 +141,53 @@ def peak_assignment(unknown_x, unknown_y, known_compound_list,
     print(percentages)
 
 
+def _screened_compounds(library, candidates, known_compound_list):
+    """Returns the known compounds that are the `candidates` labels of `library`. A label
+    that is not the title of a known compound, such as a shoyu_data_dict key, is matched
+    by the spectrum stored under it, against the known compounds resampled onto the grid
+    of the library."""
+    titles = {compound['title'] for compound in known_compound_list}
+    unmatched = [label for label in candidates if label not in titles]
+    screened = [compound for compound in known_compound_list
+                if compound['title'] in candidates]
+    rest = [compound for compound in known_compound_list
+            if compound['title'] not in candidates]
+    if unmatched and rest:
+        rows = library.matrix[[library.labels.index(label) for label in unmatched]]
+        spectra = shoyu.resample_spectra(rest, library.grid)[1]
+        screened += [compound for compound, spectrum in zip(rest, spectra)
+                     if any(np.allclose(spectrum, row) for row in rows)]
+    return screened
+
+
+def reference_peaks(compound, cache=None):
+    """
+    Returns `spectrafit.compound_report` for a known compound, reusing a previous fit when one
+    is stored in `cache`. A `spectrafit.FitCache` with a `cache_dir` saves each fit as its own
+    .npz file, so one cache directory can be shared by many processes.
+
+    Args:
+        compound (dict): a single NIST compound dictionary from shoyu_data_dict.
+        cache (FitCache): (Optional) The cache holding previous fits. If None, the
+                          compound is always fit.
+
+    Returns:
+        peak_centers (list): A list with a peak center value for each peak.
+        peak_sigma (list): A list with a sigma value for each peak.
+        peak_ampl (list): A list with amplitudes for each peak.
+        xmin (float): The minimum wavenumber value in the compound data
+        xmax (float): The maximum wavenumber value in the compound data
+    """
+    #Handling errors in inputs.
+    if not isinstance(compound, dict):
+        raise TypeError("Passed value of `compound` is not a dictionary! Instead, it is: "
+                        + str(type(compound)))
+    if cache is not None and not isinstance(cache, spectrafit.FitCache):
+        raise TypeError("Passed value of `cache` is not a spectrafit.FitCache! Instead, it is: "
+                        + str(type(cache)))
+    return spectrafit.compound_report(compound, cache=cache)
+
+
 def compare_unknown_to_known(combined_peaks, known_peaks, precision):
     """This function takes in peak positions for the spectrum to be
     analyzed and a single known compound and determines if the peaks
@@ -95,27 +206,763 @@ def compare_unknown_to_known(combined_peaks, known_peaks, precision):
         raise TypeError("""Passed value of `precision` is not a float or int!
         Instead, it is: """ + str(type(precision)))
 
-    assignment_matrix = np.zeros(len(combined_peaks))
-    peaks_found = 0
-    for i, _ in enumerate(combined_peaks):
-        for j, _ in enumerate(known_peaks):
-            # instead of If, call peak_1D_score
-            if math.isclose(combined_peaks[i], known_peaks[j],
-                            rel_tol=precision):
-                # Instead of using a 1, just input the score
-                # from the score calculator.
-                # Bigger is better.
-                # Storing only the second component in the list.
-                assignment_matrix[i] = 1
-                peaks_found += 1
-                continue
+    assignment_matrix = match_library(combined_peaks, [known_peaks], precision)[0]
+    return assignment_matrix
+
+
+def _window_pairs(sorted_values, lower, upper):
+    """
+    Returns every (query, position) pair where `sorted_values[position]` lies in the closed
+    window [lower[query], upper[query]], found with np.searchsorted on the sorted values.
+    """
+    start = np.searchsorted(sorted_values, lower, 'left')
+    stop = np.searchsorted(sorted_values, upper, 'right')
+    counts = np.maximum(stop - start, 0)
+    query = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    position = np.repeat(start, counts) + offsets
+    return query, position
+
+
+def _match_windows(unknown, precision, score):
+    """
+    Returns the lower and upper wavenumber of the window that can hold a match for each
+    unknown peak, for the binary and the score tests of `match_library`.
+    """
+    if score:
+        return unknown - 50, unknown + 50
+    if precision < 1:
+        #Peaks within a relative tolerance of a peak form an interval around it. It is widened
+        #slightly here, and the exact test applied to each candidate decides its edges.
+        bounds = np.sort([unknown*(1 - precision), unknown/(1 - precision)], axis=0)
+        return bounds[0] - 1e-9*np.abs(bounds[0]), bounds[1] + 1e-9*np.abs(bounds[1])
+    return np.full(len(unknown), -np.inf), np.full(len(unknown), np.inf)
+
+
+def match_library(unknown_peaks, known_compound_peaks, precision=0.03, score=False):
+    """This function compares the unknown peaks against the peaks of every known compound in a
+    single vectorized pass. All known peaks are sorted once, and np.searchsorted finds the few
+    known peaks near each unknown peak, so no unknown and known peak pair is looped over.
+
+    Args:
+        unknown_peaks (list like): The peak centers of the spectrum to be analyzed.
+        known_compound_peaks (list): One list of peak centers per known compound.
+        precision (float): (Optional) The relative tolerance used to call two peaks a match.
+        score (boolean): (Optional) If False (default), a peak is marked 1 when a peak of the
+                        compound lies within `precision` of it, exactly as in
+                        `compare_unknown_to_known`. If True, the peak is given the reciprocal
+                        distance score of `peak_1d_score` for the closest peak of the compound,
+                        1 / (distance + 1), or 0 when that score is not above 0.02.
+
+    Returns:
+        assignment_matrix (numpy array): An array with one row per known compound and one
+                        column per unknown peak.
+    """
+    #Handling errors in inputs.
+    if not isinstance(unknown_peaks, (list, np.ndarray)):
+        raise TypeError("""Passed value of `unknown_peaks` is not a list or ndarray!
+        Instead, it is: """ + str(type(unknown_peaks)))
+
+    if not isinstance(known_compound_peaks, list):
+        raise TypeError("""Passed value of `known_compound_peaks` is not a list!
+        Instead, it is: """ + str(type(known_compound_peaks)))
+
+    if not isinstance(precision, (float, int)):
+        raise TypeError("""Passed value of `precision` is not a float or int!
+        Instead, it is: """ + str(type(precision)))
+
+    if not isinstance(score, bool):
+        raise TypeError("""Passed value of `score` is not a Boolean!
+        Instead, it is: """ + str(type(score)))
+
+    unknown = np.asarray(unknown_peaks, dtype=np.float64).ravel()
+    lengths = [len(known) for known in known_compound_peaks]
+    values = np.concatenate([np.asarray(known, dtype=np.float64).ravel()
+                             for known in known_compound_peaks] + [np.zeros(0)])
+    owner = np.repeat(np.arange(len(known_compound_peaks)), lengths)
+    order = np.argsort(values, kind='stable')
+    values = values[order]
+    owner = owner[order]
+
+    #Find the window that can hold a match for each unknown peak.
+    lower, upper = _match_windows(unknown, precision, score)
+    index_u, index_k = _window_pairs(values, lower, upper)
+    difference = np.abs(values[index_k] - unknown[index_u])
+
+    assignment_matrix = np.zeros((len(known_compound_peaks), len(unknown)))
+    if score:
+        reciprocal = 1 / (difference + 1)
+        keep = reciprocal > .02
+        np.maximum.at(assignment_matrix, (owner[index_k[keep]], index_u[keep]),
+                      reciprocal[keep])
+    else:
+        #The same test as math.isclose.
+        keep = ((difference <= np.abs(precision*values[index_k]))
+                | (difference <= np.abs(precision*unknown[index_u])))
+        assignment_matrix[owner[index_k[keep]], index_u[keep]] = 1
+    return assignment_matrix
+
+
+class PeakIndex():
+    """
+    Inverted index of reference peak centers over fixed width wavenumber bins, used to screen
+    an unknown spectrum against a whole library. Each bin maps to the (label, peak id, center,
+    sigma) entries of the reference peaks that fall in it, so a query only visits the bins
+    around the unknown peaks and never touches compounds without a nearby peak. Compounds
+    can be added one at a time, for example by `shoyu.add_jdx` and `shoyu.more_please`.
+
+    Args:
+        library (dict): (Optional) A shoyu_data_dict or `shoyu.ShoyuStore` whose compounds
+                        are added to the index.
+        bin_width (float): (Optional) The width of each wavenumber bin.
+        cache (FitCache): (Optional) The reference peak cache passed to `reference_peaks`.
+    """
+    def __init__(self, library=None, bin_width=10, cache=None):
+        #Handling errors in inputs.
+        if not isinstance(bin_width, (float, int)):
+            raise TypeError("Passed value of `bin_width` is not a float or int! Instead, it is: "
+                            + str(type(bin_width)))
+        if bin_width <= 0:
+            raise ValueError("Passed value of `bin_width` is not within bounds!")
+        if cache is not None and not isinstance(cache, spectrafit.FitCache):
+            raise TypeError("Passed value of `cache` is not a spectrafit.FitCache! "
+                            "Instead, it is: " + str(type(cache)))
+        self.bin_width = bin_width
+        self.cache = cache
+        self.bins = {}
+        self.compounds = {}
+        if library is not None:
+            self.update(library)
+
+    def update(self, library):
+        """Adds every compound of a shoyu_data_dict or `shoyu.ShoyuStore` to the index."""
+        if not hasattr(library, 'items'):
+            raise TypeError("Passed value of `library` is not a dictionary! Instead, it is: "
+                            + str(type(library)))
+        for label, compound in library.items():
+            self.add(label, compound)
+
+    def add(self, label, compound):
+        """Fits the reference peaks of a compound and adds them to the index under `label`."""
+        if not isinstance(compound, dict):
+            raise TypeError("Passed value of `compound` is not a dictionary! Instead, it is: "
+                            + str(type(compound)))
+        peak_centers, peak_sigma = reference_peaks(compound, self.cache)[:2]
+        self.add_peaks(label, peak_centers, peak_sigma)
+
+    def add_peaks(self, label, peak_centers, peak_sigma=None):
+        """
+        Adds already fit peaks to the index under `label`, replacing any peaks that were
+        stored for that label before.
+        """
+        if not isinstance(label, str):
+            raise TypeError("Passed value of `label` is not a string! Instead, it is: "
+                            + str(type(label)))
+        if not isinstance(peak_centers, (list, np.ndarray)):
+            raise TypeError("Passed value of `peak_centers` is not a list or ndarray! "
+                            "Instead, it is: " + str(type(peak_centers)))
+        if peak_sigma is None:
+            peak_sigma = [np.nan]*len(peak_centers)
+        if label in self.compounds:
+            self.remove(label)
+        #The centers are kept so that `remove` only visits the bins of this compound.
+        self.compounds[label] = [float(center) for center in peak_centers]
+        for peak_id, (center, sigma) in enumerate(zip(peak_centers, peak_sigma)):
+            entry = (label, peak_id, float(center), float(sigma))
+            self.bins.setdefault(math.floor(center / self.bin_width), []).append(entry)
+
+    def remove(self, label):
+        """Removes every peak stored under `label` from the index."""
+        if label not in self.compounds:
+            raise KeyError(label)
+        keys = {math.floor(center / self.bin_width) for center in self.compounds.pop(label)}
+        for key in keys:
+            entries = [entry for entry in self.bins[key] if entry[0] != label]
+            if entries:
+                self.bins[key] = entries
             else:
-                pass
-        if peaks_found == len(known_peaks):
-            continue
+                del self.bins[key]
+
+    def query(self, unknown_peaks, precision=0.03, score=False, top=None):
+        """
+        Ranks the compounds of the index against a list of unknown peaks.
+
+        Args:
+            unknown_peaks (list like): The peak centers of the spectrum to be analyzed.
+            precision (float): (Optional) The relative tolerance used to call two peaks a match.
+            score (boolean): (Optional) If False (default), compounds are ranked by the number
+                            of unknown peaks they match, as summed from the rows of
+                            `match_library`. If True, they are ranked by the sum of the
+                            `match_library` scores instead.
+            top (int): (Optional) The number of candidates to return. All compounds with at
+                       least one match are returned if None.
+
+        Returns:
+            candidates (list): (label, value) tuples, best match first. Ties are ordered
+                               by label.
+        """
+        #Handling errors in inputs.
+        if not isinstance(unknown_peaks, (list, np.ndarray)):
+            raise TypeError("Passed value of `unknown_peaks` is not a list or ndarray! "
+                            "Instead, it is: " + str(type(unknown_peaks)))
+        if not isinstance(precision, (float, int)):
+            raise TypeError("Passed value of `precision` is not a float or int! Instead, it is: "
+                            + str(type(precision)))
+        if not isinstance(score, bool):
+            raise TypeError("Passed value of `score` is not a Boolean! Instead, it is: "
+                            + str(type(score)))
+        if top is not None and not isinstance(top, int):
+            raise TypeError("Passed value of `top` is not an int! Instead, it is: "
+                            + str(type(top)))
+        unknown = np.asarray(unknown_peaks, dtype=np.float64).ravel()
+        lower, upper = _match_windows(unknown, precision, score)
+        totals = {}
+        for peak, low, high in zip(unknown, lower, upper):
+            if np.isfinite(low) and np.isfinite(high):
+                keys = range(math.floor(low / self.bin_width),
+                             math.floor(high / self.bin_width) + 1)
+            else:
+                keys = list(self.bins)
+            best = {}
+            for key in keys:
+                for label, _, center, _ in self.bins.get(key, ()):
+                    difference = abs(center - peak)
+                    if score:
+                        value = 1 / (difference + 1)
+                        if value > .02 and value > best.get(label, 0):
+                            best[label] = value
+                    #The same test as math.isclose.
+                    elif (difference <= abs(precision*center)
+                          or difference <= abs(precision*peak)):
+                        best[label] = 1
+            for label, value in best.items():
+                totals[label] = totals.get(label, 0) + value
+        candidates = sorted(totals.items(), key=lambda item: (-item[1], item[0]))
+        if top is not None:
+            candidates = candidates[:top]
+        return candidates
+
+    def __contains__(self, label):
+        return label in self.compounds
+
+    def __len__(self):
+        return len(self.compounds)
+
+    def __repr__(self):
+        return 'PeakIndex({} compounds, {} bins)'.format(len(self.compounds), len(self.bins))
+
+
+class SpectralLibrary():
+    """
+    Reference library resampled once onto a common wavenumber grid, for the quantitative
+    identification of unknowns by non-negative least squares. The resampled spectra are kept
+    as a matrix with one row per compound, along with their Gram matrix and its Cholesky
+    factor. An unknown only needs one product with the matrix, and the least squares problem
+    is then solved on the small compounds by compounds factor instead of the full grid, so
+    a batch of unknowns is unmixed without fitting any peaks.
+
+    Args:
+        library (dict): (Optional) A shoyu_data_dict or `shoyu.ShoyuStore` whose compounds
+                        are resampled with `shoyu.resample_spectra`.
+        grid (list like): (Optional) The wavenumbers to resample onto. Defaults to the
+                          integer wavenumbers across the range of all the compounds.
+    """
+    def __init__(self, library=None, grid=None):
+        #Handling errors in inputs.
+        if library is not None and not hasattr(library, 'items'):
+            raise TypeError("Passed value of `library` is not a dictionary! Instead, it is: "
+                            + str(type(library)))
+        if grid is not None and not isinstance(grid, (list, np.ndarray)):
+            raise TypeError("Passed value of `grid` is not a list or ndarray! Instead, it is: "
+                            + str(type(grid)))
+        self.labels = []
+        self.grid = np.zeros(0) if grid is None else np.asarray(grid, dtype=np.float64)
+        self.matrix = np.zeros((0, len(self.grid)))
+        if library is not None and len(library) > 0:
+            labels, compounds = zip(*library.items())
+            self.grid, self.matrix = shoyu.resample_spectra(list(compounds), grid)
+            self.grid = np.asarray(self.grid, dtype=np.float64)
+            self.labels = list(labels)
+        self._factor()
+
+    def _factor(self):
+        """Computes the Gram matrix of the library and its upper Cholesky factor. A ridge
+        of 1e-10 of the mean diagonal keeps the factor defined for repeated compounds."""
+        self.gram = self.matrix @ self.matrix.T
+        self._transform = None
+        ridge = 1e-10*np.trace(self.gram)/max(len(self.labels), 1) or 1e-300
+        self._cholesky = linalg.cholesky(self.gram + ridge*np.eye(len(self.labels)))
+
+    def save(self, filename):
+        """Stores the grid, labels, resampled matrix and Gram matrix in an .npz file."""
+        if not isinstance(filename, str):
+            raise TypeError("Passed value of `filename` is not a string! Instead, it is: "
+                            + str(type(filename)))
+        directory = os.path.dirname(os.path.abspath(filename))
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as library_file:
+            np.savez(library_file, labels=np.array(self.labels, dtype=str), grid=self.grid,
+                     matrix=self.matrix, gram=self.gram)
+        os.replace(temporary, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Returns the library stored in an .npz file by `save`."""
+        if not isinstance(filename, str):
+            raise TypeError("Passed value of `filename` is not a string! Instead, it is: "
+                            + str(type(filename)))
+        library = cls()
+        with np.load(filename) as stored:
+            library.labels = stored['labels'].tolist()
+            library.grid = stored['grid']
+            library.matrix = stored['matrix']
+        library._factor()
+        return library
+
+    def resample(self, unknown_x, unknown_y):
+        """Linearly interpolates one unknown, or a 2-D array of unknowns sharing `unknown_x`,
+        onto the grid of the library. Grid points outside of `unknown_x` are zero."""
+        return _resample_unknown(self.grid, unknown_x, unknown_y)
+
+    def unmix(self, unknown_x, unknown_y):
+        """
+        Finds the non-negative contribution of every compound to an unknown spectrum, or to
+        a batch of unknowns, that best reproduces it in the least squares sense.
+
+        Args:
+            unknown_x (numpy array): The wavenumbers of the unknowns.
+            unknown_y (numpy array): The spectrum of one unknown, or a 2-D array with one
+                                     unknown per row.
+
+        Returns:
+            weights (numpy array): The contribution of each compound, in the order of
+                                   `labels`, with one row per unknown for a batch.
+            residual (numpy array): The norm of the difference between each resampled
+                                    unknown and its reconstruction.
+        """
+        #Handling errors in inputs.
+        if not isinstance(unknown_x, np.ndarray):
+            raise TypeError("Passed value of `unknown_x` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_x)))
+        if not isinstance(unknown_y, np.ndarray):
+            raise TypeError("Passed value of `unknown_y` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_y)))
+        if unknown_y.shape[-1] != len(unknown_x):
+            raise ValueError("The length of `unknown_y` does not match `unknown_x`!")
+        spectra = self.resample(unknown_x, unknown_y)
+        products = spectra @ self.matrix.T
+        #With G = R^T R, |A^T w - y|^2 = |R w - R^-T A y|^2 + |y|^2 - |R^-T A y|^2.
+        targets = linalg.solve_triangular(self._cholesky, products.T, trans='T').T
+        weights = np.zeros((len(spectra), len(self.labels)))
+        if self.labels:
+            weights[:] = [optimize.nnls(self._cholesky, target)[0] for target in targets]
+        squares = ((spectra**2).sum(axis=1) - 2*(weights*products).sum(axis=1)
+                   + ((weights @ self.gram)*weights).sum(axis=1))
+        residual = np.sqrt(np.maximum(squares, 0))
+        if unknown_y.ndim == 1:
+            return weights[0], residual[0]
+        return weights, residual
+
+    def screen(self, unknown_x, unknown_y, top=5, max_shift=10):
+        """
+        Ranks the compounds of the library by their normalized cross-correlation with an
+        unknown spectrum, or with a batch of unknowns, as a cheap pre-screen before peaks
+        are fit. Every spectrum is centered and scaled to unit norm on the grid, and the
+        correlations at all shifts are found at once with FFTs. The transforms of the
+        library are computed once and kept.
+
+        Args:
+            unknown_x (numpy array): The wavenumbers of the unknowns.
+            unknown_y (numpy array): The spectrum of one unknown, or a 2-D array with one
+                                     unknown per row.
+            top (int): (Optional) The number of candidates to return. All compounds are
+                       returned if None.
+            max_shift (float): (Optional) The largest shift, in wavenumbers, between the
+                               unknown and a compound over which the correlation is maximized.
+
+        Returns:
+            candidates (list): (label, correlation) tuples, best match first, with ties
+                               ordered by label. For a batch, one such list per unknown.
+        """
+        #Handling errors in inputs.
+        if not isinstance(unknown_x, np.ndarray):
+            raise TypeError("Passed value of `unknown_x` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_x)))
+        if not isinstance(unknown_y, np.ndarray):
+            raise TypeError("Passed value of `unknown_y` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_y)))
+        if unknown_y.shape[-1] != len(unknown_x):
+            raise ValueError("The length of `unknown_y` does not match `unknown_x`!")
+        if top is not None and not isinstance(top, int):
+            raise TypeError("Passed value of `top` is not an int! Instead, it is: "
+                            + str(type(top)))
+        if not isinstance(max_shift, (float, int)):
+            raise TypeError("Passed value of `max_shift` is not a float or int! Instead, it is: "
+                            + str(type(max_shift)))
+        step = np.median(np.diff(self.grid)) if len(self.grid) > 1 else 1
+        lags = int(round(abs(max_shift) / step))
+        #Zero padded by the largest shift, so the correlations do not wrap around.
+        size = fft.next_fast_len(len(self.grid) + lags, real=True)
+        if self._transform is None or self._transform[0] != size:
+            self._transform = (size, np.conj(fft.rfft(_normalize_rows(self.matrix), size)))
+        spectra = _normalize_rows(self.resample(unknown_x, unknown_y))
+        correlation = fft.irfft(fft.rfft(spectra, size)[:, None, :] * self._transform[1],
+                                size)
+        #Shifts of 0 to lags grid points are at the start, negative shifts at the end.
+        shifts = np.r_[np.arange(lags + 1), np.arange(size - lags, size)]
+        scores = correlation[:, :, shifts].max(axis=2)
+        candidates = [sorted(zip(self.labels, row.tolist()), key=lambda item: (-item[1], item[0]))
+                      [:top] for row in scores]
+        if unknown_y.ndim == 1:
+            return candidates[0]
+        return candidates
+
+    def __contains__(self, label):
+        return label in self.labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __repr__(self):
+        return 'SpectralLibrary({} compounds, {} grid points)'.format(len(self.labels),
+                                                                     len(self.grid))
+
+
+class EmbeddingIndex():
+    """
+    Approximate nearest neighbour index of library spectra kept in an .hdf5 file, for
+    libraries too large to scan. Each compound is resampled onto a fixed grid, centered and
+    scaled to unit norm, and projected to a low dimensional embedding, by PCA or by a random
+    projection. The embeddings are split into inverted file (IVF) lists around k-means
+    centroids, and every list is stored as its own datasets, so a query only reads the few
+    lists whose centroids are nearest to the unknown.
+
+    Compounds added before the projection can be fit (`dimensions` + 1 compounds for PCA)
+    are kept in a buffer that queries scan exactly. Once enough compounds are buffered, the
+    projection and the centroids are fit to them and fixed. Later compounds are added to
+    the list of their nearest centroid, and a list that grows beyond twice the square root
+    of the size of the index is split in two, so the lists grow with the library. Each
+    label is linked to the list that holds it, so compounds can be added, replaced and
+    removed one at a time, for example by `shoyu.add_jdx`, without reading the other lists.
+
+    Args:
+        filename (str): The .hdf5 file that holds the index. It is created if it does not
+                        exist. An existing index keeps the settings it was created with.
+        grid (list like): (Optional) The wavenumbers to resample onto. Defaults to the
+                          integer wavenumbers across the range of the first compounds added.
+        dimensions (int): (Optional) The number of dimensions of the embedding.
+        n_lists (int): (Optional) The number of IVF lists the centroids are first fit with.
+                       Defaults to the square root of the number of compounds they are fit
+                       to. Training waits for at least this many compounds.
+        projection (str): (Optional) 'pca' (default) projects onto the principal components
+                          of the first compounds added. 'random' uses a seeded Gaussian
+                          random projection, which needs no compounds to be fit.
+        seed (int): (Optional) The seed of the random projection and of k-means.
+    """
+    def __init__(self, filename, grid=None, dimensions=32, n_lists=None, projection='pca',
+                 seed=0):
+        #Handling errors in inputs.
+        if not isinstance(filename, str):
+            raise TypeError("Passed value of `filename` is not a string! Instead, it is: "
+                            + str(type(filename)))
+        if not filename.split('/')[-1].split('.')[-1] == 'hdf5':
+            raise TypeError("`filename` is not type = .hdf5! Instead, it is: "
+                            + filename.split('/')[-1].split('.')[-1])
+        if grid is not None and not isinstance(grid, (list, np.ndarray)):
+            raise TypeError("Passed value of `grid` is not a list or ndarray! Instead, it is: "
+                            + str(type(grid)))
+        if not isinstance(dimensions, int):
+            raise TypeError("Passed value of `dimensions` is not an int! Instead, it is: "
+                            + str(type(dimensions)))
+        if n_lists is not None and not isinstance(n_lists, int):
+            raise TypeError("Passed value of `n_lists` is not an int! Instead, it is: "
+                            + str(type(n_lists)))
+        if projection not in ('pca', 'random'):
+            raise ValueError("Passed value of `projection` must be 'pca' or 'random', not: "
+                             + str(projection))
+        if not isinstance(seed, int):
+            raise TypeError("Passed value of `seed` is not an int! Instead, it is: "
+                            + str(type(seed)))
+        self.filename = filename
+        with h5py.File(self.filename, 'a') as index:
+            if 'projection' not in index.attrs:
+                index.attrs['dimensions'] = dimensions
+                index.attrs['n_lists'] = n_lists or 0
+                index.attrs['projection'] = projection
+                index.attrs['seed'] = seed
+                if grid is not None:
+                    index['grid'] = np.asarray(grid, dtype=np.float64)
+                index.create_group('lists')
+                index.create_group('members')
+
+    def update(self, library, batch_size=1000):
+        """Adds every compound of a shoyu_data_dict or `shoyu.ShoyuStore` to the index,
+        resampling `batch_size` compounds at a time. A compound already stored under the
+        same label is replaced."""
+        if not hasattr(library, 'items'):
+            raise TypeError("Passed value of `library` is not a dictionary! Instead, it is: "
+                            + str(type(library)))
+        labels = list(library.keys())
+        for start in range(0, len(labels), batch_size):
+            batch = labels[start:start + batch_size]
+            self._add(batch, [library[label] for label in batch])
+
+    def add(self, label, compound):
+        """Adds a compound to the index under `label`, replacing any compound stored under
+        that label before."""
+        if not isinstance(label, str):
+            raise TypeError("Passed value of `label` is not a string! Instead, it is: "
+                            + str(type(label)))
+        if not isinstance(compound, dict):
+            raise TypeError("Passed value of `compound` is not a dictionary! Instead, it is: "
+                            + str(type(compound)))
+        self._add([label], [compound])
+
+    def _add(self, labels, compounds):
+        """Resamples compounds and adds them to the buffer, or to the lists once trained."""
+        with h5py.File(self.filename, 'a') as index:
+            grid = index['grid'][()] if 'grid' in index else None
+            grid, spectra = shoyu.resample_spectra(compounds, grid)
+            if 'grid' not in index:
+                index['grid'] = np.asarray(grid, dtype=np.float64)
+            spectra = _normalize_rows(spectra)
+            _remove_members(index, labels)
+            if 'centroids' in index:
+                _insert_members(index, labels, _embed(index, spectra))
+                return
+            _append_rows(index, 'buffer', labels, spectra)
+            projection = index.attrs['projection']
+            needed = max(int(index.attrs['dimensions']) + 1 if projection == 'pca' else 1,
+                         int(index.attrs['n_lists']))
+            if len(index['buffer/labels']) >= needed:
+                self._train(index)
+
+    @staticmethod
+    def _train(index):
+        """Fits the projection and the IVF centroids to the buffered compounds, and moves
+        them into the lists."""
+        dimensions = int(index.attrs['dimensions'])
+        spectra = index['buffer/vectors'][()].astype(np.float64)
+        labels = index['buffer/labels'].asstr()[()].tolist()
+        if index.attrs['projection'] == 'pca':
+            mean = spectra.mean(axis=0)
+            components = linalg.svd(spectra - mean, full_matrices=False)[2][:dimensions]
         else:
-            pass
-    return assignment_matrix
+            mean = np.zeros(spectra.shape[1])
+            generator = np.random.RandomState(int(index.attrs['seed']))
+            components = (generator.standard_normal((dimensions, spectra.shape[1]))
+                          / np.sqrt(dimensions))
+        index['mean'] = mean
+        index['components'] = components
+        vectors = _embed(index, spectra)
+        n_lists = int(index.attrs['n_lists']) or int(round(np.sqrt(len(vectors))))
+        n_lists = max(1, min(n_lists, len(vectors)))
+        if n_lists == 1:
+            centroids = vectors.mean(axis=0, keepdims=True)
+        else:
+            centroids = vq.kmeans2(vectors, n_lists, minit='++',
+                                   seed=int(index.attrs['seed']))[0]
+        index.create_dataset('centroids', data=centroids,
+                             maxshape=(None, centroids.shape[1]))
+        del index['buffer']
+        _insert_members(index, labels, vectors)
+
+    def remove(self, label):
+        """Removes the compound stored under `label` from the index."""
+        with h5py.File(self.filename, 'a') as index:
+            if not _remove_members(index, [label]):
+                raise KeyError(label)
+
+    def query(self, unknown_x, unknown_y, top=5, n_probe=None):
+        """
+        Finds the compounds of the index nearest to an unknown spectrum, or to a batch of
+        unknowns, in the embedding. Only the `n_probe` lists with the nearest centroids are
+        read and searched. Before the index is trained, every buffered compound is compared
+        with the unknown on the full grid instead.
+
+        Args:
+            unknown_x (numpy array): The wavenumbers of the unknowns.
+            unknown_y (numpy array): The spectrum of one unknown, or a 2-D array with one
+                                     unknown per row.
+            top (int): (Optional) The number of candidates to return. Every compound in
+                       the probed lists is returned if None.
+            n_probe (int): (Optional) The number of lists searched. Defaults to the square
+                           root of the number of lists.
+
+        Returns:
+            candidates (list): (label, distance) tuples, nearest first, with ties ordered by
+                               label. For a batch, one such list per unknown.
+        """
+        #Handling errors in inputs.
+        if not isinstance(unknown_x, np.ndarray):
+            raise TypeError("Passed value of `unknown_x` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_x)))
+        if not isinstance(unknown_y, np.ndarray):
+            raise TypeError("Passed value of `unknown_y` is not a np.ndarray! Instead, it is: "
+                            + str(type(unknown_y)))
+        if top is not None and not isinstance(top, int):
+            raise TypeError("Passed value of `top` is not an int! Instead, it is: "
+                            + str(type(top)))
+        if n_probe is not None and not isinstance(n_probe, int):
+            raise TypeError("Passed value of `n_probe` is not an int! Instead, it is: "
+                            + str(type(n_probe)))
+        with h5py.File(self.filename, 'r') as index:
+            if 'grid' not in index:
+                candidates = [[] for _ in np.atleast_2d(unknown_y)]
+                return candidates[0] if unknown_y.ndim == 1 else candidates
+            spectra = _normalize_rows(_resample_unknown(index['grid'][()], unknown_x,
+                                                        unknown_y))
+            if 'centroids' in index:
+                vectors = _embed(index, spectra)
+                centroids = index['centroids'][()]
+                n_probe = n_probe or int(round(np.sqrt(len(centroids))))
+            else:
+                vectors = spectra
+            candidates = []
+            for vector in vectors:
+                if 'centroids' in index:
+                    #The nearest lists that hold any compounds are searched.
+                    groups = []
+                    for number in np.argsort(((centroids - vector)**2).sum(axis=1)):
+                        group = index['lists'].get(str(number))
+                        if group is not None and len(group['labels']) > 0:
+                            groups.append(group)
+                        if len(groups) == n_probe:
+                            break
+                else:
+                    groups = [index['buffer']] if 'buffer' in index else []
+                labels, distances = [], []
+                for group in groups:
+                    labels.extend(group['labels'].asstr()[()])
+                    distances.extend(np.linalg.norm(group['vectors'][()] - vector, axis=1))
+                found = sorted(zip(labels, np.asarray(distances, dtype=float).tolist()),
+                               key=lambda item: (item[1], item[0]))
+                candidates.append(found[:top])
+        if unknown_y.ndim == 1:
+            return candidates[0]
+        return candidates
+
+    def __iter__(self):
+        with h5py.File(self.filename, 'r') as index:
+            labels = [unquote(name) for name in index['members']]
+        return iter(labels)
+
+    def __contains__(self, label):
+        if not isinstance(label, str):
+            return False
+        with h5py.File(self.filename, 'r') as index:
+            return index['members'].get(quote(label, safe=' '), getlink=True) is not None
+
+    def __len__(self):
+        with h5py.File(self.filename, 'r') as index:
+            return len(index['members'])
+
+    def __repr__(self):
+        return 'EmbeddingIndex({!r})'.format(self.filename)
+
+
+def _embed(index, spectra):
+    """Projects normalized spectra with the projection of an open EmbeddingIndex file."""
+    return (spectra - index['mean'][()]) @ index['components'][()].T
+
+
+def _append_rows(index, path, labels, vectors):
+    """Appends labeled rows to the list at `path` of an open EmbeddingIndex file, creating it
+    if needed, and links each label to that list."""
+    group = index.require_group(path)
+    if 'vectors' not in group:
+        width = vectors.shape[1]
+        group.create_dataset('vectors', shape=(0, width), maxshape=(None, width),
+                             dtype=np.float32, chunks=(min(256, max(1, 2**18 // width)), width))
+        group.create_dataset('labels', shape=(0,), maxshape=(None,),
+                             dtype=h5py.string_dtype(), chunks=(256,))
+    size = len(group['labels'])
+    group['vectors'].resize(size + len(labels), axis=0)
+    group['labels'].resize(size + len(labels), axis=0)
+    group['vectors'][size:] = vectors
+    group['labels'][size:] = labels
+    for label in labels:
+        name = quote(label, safe=' ')
+        if index['members'].get(name, getlink=True) is not None:
+            del index['members'][name]
+        index['members'][name] = h5py.SoftLink(group.name)
+
+
+def _insert_members(index, labels, vectors):
+    """Adds embedded compounds to the lists of their nearest centroids, splitting any list
+    that grows beyond twice the square root of the size of the index."""
+    lists = vq.vq(vectors, index['centroids'][()])[0]
+    for number in np.unique(lists):
+        members = np.flatnonzero(lists == number)
+        _append_rows(index, 'lists/{}'.format(number), [labels[member] for member in members],
+                     vectors[members])
+    largest = max(4, 2*np.sqrt(len(index['members'])))
+    for number in np.unique(lists):
+        if len(index['lists/{}/labels'.format(number)]) > largest:
+            _split_list(index, int(number))
+
+
+def _split_list(index, number):
+    """Splits an IVF list of an open EmbeddingIndex file in two with 2-means, giving the
+    second half a new centroid and list."""
+    group = index['lists'][str(number)]
+    vectors = group['vectors'][()].astype(np.float64)
+    labels = group['labels'].asstr()[()]
+    if np.ptp(vectors, axis=0).max() == 0:
+        return
+    centroids, assigned = vq.kmeans2(vectors, 2, minit='++', seed=int(index.attrs['seed']))
+    if assigned.min() == assigned.max():
+        return
+    new = len(index['centroids'])
+    index['centroids'].resize(new + 1, axis=0)
+    index['centroids'][number] = centroids[0]
+    index['centroids'][new] = centroids[1]
+    keep = assigned == 0
+    _write_rows(group, labels[keep], vectors[keep])
+    _append_rows(index, 'lists/{}'.format(new), labels[~keep].tolist(), vectors[~keep])
+
+
+def _write_rows(group, labels, vectors):
+    """Replaces the rows of a list group of an EmbeddingIndex file."""
+    group['vectors'].resize(len(labels), axis=0)
+    group['labels'].resize(len(labels), axis=0)
+    group['vectors'][:] = vectors
+    group['labels'][:] = list(labels)
+
+
+def _remove_members(index, labels):
+    """Removes the entries with any of `labels` from an open EmbeddingIndex file, reading
+    only the lists that hold them, and returns the number removed."""
+    owners = {}
+    for label in labels:
+        name = quote(label, safe=' ')
+        link = index['members'].get(name, getlink=True)
+        if link is not None:
+            owners.setdefault(link.path, set()).add(label)
+            del index['members'][name]
+    for path, removed in owners.items():
+        group = index[path]
+        stored = group['labels'].asstr()[()]
+        keep = ~np.isin(stored, list(removed))
+        _write_rows(group, stored[keep], group['vectors'][()][keep])
+    return sum(len(removed) for removed in owners.values())
+
+
+def _resample_unknown(grid, unknown_x, unknown_y):
+    """Linearly interpolates one unknown, or a 2-D array of unknowns sharing `unknown_x`,
+    onto `grid`, as a 2-D array. Grid points outside of `unknown_x` are zero."""
+    order = np.argsort(unknown_x, kind='stable')
+    unknown_x = np.asarray(unknown_x, dtype=np.float64)[order]
+    unknown_y = np.atleast_2d(np.asarray(unknown_y, dtype=np.float64))[:, order]
+    return np.array([np.interp(grid, unknown_x, row, left=0, right=0) for row in unknown_y])
+
+
+def _normalize_rows(spectra):
+    """Returns the rows of `spectra` centered and scaled to unit norm. Constant rows are
+    left at zero."""
+    centered = spectra - spectra.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(centered, axis=1, keepdims=True)
+    return np.divide(centered, norms, out=np.zeros_like(centered), where=norms > 0)
 
 
 def peak_position_comparisons(unknown_peaks, known_compound_peaks,
@@ -269,23 +1116,25 @@ def peak_1d_score(row_i, row_j, scoremax):
     if scoremax < 0:
         raise ValueError("""Passed value of `scoremax` is not within bounds!""")
 
-    # Initializing the variables
-    scores = []
-    peaks = []
-
-    for i, _ in enumerate(row_i):
-        for j, _ in enumerate(row_j):
-            # Calculating distances between peaks
-            distance = np.where((row_i[i] - row_j[j] > 50), np.nan,
-                                math.sqrt(sum([math.pow(row_i[i] - row_j[j], 2)])))
-            # Score for peaks less than 50 units apart
-            if 1 / (distance + 1) > .02:
-                # Dividing over the given max score
-                scores.append(((1 / (distance + 1)) / scoremax))
-                # Appends a tuple of the compared peaks
-                peaks.append((row_i[i], row_j[j]))
-            else:
-                pass
+    # Sort row_j once so the peaks within 50 units of each peak in row_i
+    # are found with np.searchsorted instead of comparing every pair
+    values_i = np.asarray(row_i, dtype=np.float64).ravel()
+    values_j = np.asarray(row_j, dtype=np.float64).ravel()
+    order = np.argsort(values_j, kind='stable')
+    index_i, index_j = _window_pairs(values_j[order], values_i - 50, values_i + 50)
+    index_j = order[index_j]
+    # Keep the row_i then row_j order of the pairwise comparison
+    pairs = np.lexsort((index_j, index_i))
+    index_i = index_i[pairs]
+    index_j = index_j[pairs]
+    # Calculating distances between peaks
+    distance = np.abs(values_i[index_i] - values_j[index_j])
+    # Score for peaks less than 50 units apart
+    keep = 1 / (distance + 1) > .02
+    # Dividing over the given max score
+    scores = list((1 / (distance[keep] + 1)) / scoremax)
+    # A tuple of the compared peaks for each score
+    peaks = [(row_i[i], row_j[j]) for i, j in zip(index_i[keep], index_j[keep])]
     return scores, peaks
 
 
@@ -3,15 +3,23 @@ This module allows for IR spectra to be downloaded from the NIST Chemistry WebBo
 The CAS Registry Number for the compound is used to download the data and then add
 it to a dictionary called shoyu_data_dict
 Functionality also allows for any .jdx file to be added to the shoyu_data_dict
-pickle file.
+pickle file, or to a ShoyuStore, an .hdf5 backed library that reads and adds one
+compound at a time.
 
 Developed by Raman-Noodles team.
 """
 
 import os
 import pickle
-import jcamp
+import re
+import tempfile
+from collections.abc import MutableMapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from urllib.parse import quote, unquote
+import h5py
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy import interpolate
@@ -54,7 +62,113 @@ def download_cas(cas_num):
         print('file already in raman_spectra folder')
 
 
-def add_jdx(filename, label=None):
+class ShoyuStore(MutableMapping):
+    """
+    Dictionary-like library of compound spectra kept in an .hdf5 file, for use in place of
+    the pickled shoyu_data_dict. Every compound is stored in its own group, so a single
+    compound can be read or added without loading or rewriting the rest of the library.
+    Reading a key returns the same compound dictionary that shoyu_data_dict holds, so the
+    values can be passed straight to `combine_spectra`, `spectrafit.compound_report` and
+    `peakidentify.peak_assignment`.
+
+    Args:
+        filename (str): The .hdf5 file that holds the library. It is created if it does
+                        not exist.
+    """
+    def __init__(self, filename):
+        # handling errors in inputs
+        if not isinstance(filename, str):
+            raise TypeError('Passed value of `filename` is not a string! Instead, it is: '
+                            + str(type(filename)))
+        if not filename.split('/')[-1].split('.')[-1] == 'hdf5':
+            raise TypeError('`filename` is not type = .hdf5! Instead, it is: '
+                            + filename.split('/')[-1].split('.')[-1])
+        self.filename = filename
+        # track_order keeps compounds in the order they were added, like a dict
+        with h5py.File(self.filename, 'a', track_order=True):
+            pass
+
+    def __getitem__(self, key):
+        with h5py.File(self.filename, 'r') as store:
+            name = quote(key, safe=' ')
+            if name not in store:
+                raise KeyError(key)
+            group = store[name]
+            compound = {}
+            for field, value in group.attrs.items():
+                compound[field] = value.item() if isinstance(value, np.generic) else value
+            for field in group:
+                compound[unquote(field)] = group[field][()]
+        return compound
+
+    def __setitem__(self, key, compound):
+        if not isinstance(key, str):
+            raise TypeError('Passed value of `key` is not a string! Instead, it is: '
+                            + str(type(key)))
+        if not isinstance(compound, dict):
+            raise TypeError('Passed value of `compound` is not a dictionary! Instead, it is: '
+                            + str(type(compound)))
+        with h5py.File(self.filename, 'a') as store:
+            name = quote(key, safe=' ')
+            if name in store:
+                del store[name]
+            group = store.create_group(name, track_order=True)
+            for field, value in compound.items():
+                # spectra are stored as datasets, header values as attributes
+                if isinstance(value, (np.ndarray, list)):
+                    group[quote(field, safe=' ')] = np.asarray(value)
+                else:
+                    group.attrs[field] = value
+
+    def __delitem__(self, key):
+        with h5py.File(self.filename, 'a') as store:
+            name = quote(key, safe=' ')
+            if name not in store:
+                raise KeyError(key)
+            del store[name]
+
+    def __contains__(self, key):
+        if not isinstance(key, str):
+            return False
+        with h5py.File(self.filename, 'r') as store:
+            return quote(key, safe=' ') in store
+
+    def __iter__(self):
+        with h5py.File(self.filename, 'r') as store:
+            names = list(store.keys())
+        for name in names:
+            yield unquote(name)
+
+    def __len__(self):
+        with h5py.File(self.filename, 'r') as store:
+            return len(store)
+
+    def __repr__(self):
+        return 'ShoyuStore({!r})'.format(self.filename)
+
+
+def library_from_pickle(pickle_filename, hdf5_filename):
+    """
+    Function that copies every compound of a pickled shoyu_data_dict into a `ShoyuStore`.
+
+    Args:
+        pickle_filename (str): The pickle file, usually raman_spectra/shoyu_data_dict.p
+        hdf5_filename (str): The .hdf5 file of the store the compounds are copied into.
+
+    Returns:
+        store (ShoyuStore): The store that now holds the compounds from the pickle file.
+    """
+    # handling errors in inputs
+    if not isinstance(pickle_filename, str):
+        raise TypeError('Passed value of `pickle_filename` is not a string! Instead, it is: '
+                        + str(type(pickle_filename)))
+    shoyu_data_dict = pickle.load(open(pickle_filename, 'rb'))
+    store = ShoyuStore(hdf5_filename)
+    store.update(shoyu_data_dict)
+    return store
+
+
+def add_jdx(filename, label=None, store=None, index=None):
     """
     Function that reads and adds a .jdx file to the raman_data_dict pickle file.
 
@@ -62,31 +176,47 @@ def add_jdx(filename, label=None):
         filename (str): This filename is the exact file name that is affiliated with the
                         .jdx file that has been downloaded that the user wants to add to
                         their pickle file.
+        store (ShoyuStore): (Optional) If passed, the compound is added to this store
+                            instead of the pickle file, without reading or rewriting the
+                            other compounds in the library.
+        index (peakidentify.PeakIndex): (Optional) If passed, the peaks of the compound
+                                        are also added to this index. A
+                                        peakidentify.EmbeddingIndex may be passed instead.
 
     Returns:
         shoyu_data_dict (dict): This is the dictionary that contains the data loaded from
                                 the pickle file and is the common way in which the user
-                                interacts with data in this software.
+                                interacts with data in this software. If `store` was
+                                passed, the store is returned instead.
     """
     if not isinstance(filename, str):
         raise TypeError("Passed value of `filename` is not a string! Instead, it is: "
                         + str(type(filename)))
-    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
-    data = jcamp.JCAMP_reader(filename)
-    y_abs = 1 - data['y']
-    data['yunits'] = 'ABSORBANCE'
-    data['y'] = y_abs
+    if store is not None and not isinstance(store, ShoyuStore):
+        raise TypeError("Passed value of `store` is not a ShoyuStore! Instead, it is: "
+                        + str(type(store)))
+    # any index with the add and update methods of peakidentify.PeakIndex is accepted
+    if index is not None and not (callable(getattr(index, 'add', None))
+                                  and callable(getattr(index, 'update', None))):
+        raise TypeError("Passed value of `index` is not a PeakIndex or EmbeddingIndex! "
+                        "Instead, it is: " + str(type(index)))
+    data = _load_jdx(read_jdx(filename))
     if label is None:
-        shoyu_data_dict.update({data['title'].upper(): data})
-        print('{} loaded into the dictionary - shoyu_data_dict.p'.format(data['title']))
-    else:
-        shoyu_data_dict.update({label: data})
-        print('{} loaded into the dictionary - shoyu_data_dict.p'.format(label))
+        label = data['title'].upper()
+    if index is not None:
+        index.add(label, data)
+    if store is not None:
+        store[label] = data
+        print('{} loaded into the library - {}'.format(label, store.filename))
+        return store
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    shoyu_data_dict.update({label: data})
+    print('{} loaded into the dictionary - shoyu_data_dict.p'.format(label))
     pickle.dump(shoyu_data_dict, open('../raman_spectra/shoyu_data_dict.p', 'wb'))
     return shoyu_data_dict
 
 
-def initialize_standard_library():
+def initialize_standard_library(store=None, mirror=None, workers=8):
     """
     Function that downloads a standard library of raman spectra from the NIST Chemistry
     WebBook. It generates a folder and a pickle file for storing data for future use.
@@ -94,7 +224,11 @@ def initialize_standard_library():
     shoyu_data_dict.p file
 
     Args:
-        This function does not take input parameters
+        store (ShoyuStore): (Optional) If passed, the store is emptied and the standard
+                            library is written to it instead of to the pickle file.
+        mirror (str): (Optional) A directory or http(s) URL holding the .jdx files, to use
+                      in place of the NIST WebBook. See `fetch_jdx`.
+        workers (int): (Optional) The number of files downloaded at the same time.
 
     Returns:
         This function has no returns.
@@ -108,21 +242,22 @@ def initialize_standard_library():
                'ethanol':'64-17-5',
                'acetone':'67-64-1',
                'pentane':'109-66-0'}
-    # initialize empty shoyu_data_dict
-    shoyu_data_dict = {}
     os.makedirs('../raman_spectra', exist_ok=True)
-    pickle.dump(shoyu_data_dict, open('../raman_spectra/shoyu_data_dict.p', 'wb'))
-    for item in cas_lib:
-        cas_num = ''.join(cas_lib[item].split('-'))
-        download_cas(cas_num)
-        add_jdx('../raman_spectra/'+cas_num+'_NIST_IR.jdx', label=None)
+    if store is not None:
+        store.clear()
+    else:
+        # initialize empty shoyu_data_dict
+        shoyu_data_dict = {}
+        pickle.dump(shoyu_data_dict, open('../raman_spectra/shoyu_data_dict.p', 'wb'))
+    download_library(list(cas_lib.values()), store=store, mirror=mirror, workers=workers)
 
 
-def more_please(cas_num, label=None):
+def more_please(cas_num, label=None, store=None, index=None, mirror=None):
     """
     Function that downloads a spectra from the NIST
     database, adds it to shoyu_data_dict, pickles shoyu_data_dict
-    and returns the updated shoyu_data_dict.
+    and returns the updated shoyu_data_dict. An OSError giving the reason is raised
+    when the .jdx file cannot be fetched.
 
     Args:
         cas_num (str): The CAS number that is associated with the compound intended
@@ -132,11 +267,19 @@ def more_please(cas_num, label=None):
                      on the NIST webbook, when the compound spectral data is added to the
                      shoyu_data_dict it will use the text of `label` as the dictionary
                      key for this spectral data.
+        store (ShoyuStore): (Optional) If passed, the spectra is added to this store
+                            instead of the pickle file.
+        index (peakidentify.PeakIndex): (Optional) If passed, the peaks of the spectra
+                                        are also added to this index. A
+                                        peakidentify.EmbeddingIndex may be passed instead.
+        mirror (str): (Optional) A directory or http(s) URL holding the .jdx file, to use
+                      in place of the NIST WebBook. See `fetch_jdx`.
 
     Returns:
         shoyu_data_dict (dict): This is the dictionary that contains the data loaded from
                                 the pickle file, and is the common way in which the user
-                                interacts with data in this software.
+                                interacts with data in this software. If `store` was
+                                passed, the store is returned instead.
     """
     # handling errors in inputs
     if not isinstance(cas_num, str):
@@ -144,8 +287,358 @@ def more_please(cas_num, label=None):
                         + str(type(cas_num)))
     # Drop any '-' from cas_num
     cas_num = ''.join(cas_num.split('-'))
-    download_cas(cas_num)
-    shoyu_data_dict = add_jdx('../raman_spectra/'+cas_num+'_NIST_IR.jdx', label)
+    _, filename, error = fetch_jdx([cas_num], mirror=mirror)[0]
+    if filename is None:
+        raise OSError('The .jdx file of CAS # {} could not be fetched: {}'.format(cas_num,
+                                                                                   error))
+    shoyu_data_dict = add_jdx(filename, label, store, index)
+    return shoyu_data_dict
+
+
+# NIST Chemistry WebBook address of the IR spectrum of a CAS registry number
+NIST_URL = 'https://webbook.nist.gov/cgi/cbook.cgi?JCAMP=C{}&Index=1&Type=IR'
+
+
+_JDX_INT = re.compile(r'[+-]?\d+')
+_JDX_FLOAT = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+
+
+def _jdx_pseudo_digits():
+    """Returns lookup tables, indexed by byte, of the kind (0 SQZ, 1 DIF, 2 DUP, -1 for
+    other bytes), digit and sign of the JCAMP-DX ASCII pseudo-digits."""
+    kinds = np.full(256, -1)
+    digits = np.arange(256, dtype=np.uint8)
+    signs = np.ones(256)
+    forms = (('@ABCDEFGHI', 0, 1), ('abcdefghi', 0, -1), ('%JKLMNOPQR', 1, 1),
+             ('jklmnopqr', 1, -1), ('STUVWXYZs', 2, 1))
+    for characters, kind, sign in forms:
+        # the negative forms and DUP start from 1, the others from 0
+        start = 0 if characters[0] in '@%' else 1
+        for digit, character in enumerate(characters, start):
+            kinds[ord(character)] = kind
+            digits[ord(character)] = ord(str(digit))
+            signs[ord(character)] = sign
+    return kinds, digits, signs
+
+
+_JDX_KINDS, _JDX_DIGITS, _JDX_SIGNS = _jdx_pseudo_digits()
+
+
+def _jdx_value(text):
+    """Returns a header value of a .jdx file as an int or float where it is a number."""
+    text = text.strip()
+    if _JDX_INT.fullmatch(text):
+        return int(text)
+    if _JDX_FLOAT.fullmatch(text):
+        return float(text)
+    return text
+
+
+def _jdx_tokens(table):
+    """Decodes the data table of a .jdx file in bulk, returning the values and, for each value,
+    whether it is a DIF value and the number of the line it is on. Values are plain (AFFN)
+    numbers, or start with a pseudo-digit that stands for a signed digit in the squeezed
+    (SQZ) and difference (DIF) forms, or for a count of repeats in the duplicate (DUP) form."""
+    codes = np.frombuffer(table.encode('ascii', 'replace'), dtype=np.uint8)
+    pseudo = _JDX_KINDS[codes] >= 0
+    sign = (codes == ord('+')) | (codes == ord('-'))
+    number = ((codes >= ord('0')) & (codes <= ord('9'))) | (codes == ord('.'))
+    # the 'E' of an exponent, as in 1.5E+03, is not a pseudo-digit
+    exponent = (((codes == ord('E')) | (codes == ord('e'))) & np.r_[sign[1:], False]
+                & np.r_[False, number[:-1]])
+    pseudo &= ~exponent
+    part = number | pseudo | sign | exponent
+    starts = pseudo | (sign & ~np.r_[False, exponent[:-1]]) | (number & ~np.r_[False, part[:-1]])
+    # each value is written out with its pseudo-digit as a digit, after a space
+    text = np.where(pseudo, _JDX_DIGITS[codes], np.where(part, codes, ord(' ')))
+    text = np.insert(text.astype(np.uint8), np.flatnonzero(starts), ord(' '))
+    values = np.array(text.tobytes().split(), dtype=float)*_JDX_SIGNS[codes[starts]]
+    kinds = _JDX_KINDS[codes[starts]]
+    lines = np.cumsum(codes == ord('\n'))[starts]
+    # DUP repeats the value before it, counting that value
+    dup = np.flatnonzero(kinds == 2)
+    repeats = np.ones(len(values), dtype=int)
+    repeats[dup - 1] += values[dup].astype(int) - 1
+    repeats[dup] = 0
+    return (np.repeat(values, repeats), np.repeat(kinds == 1, repeats),
+            np.repeat(lines, repeats))
+
+
+def _jdx_xydata(table, lastx):
+    """Returns the x and y data of a (X++(Y..Y)) table. The x values of each line are spread
+    evenly from its first x value to the first x value of the next line, as np.linspace does,
+    ending at `lastx`."""
+    values, dif, lines = _jdx_tokens(table)
+    # the first value of each line is its x value
+    first = np.r_[True, lines[1:] != lines[:-1]]
+    x_starts = values[first]
+    y_values, y_dif, y_lines = values[~first], dif[~first], lines[~first]
+    check = np.zeros(len(y_values), dtype=bool)
+    if y_dif.any():
+        # a DIF value adds to the value before it. The values of the compressed forms are
+        # integers, so the cumulative sums are exact.
+        total = np.cumsum(y_values)
+        starts = np.flatnonzero(~y_dif)
+        y_values = total - (total[starts] - y_values[starts])[np.cumsum(~y_dif) - 1]
+        # a line after one ending in a DIF value starts with that value again, as a check
+        line_starts = np.flatnonzero(np.r_[True, y_lines[1:] != y_lines[:-1]])
+        line_ends = np.r_[line_starts[1:], len(y_lines)] - 1
+        check[line_starts[1:]] = y_dif[line_ends[:-1]]
+    counts = np.bincount(y_lines, minlength=lines.max() + 1)[lines[first]]
+    x_stops = np.r_[x_starts[1:], lastx]
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    steps = (x_stops - x_starts)/np.maximum(counts - 1, 1)
+    x_data = (np.arange(counts.sum()) - offsets)*np.repeat(steps, counts) \
+        + np.repeat(x_starts, counts)
+    ends = np.cumsum(counts)[counts > 1] - 1
+    x_data[ends] = x_stops[counts > 1]
+    return x_data[~check], y_values[~check]
+
+
+def read_jdx(filename):
+    """
+    Function that reads a JCAMP-DX (.jdx) file. The data table is tokenized in bulk, in
+    any of the plain (AFFN) or compressed (SQZ, DIF, DUP) forms, and its x and y arrays are
+    built with numpy, so large libraries are read quickly.
+
+    Args:
+        filename (str): The path of the .jdx file.
+
+    Returns:
+        data (dict): The labeled data records of the file, keyed by their lowercase label,
+                     with numbers read as int or float. The x and y data are in 'x' and 'y',
+                     multiplied by XFACTOR and YFACTOR, and the path is in 'filename'.
+                     Tables in the (X++(Y..Y)) and (XY..XY) forms are read.
+    """
+    # handling errors in inputs
+    if not isinstance(filename, str):
+        raise TypeError('Passed value of `filename` is not a string! Instead, it is: '
+                        + str(type(filename)))
+    with open(filename, 'r') as jdx_file:
+        text = jdx_file.read()
+    data = {}
+    table = None
+    # each labeled data record starts a line with '##'. Text after the first line of a
+    # record is only kept for the data table.
+    for record in re.split(r'^##', text, flags=re.M)[1:]:
+        label, _, value = record.partition('=')
+        value, _, rest = value.partition('\n')
+        label = label.strip().lower()
+        data[label] = _jdx_value(value)
+        if label in ('xydata', 'xypoints', 'peak table') and table is None:
+            table = (data[label], re.sub(r'\$\$.*', '', rest))
+    if table is None:
+        raise ValueError('No data table found in ' + filename)
+    form, table = table
+    if form == '(X++(Y..Y))':
+        x_data, y_data = _jdx_xydata(table, data['lastx'])
+    elif str(form).startswith('(XY'):
+        values = _jdx_tokens(table)[0]
+        x_data, y_data = values[0::2], values[1::2]
+    else:
+        raise ValueError('Data table form {} of {} is not supported'.format(form, filename))
+    data['x'] = x_data*data.get('xfactor', 1)
+    data['y'] = y_data*data.get('yfactor', 1)
+    data['filename'] = filename
+    return data
+
+
+def read_jdx_dir(directory, workers=None):
+    """
+    Function that reads every .jdx file in a directory with `read_jdx`, in parallel over a
+    pool of processes.
+
+    Args:
+        directory (str): The directory holding the .jdx files.
+        workers (int): (Optional) The number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        library (dict): The data of each file, as returned by `read_jdx`, keyed by its path.
+    """
+    # handling errors in inputs
+    if not isinstance(directory, str):
+        raise TypeError('Passed value of `directory` is not a string! Instead, it is: '
+                        + str(type(directory)))
+    if workers is not None and not isinstance(workers, int):
+        raise TypeError('Passed value of `workers` is not an int! Instead, it is: '
+                        + str(type(workers)))
+    filenames = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                       if name.lower().endswith('.jdx'))
+    return dict(zip(filenames, _read_all(filenames, workers)))
+
+
+def _read_all(filenames, workers=None):
+    """Reads .jdx files with `read_jdx`, in a pool of processes when there are several."""
+    if len(filenames) < 2 or workers == 1:
+        return [read_jdx(filename) for filename in filenames]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        chunksize = max(1, len(filenames) // (4*(workers or os.cpu_count() or 1)))
+        return list(executor.map(read_jdx, filenames, chunksize=chunksize))
+
+
+def _load_jdx(data):
+    """Converts the y data of a NIST .jdx file from transmittance to absorbance."""
+    y_abs = 1 - data['y']
+    data['yunits'] = 'ABSORBANCE'
+    data['y'] = y_abs
+    return data
+
+
+def _session(workers, retries):
+    """Returns a requests session whose connection pool fits `workers` threads and which
+    retries failed connections and 429 or 5xx responses with exponential backoff."""
+    retry = Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(429, 500, 502, 503, 504), allowed_methods=('GET',))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def _fetch_one(session, cas_num, directory, mirror, timeout):
+    """Fetches the .jdx file of one CAS number into `directory`, returning a (cas_num, path,
+    error) tuple whose path is None, and error the reason, when it could not be fetched."""
+    name = cas_num+'_NIST_IR.jdx'
+    filename = os.path.join(directory, name)
+    if os.path.exists(filename):
+        return cas_num, filename, None
+    if mirror is not None and not mirror.startswith(('http://', 'https://')):
+        source = os.path.join(mirror, name)
+        if not os.path.isfile(source):
+            return cas_num, None, 'not in mirror {}'.format(mirror)
+        with open(source, 'rb') as source_file:
+            content = source_file.read()
+    else:
+        url = NIST_URL.format(cas_num) if mirror is None else mirror.rstrip('/')+'/'+name
+        try:
+            data = session.get(url, allow_redirects=True, timeout=timeout)
+        except requests.exceptions.RequestException as error:
+            return cas_num, None, 'request failed: {}'.format(error)
+        if data.status_code != 200:
+            return cas_num, None, 'request status: {}'.format(data.status_code)
+        if data.text.startswith('##TITLE=Spectrum not found.'):
+            return (cas_num, None,
+                    'CAS # not found, please verify with NIST Chemistry WebBook')
+        content = data.content
+    # write to a temporary file first, so a partial download is never left behind
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as jdx_file:
+        jdx_file.write(content)
+    os.replace(temporary, filename)
+    return cas_num, filename, None
+
+
+def fetch_jdx(cas_nums, directory='../raman_spectra', mirror=None, workers=8, retries=3,
+              timeout=30):
+    """
+    Function that downloads the .jdx files of many CAS registry numbers at the same time,
+    the bulk form of `download_cas`. Up to `workers` files are fetched concurrently over one
+    pooled session, and failed connections and 429 or 5xx responses are retried with
+    exponential backoff. Files already in `directory` are not downloaded again.
+
+    Args:
+        cas_nums (list): The CAS numbers of the compounds. They are insensitive to hyphens.
+        directory (str): (Optional) The directory the files are saved in.
+        mirror (str): (Optional) Where to fetch the files from instead of the NIST WebBook:
+                      a local directory, or an http(s) URL, holding files named like the
+                      downloads, e.g. 7732185_NIST_IR.jdx. This allows offline use.
+        workers (int): (Optional) The number of files fetched at the same time.
+        retries (int): (Optional) The number of retries of each request.
+        timeout (float): (Optional) The timeout of each request, in seconds.
+
+    Returns:
+        results (list): A (cas_num, path, error) tuple for every CAS number, without
+                        hyphens, in the order given. The path is that of the .jdx file when
+                        it was fetched, or was already in `directory`, and error is None.
+                        Otherwise the path is None and error is the reason, which is also
+                        printed.
+    """
+    # handling errors in inputs
+    if not isinstance(cas_nums, list):
+        raise TypeError('Passed value of `cas_nums` is not a list! Instead, it is: '
+                        + str(type(cas_nums)))
+    for cas_num in cas_nums:
+        if not isinstance(cas_num, str):
+            raise TypeError('Passed value in `cas_nums` is not a string! Instead, it is: '
+                            + str(type(cas_num)))
+    if mirror is not None and not isinstance(mirror, str):
+        raise TypeError('Passed value of `mirror` is not a string! Instead, it is: '
+                        + str(type(mirror)))
+    if not isinstance(workers, int):
+        raise TypeError('Passed value of `workers` is not an int! Instead, it is: '
+                        + str(type(workers)))
+    # drop any '-' and repeated numbers, keeping the order
+    cas_nums = list(dict.fromkeys(''.join(cas_num.split('-')) for cas_num in cas_nums))
+    os.makedirs(directory, exist_ok=True)
+    with _session(max(workers, 1), retries) as session:
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            results = list(executor.map(lambda cas_num: _fetch_one(
+                session, cas_num, directory, mirror, timeout), cas_nums))
+    for cas_num, filename, error in results:
+        if filename is None:
+            print('{} not downloaded, {}'.format(cas_num, error))
+    return results
+
+
+def download_library(cas_nums, store=None, index=None, directory='../raman_spectra',
+                     mirror=None, workers=8, retries=3):
+    """
+    Function that downloads many compounds with `fetch_jdx` and adds them all to the library
+    at once, so shoyu_data_dict.p is read and pickled a single time however many compounds
+    are added. Compounds are labeled with the title of their .jdx file, as `add_jdx` does.
+
+    Args:
+        cas_nums (list): The CAS numbers of the compounds. They are insensitive to hyphens.
+        store (ShoyuStore): (Optional) If passed, the compounds are added to this store
+                            instead of the pickle file.
+        index (peakidentify.PeakIndex): (Optional) If passed, the peaks of the compounds
+                                        are also added to this index. A
+                                        peakidentify.EmbeddingIndex may be passed instead.
+        directory (str): (Optional) The directory of the .jdx files and of the pickle file.
+        mirror (str): (Optional) A directory or http(s) URL to fetch the files from instead
+                      of the NIST WebBook, see `fetch_jdx`.
+        workers (int): (Optional) The number of files fetched at the same time.
+        retries (int): (Optional) The number of retries of each request.
+
+    Returns:
+        shoyu_data_dict (dict): The updated library from the pickle file. If `store` was
+                                passed, the store is returned instead.
+    """
+    # handling errors in inputs
+    if store is not None and not isinstance(store, ShoyuStore):
+        raise TypeError("Passed value of `store` is not a ShoyuStore! Instead, it is: "
+                        + str(type(store)))
+    # any index with the add and update methods of peakidentify.PeakIndex is accepted
+    if index is not None and not (callable(getattr(index, 'add', None))
+                                  and callable(getattr(index, 'update', None))):
+        raise TypeError("Passed value of `index` is not a PeakIndex or EmbeddingIndex! "
+                        "Instead, it is: " + str(type(index)))
+    filenames = [filename for _, filename, _ in fetch_jdx(cas_nums, directory, mirror,
+                                                          workers, retries)
+                 if filename is not None]
+    compounds = {}
+    for data in _read_all(filenames):
+        data = _load_jdx(data)
+        compounds[data['title'].upper()] = data
+    if index is not None:
+        index.update(compounds)
+    if store is not None:
+        store.update(compounds)
+        print('{} compounds loaded into the library - {}'.format(len(compounds),
+                                                                  store.filename))
+        return store
+    pickle_filename = os.path.join(directory, 'shoyu_data_dict.p')
+    shoyu_data_dict = {}
+    if os.path.isfile(pickle_filename):
+        shoyu_data_dict = pickle.load(open(pickle_filename, 'rb'))
+    shoyu_data_dict.update(compounds)
+    # one write of the whole library, replaced atomically
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as pickle_file:
+        pickle.dump(shoyu_data_dict, pickle_file)
+    os.replace(temporary, pickle_filename)
+    print('{} compounds loaded into the dictionary - shoyu_data_dict.p'.format(len(compounds)))
     return shoyu_data_dict
 
 
@@ -169,15 +662,10 @@ def clean_spectra(compound):
     x_comp = compound['x']
     y_comp = compound['y']
     y_comp = spectrafit.subtract_baseline(y_comp)
-    # zip x and y values
-    comp_data = list(zip(x_comp, y_comp))
-    #clean comp1
-    comp_data_clean = []
-    for i in range(1, len(comp_data)-1):
-        if comp_data[i][0] == comp_data[i-1][0]:
-            pass
-        else:
-            comp_data_clean.append(comp_data[i])
+    x_comp = np.asarray(x_comp)
+    # keep the inner points whose x-value differs from the point before
+    keep = np.flatnonzero(x_comp[1:-1] != x_comp[:-2]) + 1
+    comp_data_clean = list(zip(x_comp[keep], np.asarray(y_comp)[keep]))
     return comp_data_clean
 
 
@@ -236,17 +724,10 @@ def sum_spectra(comp1_data_int, comp2_data_int):
         raise TypeError('Passed value of `comp1_data_int` is not a list! Instead, it is: '
                         + str(type(comp1_data_int)))
     # add the two spectra
-    combined = sorted(comp1_data_int + comp2_data_int)
+    x_comp, y_comp = np.asarray(comp1_data_int + comp2_data_int).T
     # add by like
-    same_x = {x:0 for x, _ in combined}
-    for name, num in combined:
-        same_x[name] += num
-    sum_combined = list(map(tuple, same_x.items()))
-    # unzip
-    x_combined, y_combined = zip(*sum_combined)
-    # set as arrays
-    x_combined = np.asarray(x_combined)
-    y_combined = np.asarray(y_combined)
+    x_combined, same_x = np.unique(x_comp, return_inverse=True)
+    y_combined = np.bincount(same_x, weights=y_comp)
     return x_combined, y_combined
 
 
@@ -276,18 +757,245 @@ def combine_spectra(compound_1, compound_2, plot=False):
     if not isinstance(compound_2, dict):
         raise TypeError("Passed value of `compound_2` is not a dictionary! Instead, it is: "
                         + str(type(compound_1)))
-    data1 = clean_spectra(compound_1)
-    data2 = clean_spectra(compound_2)
-    comp1_data_int = interpolate_spectra(data1)
-    comp2_data_int = interpolate_spectra(data2)
-    x_combined, y_combined = sum_spectra(comp1_data_int, comp2_data_int)
+    x_combined, y_combined = mix_spectra([compound_1, compound_2])
     if plot:
+        data1 = _clean_arrays(compound_1)
+        data2 = _clean_arrays(compound_2)
         # plot original data and combined plot
         plt.figure(figsize=(15, 5))
-        plt.plot([i[0] for i in data1], [i[1] for i in data1], 'b--', label=compound_1['title'])
-        plt.plot([i[0] for i in data2], [i[1] for i in data2], 'g--', label=compound_2['title'])
+        plt.plot(data1[0], data1[1], 'b--', label=compound_1['title'])
+        plt.plot(data2[0], data2[1], 'g--', label=compound_2['title'])
         plt.plot(x_combined, y_combined, 'r', label='Combination', linewidth=2, alpha=0.7)
         plt.legend()
         plt.xlabel('cm$^{-1}$', fontsize=14)
         plt.ylabel('Absoprtion', fontsize=14)
     return x_combined, y_combined
+
+
+def _clean_arrays(compound):
+    """Returns the baselined data of a compound as arrays, sorted by unique x-value."""
+    x_comp = np.asarray(compound['x'], dtype=float)
+    y_comp = spectrafit.subtract_baseline(np.asarray(compound['y'], dtype=float))
+    # the first point of every repeated x-value is kept
+    x_comp, first = np.unique(x_comp, return_index=True)
+    return x_comp, y_comp[first]
+
+
+def resample_spectra(compounds, grid=None):
+    """
+    Function that cleans the data of several compounds and resamples them onto one shared
+    grid, the array form of `clean_spectra` followed by `interpolate_spectra`. Repeated
+    x-values are removed with np.unique and every compound is interpolated with the same
+    cubic spline as `interpolate_spectra`. Grid points outside the integer range that
+    `interpolate_spectra` covers for a compound are zero.
+
+    Args:
+        compounds (list): list of compound dictionaries from shoyu_data_dict.p
+                          or a ShoyuStore
+        grid (list like): (Optional) The x-values to resample onto. Defaults to the
+                          integer wavenumbers across the range of all the compounds.
+
+    Returns:
+        grid (numpy array): The x-values shared by all the resampled spectra.
+        spectra (numpy array): 2-D array with the resampled y-values of one compound
+                               per row.
+    """
+    # handling errors in inputs
+    if not isinstance(compounds, list):
+        raise TypeError('Passed value of `compounds` is not a list! Instead, it is: '
+                        + str(type(compounds)))
+    for compound in compounds:
+        if not isinstance(compound, dict):
+            raise TypeError('Component of the passed value is not a dictionary! Instead, it is: '
+                            + str(type(compound)))
+    if grid is not None and not isinstance(grid, (list, np.ndarray)):
+        raise TypeError('Passed value of `grid` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(grid)))
+    data = [_clean_arrays(compound) for compound in compounds]
+    if grid is None:
+        # the same integer range as interpolate_spectra, across all compounds
+        grid = np.arange(min(int(x_comp[0]) for x_comp, _ in data)+1,
+                         max(int(x_comp[-1]) for x_comp, _ in data), 1)
+    grid = np.asarray(grid)
+    spectra = np.zeros((len(data), len(grid)))
+    for i, (x_comp, y_comp) in enumerate(data):
+        # the integer range that interpolate_spectra covers for this compound
+        inside = (grid >= int(x_comp[0])+1) & (grid < int(x_comp[-1]))
+        spectra[i, inside] = interpolate.make_interp_spline(x_comp, y_comp, k=3)(grid[inside])
+    return grid, spectra
+
+
+def mix_spectra(compounds, weights=None, grid=None):
+    """
+    Function that sums any number of compounds from shoyu_data_dict.p, each scaled by a
+    weight. The compounds are resampled once with `resample_spectra`, and the mixtures
+    are a single matrix product, so a 2-D array of weights makes many training mixtures
+    at the cost of one.
+
+    Args:
+        compounds (list): list of compound dictionaries from shoyu_data_dict.p
+                          or a ShoyuStore
+        weights (list like): (Optional) The weight of each compound, or a 2-D array with
+                             the weights of one mixture per row. Defaults to a weight of 1
+                             for every compound, which is the plain sum.
+        grid (list like): (Optional) The x-values to resample onto. Defaults to the
+                          integer wavenumbers across the range of all the compounds.
+
+    Returns:
+        x_combined (numpy array): The x-values shared by the mixtures.
+        y_combined (numpy array): The y-values of the mixture, or a 2-D array with one
+                                  mixture per row of `weights`.
+    """
+    grid, spectra = resample_spectra(compounds, grid)
+    if weights is None:
+        weights = np.ones(len(compounds))
+    if not isinstance(weights, (list, np.ndarray)):
+        raise TypeError('Passed value of `weights` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(weights)))
+    weights = np.asarray(weights, dtype=float)
+    if weights.ndim not in (1, 2) or weights.shape[-1] != len(compounds):
+        raise ValueError('`weights` must hold one value per compound, {} compounds were '
+                         'passed'.format(len(compounds)))
+    y_combined = weights @ spectra
+    return grid, y_combined
+
+
+def generate_mixtures(library, hdf5_filename, n_spectra, batch_size=1000, max_compounds=3,
+                      concentration=(0.1, 1.0), shift=2.0, drift=0.05, noise=0.01, seed=None):
+    """
+    Function that writes a labeled corpus of synthetic mixture spectra to an .hdf5 file,
+    for benchmarking `peakidentify` and `spectrafit` or for training models. Every mixture
+    holds a random subset of 1 to `max_compounds` compounds of the library at random
+    concentrations. Each spectrum is then shifted along the wavenumber axis, as from a
+    calibration offset, and a random quadratic baseline drift and gaussian noise are added.
+    The spectra are made one batch at a time with array math on top of `resample_spectra`
+    and appended to the file, so the corpus can be much larger than memory.
+
+    The file holds `x` (the shared wavenumbers), `counts` (one spectrum per row),
+    `weights` (the concentration of every compound in each spectrum, zero when absent),
+    `shift` (the shift of each spectrum), `compounds` (the labels of the weight columns)
+    and `peaks` (the peak centers that `spectrafit.peak_detect` finds in each resampled
+    compound, padded with NaN). `mixture_labels` reads the ground
+    truth of a single spectrum.
+
+    Args:
+        library (dict): shoyu_data_dict or a ShoyuStore with the compounds to mix.
+        hdf5_filename (str): The .hdf5 file to create.
+        n_spectra (int): The number of spectra to write.
+        batch_size (int): (Optional) The number of spectra made and written at a time.
+        max_compounds (int): (Optional) The largest number of compounds in a mixture.
+        concentration (tuple): (Optional) The range of the compound concentrations.
+        shift (float): (Optional) The standard deviation of the shift, in wavenumbers.
+        drift (float): (Optional) The standard deviation of the baseline coefficients,
+                       relative to the highest point of the spectrum.
+        noise (float): (Optional) The standard deviation of the noise, relative to the
+                       highest point of the spectrum.
+        seed (int): (Optional) Seed of the random number generator, for repeatable corpora.
+
+    Returns:
+        n_spectra (int): The number of spectra written.
+    """
+    # handling errors in inputs
+    if not isinstance(library, (dict, ShoyuStore)):
+        raise TypeError('Passed value of `library` is not a dictionary or ShoyuStore! '
+                        'Instead, it is: ' + str(type(library)))
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not hdf5_filename.split('/')[-1].split('.')[-1] == 'hdf5':
+        raise TypeError('`hdf5_filename` is not type = .hdf5! Instead, it is: '
+                        + hdf5_filename.split('/')[-1].split('.')[-1])
+    for name, value in (('n_spectra', n_spectra), ('batch_size', batch_size),
+                        ('max_compounds', max_compounds)):
+        if not isinstance(value, int):
+            raise TypeError('Passed value of `{}` is not an integer! Instead, it is: '.format(name)
+                            + str(type(value)))
+        if value < 1:
+            raise ValueError('`{}` must be at least 1'.format(name))
+    labels = list(library)
+    compounds = [library[label] for label in labels]
+    grid, spectra = resample_spectra(compounds)
+    max_compounds = min(max_compounds, len(compounds))
+    # peaks of every compound before mixing, as a NaN padded table
+    reference = [[center for center, _ in spectrafit.peak_detect(grid, y_comp)[0]]
+                 for y_comp in spectra]
+    peaks = np.full((len(compounds), max(1, *(len(centers) for centers in reference))), np.nan)
+    for i, centers in enumerate(reference):
+        peaks[i, :len(centers)] = centers
+    # quadratic baselines over the wavenumber range
+    vander = np.vander(np.linspace(-1, 1, len(grid)), 3, increasing=True).T
+    rng = np.random.default_rng(seed)
+    hdf5 = h5py.File(hdf5_filename, 'w')
+    try:
+        hdf5['x'] = grid
+        hdf5['compounds'] = labels
+        hdf5['peaks'] = peaks
+        chunk = min(batch_size, 64)
+        counts = hdf5.create_dataset('counts', (0, len(grid)), maxshape=(None, len(grid)),
+                                     dtype=np.float32, chunks=(chunk, len(grid)))
+        weights = hdf5.create_dataset('weights', (0, len(labels)), maxshape=(None, len(labels)),
+                                      dtype=np.float32, chunks=(chunk, len(labels)))
+        shifts = hdf5.create_dataset('shift', (0,), maxshape=(None,), dtype=np.float64,
+                                     chunks=(chunk,))
+        for key, value in (('max_compounds', max_compounds), ('concentration', concentration),
+                           ('shift', shift), ('drift', drift), ('noise', noise)):
+            hdf5.attrs[key] = value
+        for start in range(0, n_spectra, batch_size):
+            size = min(batch_size, n_spectra - start)
+            # random subsets: the compounds ranked below the drawn number of compounds
+            ranks = rng.random((size, len(labels))).argsort(axis=1).argsort(axis=1)
+            present = ranks < rng.integers(1, max_compounds+1, size)[:, np.newaxis]
+            batch_weights = present * rng.uniform(*concentration, (size, len(labels)))
+            batch_shift = rng.normal(0, shift, size)
+            y_data = _shift_rows(batch_weights @ spectra, batch_shift / (grid[1] - grid[0]))
+            scale = np.abs(y_data).max(axis=1, keepdims=True)
+            y_data += scale * (rng.normal(0, drift, (size, 3)) @ vander)
+            y_data += scale * rng.normal(0, noise, y_data.shape)
+            for dataset in (counts, weights, shifts):
+                dataset.resize(start + size, axis=0)
+            counts[start:] = y_data
+            weights[start:] = batch_weights
+            shifts[start:] = batch_shift
+    finally:
+        hdf5.close()
+    return n_spectra
+
+
+def _shift_rows(y_data, steps):
+    """Shifts every row of `y_data` to the right by its number of grid `steps`, interpolating
+    linearly between grid points and padding the ends with the edge values."""
+    position = np.arange(y_data.shape[1]) - steps[:, np.newaxis]
+    position = np.clip(position, 0, y_data.shape[1] - 1)
+    lower = np.minimum(position.astype(int), y_data.shape[1] - 2)
+    fraction = position - lower
+    rows = np.arange(len(y_data))[:, np.newaxis]
+    return (1 - fraction)*y_data[rows, lower] + fraction*y_data[rows, lower + 1]
+
+
+def mixture_labels(hdf5_filename, index):
+    """
+    Function that reads the ground truth of one spectrum written by `generate_mixtures`.
+
+    Args:
+        hdf5_filename (str): The .hdf5 file written by `generate_mixtures`.
+        index (int): The row of the spectrum in `counts`.
+
+    Returns:
+        labels (dict): The concentration of every compound in the spectrum.
+        peak_centers (numpy array): The sorted peak centers of those compounds, shifted
+                                    like the spectrum.
+    """
+    # handling errors in inputs
+    if not isinstance(hdf5_filename, str):
+        raise TypeError('Passed value of `hdf5_filename` is not a string! Instead, it is: '
+                        + str(type(hdf5_filename)))
+    if not isinstance(index, (int, np.integer)):
+        raise TypeError('Passed value of `index` is not an integer! Instead, it is: '
+                        + str(type(index)))
+    with h5py.File(hdf5_filename, 'r') as hdf5:
+        weights = hdf5['weights'][index]
+        present = np.flatnonzero(weights)
+        labels = {hdf5['compounds'][i].decode(): float(weights[i]) for i in present}
+        peak_centers = hdf5['peaks'][()][present]
+        peak_centers = np.sort(peak_centers[~np.isnan(peak_centers)]) + hdf5['shift'][index]
+    return labels, peak_centers
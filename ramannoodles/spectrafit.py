@@ -9,12 +9,32 @@ Developed by the Raman-Noodles team.
 """
 
 
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import matplotlib.pyplot as plt
 import numpy as np
+import pandas as pd
 import lmfit
 from lmfit.models import PseudoVoigtModel
 from peakutils.baseline import baseline
-from scipy.signal import find_peaks
+from scipy import sparse
+from scipy.optimize import least_squares
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+
+
+# columns of the structured array returned by `fit_batch`, matching the order of the
+# per-peak rows produced by `export_fit_data`
+FIT_DTYPE = np.dtype([('spectrum', np.int64), ('peak', np.int64), ('fraction', np.float64),
+                      ('sigma', np.float64), ('center', np.float64),
+                      ('amplitude', np.float64), ('fwhm', np.float64),
+                      ('height', np.float64)])
 
 
 def subtract_baseline(y_data, deg=3, plot=False, x_data=None):
@@ -45,7 +65,7 @@ def subtract_baseline(y_data, deg=3, plot=False, x_data=None):
     y_base = baseline(y_data, deg=deg, max_it=200)
     # to avoid strange results,
     # change all negative values to zero
-    yb_plus = [0 if i < 0 else i for i in y_base]
+    yb_plus = np.maximum(y_base, 0)
     y_out = y_data - yb_plus
     # plot that lets you see the baseline fitting
     if plot and x_data is None:
@@ -63,6 +83,97 @@ def subtract_baseline(y_data, deg=3, plot=False, x_data=None):
     return y_out
 
 
+def baseline_batch(y_data, deg=3, max_it=200, tol=1e-3):
+    """
+    Function that computes the iterative polynomial baseline of `peakutils.baseline` for
+    every row of a 2-D array of spectra at once. Each spectrum in peakutils is fit on its own
+    rescaled x-axis, but rescaling does not change the polynomial fit, so a single QR
+    factorization of the Vandermonde matrix is shared by all spectra. The coefficients are
+    rescaled per spectrum so that each one stops iterating exactly where peakutils would.
+
+    Args:
+        y_data (numpy array): A 2-D array with one spectrum per row, sampled on the same
+                        x-axis. A 1-D array is treated as a single spectrum.
+        deg (integer): (Optional) The degree of the baseline polynomial.
+        max_it (integer): (Optional) The maximum number of iterations per spectrum.
+        tol (float): (Optional) The relative change in the polynomial coefficients below
+                     which a spectrum has converged.
+
+    Returns:
+        y_base (numpy array): The baselines, with the same shape as `y_data`.
+    """
+    # handling errors in inputs
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    if not isinstance(deg, int):
+        raise TypeError('Passed value of `deg` is not an int! Instead, it is: '
+                        + str(type(deg)))
+    if not isinstance(max_it, int):
+        raise TypeError('Passed value of `max_it` is not an int! Instead, it is: '
+                        + str(type(max_it)))
+    y_data = np.asarray(y_data, dtype=np.float64)
+    shape = y_data.shape
+    y_work = np.atleast_2d(y_data).copy()
+    y_base = y_work.copy()
+    order = deg + 1
+    # shared factorization of the Vandermonde matrix on a unit x-axis
+    vander = np.vander(np.linspace(0., 1., y_work.shape[1]), order)
+    q_matrix, r_matrix = np.linalg.qr(vander)
+    # peakutils stretches the x-axis of each spectrum to max(|y|)**(1/order), which
+    # divides the coefficient of x**p by that length**p
+    length = np.abs(y_work).max(axis=1) ** (1. / order)
+    scale = length[:, np.newaxis] ** np.arange(deg, -1, -1)
+    coeffs = np.ones((len(y_work), order))
+    # rows of the spectra that are still iterating, and their current baselines
+    active = np.arange(len(y_work))
+    base = y_base
+    for _ in range(max_it):
+        projection = y_work @ q_matrix
+        with np.errstate(divide='ignore', invalid='ignore'):
+            coeffs_new = np.linalg.solve(r_matrix, projection.T).T / scale
+            change = np.linalg.norm(coeffs_new - coeffs, axis=1) / np.linalg.norm(coeffs, axis=1)
+        # spectra that converged keep the baseline of their previous iteration
+        moving = ~(change < tol)
+        if not moving.all():
+            y_base[active[~moving]] = base[~moving]
+            active = active[moving]
+            y_work = y_work[moving]
+            projection = projection[moving]
+            coeffs_new = coeffs_new[moving]
+            scale = scale[moving]
+            if not active.size:
+                break
+        coeffs = coeffs_new
+        base = projection @ q_matrix.T
+        np.minimum(y_work, base, out=y_work)
+    y_base[active] = base
+    return y_base.reshape(shape)
+
+
+def subtract_baseline_batch(y_data, deg=3):
+    """
+    Function that subtracts the polynomial baseline from every row of a 2-D array of
+    spectra, the batch form of `subtract_baseline`. Baselines come from `baseline_batch`,
+    and, as in `subtract_baseline`, negative baseline values are set to zero first.
+
+    Args:
+        y_data (numpy array): A 2-D array with one spectrum per row, sampled on the same
+                        x-axis.
+        deg (integer): (Optional) The degree of the baseline polynomial.
+
+    Returns:
+        y_out (numpy array): The baselined spectra, with the same shape as `y_data`.
+    """
+    # handling errors in inputs
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    y_data = np.asarray(y_data, dtype=np.float64)
+    y_out = y_data - np.maximum(baseline_batch(y_data, deg=deg, max_it=200), 0)
+    return y_out
+
+
 def peak_detect(x_data, y_data, height=0.1, prominence=0.1, distance=10):
     """
     Function that utilizes scipy to find peak maxima from input spectral data. Default
@@ -119,7 +230,7 @@ def peak_detect(x_data, y_data, height=0.1, prominence=0.1, distance=10):
     return peaks, peak_list
 
 
-def set_params(peaks):
+def set_params(peaks, previous=None):
     """
     This module takes in the list of peaks from the peak detection modules, and then uses
     that to initialize parameters for a set of Pseudo-Voigt models that are not yet fit.
@@ -127,6 +238,11 @@ def set_params(peaks):
 
     Args:
         peaks (list): A list containing the x and y-values (in tuples) of the peaks.
+        previous (list): (Optional) The `export_fit_data` output of an earlier fit with one
+                        row per peak in `peaks`, such as the previous time point of a series.
+                        Its sigma, amplitude and fraction values are used as starting values
+                        in place of the defaults, so the fit starts close to its solution.
+                        The estimates of `initial_guess` have the same layout.
 
     Returns:
         mod (lmfit.models.PseudoVoigtModel or lmfit.model.CompositeModel): This is an array of
@@ -154,6 +270,12 @@ def set_params(peaks):
         if not isinstance(peaks[i], tuple):
             raise TypeError("""Passed value of `peaks[{}]` is not a tuple.
              Instead, it is: """.format(i) + str(type(peaks[i])))
+    if previous is not None and not isinstance(previous, list):
+        raise TypeError('Passed value of `previous` is not a list! Instead, it is: '
+                        + str(type(previous)))
+    if previous is not None and len(previous) != len(peaks):
+        raise ValueError('`previous` has {} peaks, but `peaks` has {}'
+                         .format(len(previous), len(peaks)))
     peak_list = []
     for i, _ in enumerate(peaks):
         prefix = 'p{}_'.format(i+1)
@@ -166,6 +288,10 @@ def set_params(peaks):
         pars[prefix+'height'].set(peaks[i][1], vary=False)
         pars[prefix+'sigma'].set(50, min=0, max=500)
         pars[prefix+'amplitude'].set(min=0)
+        if previous is not None:
+            pars[prefix+'fraction'].set(np.clip(previous[i][0], 0, 1))
+            pars[prefix+'sigma'].set(np.clip(previous[i][1], 0, 500))
+            pars[prefix+'amplitude'].set(max(previous[i][3], 0))
         peak_list.append(peak)
         if i == 0:
             mod = peak_list[i]
@@ -174,7 +300,7 @@ def set_params(peaks):
     return mod, pars
 
 
-def model_fit(x_data, y_data, mod, pars, report=False):
+def model_fit(x_data, y_data, mod, pars, report=False, backend='lmfit'):
     """
     This function takes in the x and y data for the spectrum being analyzed, as well as the model
     parameters that were generated in `lorentz_params` for a single peak, and uses it to generate
@@ -201,6 +327,12 @@ def model_fit(x_data, y_data, mod, pars, report=False):
         report (boolean): (Optional) This value details whether or not the users wants to receive
                         a report of the fit values. If True, the function will print a report of
                         the fit.
+        backend (str): (Optional) The fitting engine. 'lmfit' (default) fits `mod` with lmfit,
+                        which estimates the Jacobian by finite differences. 'analytic' calls
+                        scipy.optimize.least_squares directly with closed-form pseudo-Voigt
+                        derivatives, which needs far fewer model evaluations when there are
+                        many peaks, and returns a `FitResult`. Both results are accepted by
+                        `export_fit_data` and `plot_fit`.
     Returns:
         out (lmfit.model.ModelResult): An lmfit model class that contains all of the fitted values
                         for the input model.
@@ -221,8 +353,17 @@ def model_fit(x_data, y_data, mod, pars, report=False):
     if not isinstance(report, bool):
         raise TypeError('Passed value of `report` is not a boolean! Instead, it is: '
                         + str(type(report)))
+    if not isinstance(backend, str):
+        raise TypeError('Passed value of `backend` is not a string! Instead, it is: '
+                        + str(type(backend)))
+    if backend not in ('lmfit', 'analytic'):
+        raise ValueError("Passed value of `backend` must be 'lmfit' or 'analytic', not: "
+                         + backend)
     # fit model
-    out = mod.fit(y_data, pars, x=x_data)
+    if backend == 'analytic':
+        out = _analytic_fit(x_data, y_data, mod, pars)
+    else:
+        out = mod.fit(y_data, pars, x=x_data)
     if report:
         print(out.fit_report())
     else:
@@ -239,7 +380,8 @@ def plot_fit(x_data, y_data, fit_result, plot_components=False):
         x_data (list like): The x-values of the spectrum to be fitted.
         y_data (list like): The y-values of the spectrum to be fitted.
         fit_result (lmfit.model.ModelResult): An lmfit model class that contains all
-                        of the fitted values for the single input model.
+                        of the fitted values for the single input model, or the `FitResult`
+                        of the 'analytic' backend of `model_fit`.
         plot_components (boolean): (Optional) A Boolean that dictates whether or not
                         curves for individual fit components are shown in addition to the
                         concatenated fit that shows all of the function fits. Defaults to
@@ -255,9 +397,9 @@ def plot_fit(x_data, y_data, fit_result, plot_components=False):
     if not isinstance(y_data, (list, np.ndarray)):
         raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
                         + str(type(y_data)))
-    if not isinstance(fit_result, lmfit.model.ModelResult):
-        raise TypeError("""Passed value of `fit_result` is not a lmfit.model.ModelResult!
-         Instead, it is: """ + str(type(fit_result)))
+    if not isinstance(fit_result, (lmfit.model.ModelResult, FitResult)):
+        raise TypeError("""Passed value of `fit_result` is not a lmfit.model.ModelResult or a
+         FitResult! Instead, it is: """ + str(type(fit_result)))
     if not isinstance(plot_components, bool):
         raise TypeError('Passed value of `plot_components` is not a boolean! Instead, it is: '
                         + str(type(plot_components)))
@@ -284,7 +426,8 @@ def export_fit_data(out):
 
     Args:
         out (lmfit.model.ModelResult): An lmfit model class that contains all of the
-                        fitted values for the input model class.
+                        fitted values for the input model class, or the `FitResult` of the
+                        'analytic' backend of `model_fit`.
 
     Returns:
         fit_peak_data (numpy array): An array containing both the peak number, as well as the
@@ -299,9 +442,9 @@ def export_fit_data(out):
                             fit_peak_data[i][5] = p[i]_height
     """
     # handling errors in inputs
-    if not isinstance(out, lmfit.model.ModelResult):
-        raise TypeError('Passed value of `out` is not a lmfit.model.ModelResult! Instead, it is: '
-                        + str(type(out)))
+    if not isinstance(out, (lmfit.model.ModelResult, FitResult)):
+        raise TypeError('Passed value of `out` is not a lmfit.model.ModelResult or a FitResult! '
+                        'Instead, it is: ' + str(type(out)))
     fit_peak_data = []
     for i in range(int(len(out.values)/6)):
         peak = np.zeros(6)
@@ -316,20 +459,592 @@ def export_fit_data(out):
     return fit_peak_data
 
 
-def fit_data(x_data, y_data):
+def fit_data(x_data, y_data, local=False, workers=None, previous=None):
     """
     small wrapper function used in dataprep.py
     can remove height/prominence values once the peak_detect
     function is updated to be proportional to the data
+    local=True fits each cluster of overlapping peaks in its own
+    window with `fit_local`, optionally using `workers` processes
+    previous, the fit_result of the prior spectrum in a series, warm starts
+    the fit with `fit_warm`; peaks are only detected again when it fails
     """
-    peaks = peak_detect(x_data, y_data, height=10, prominence=20)[0]
-    mod, pars = set_params(peaks)
-    out = model_fit(x_data, y_data, mod, pars)
+    _start_fit('fit_data', None, x_data)
+    if previous is not None:
+        fit_result = _run_stage('warm', fit_warm, x_data, y_data, previous)
+        if fit_result is not None:
+            return fit_result
+    peaks, peak_list = _run_stage('detect', peak_detect, x_data, y_data, height=10,
+                                  prominence=20)
+    if local:
+        return _run_stage('fit_local', fit_local, x_data, y_data, peaks, workers=workers)
+    guess = _run_stage('guess', initial_guess, x_data, y_data, peak_list)
+    mod, pars = _run_stage('params', set_params, peaks, guess)
+    out = _run_stage('fit', model_fit, x_data, y_data, mod, pars)
+    fit_result = _run_stage('export', export_fit_data, out)
+    return fit_result
+
+
+def fit_warm(x_data, y_data, previous, height=10, prominence=20, distance=10,
+             backend='analytic'):
+    """
+    Fits a spectrum starting from the fit of the previous spectrum in a series, without
+    detecting peaks first. The peaks are placed at the previous centers, with heights read
+    from the new spectrum, and `set_params` starts them from the previous sigmas, amplitudes
+    and fractions, so the fit only has to follow the small change between time points.
+    The warm fit is rejected, and the peaks must be detected again, when a peak has vanished
+    or a new one has appeared. A peak has vanished when its fitted maximum falls below
+    `height` after being above it in `previous`. A peak may have appeared when `peak_detect`
+    finds a peak in the fit residual; only then is the spectrum itself searched, and the
+    peak is new if the spectrum has a detected peak there that is more than `distance`
+    samples from every fitted center. Residual peaks left by small misfits of the existing
+    peaks, or by shoulders that the previous detection did not pick up, are not new peaks.
+
+    Args:
+        x_data (list like): The x-values of the spectrum.
+        y_data (list like): The y-values of the spectrum.
+        previous (list): The `export_fit_data` output for the previous spectrum.
+        height (float): (Optional) The peak detection height used to judge the fit.
+        prominence (float): (Optional) The peak detection prominence used to judge the fit.
+        distance (float): (Optional) The peak detection distance, in samples, also used as
+                          the distance within which a detected peak matches a fitted one.
+        backend (str): (Optional) The `model_fit` backend. The default, 'analytic', takes
+                       a few iterations from a warm start.
+
+    Returns:
+        fit_result (list): The `export_fit_data` output of the fit, or None if the peaks
+                        must be detected again, as they always are when `previous` has no
+                        peaks.
+    """
+    # handling errors in inputs
+    if not isinstance(x_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `x_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(x_data)))
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    if not isinstance(previous, list):
+        raise TypeError('Passed value of `previous` is not a list! Instead, it is: '
+                        + str(type(previous)))
+    if not isinstance(height, (int, float)):
+        raise TypeError('Passed value of `height` is not a int or a float! Instead, it is: '
+                        + str(type(height)))
+    if not isinstance(prominence, (int, float)):
+        raise TypeError('Passed value of `prominence` is not a int or a float! Instead, it is: '
+                        + str(type(prominence)))
+    if not isinstance(distance, (int, float)):
+        raise TypeError('Passed value of `distance` is not a int or a float! Instead, it is: '
+                        + str(type(distance)))
+    if not isinstance(backend, str):
+        raise TypeError('Passed value of `backend` is not a string! Instead, it is: '
+                        + str(type(backend)))
+    if backend not in ('lmfit', 'analytic'):
+        raise ValueError("Passed value of `backend` must be 'lmfit' or 'analytic', not: "
+                         + backend)
+    # without previous peaks there is nothing to start from
+    if not previous:
+        return None
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    # the sample nearest each previous center, wherever the x-axis is ordered
+    center_index = np.array([np.abs(x_data - peak[2]).argmin() for peak in previous],
+                            dtype=int)
+    peaks = [(peak[2], y_data[index]) for peak, index in zip(previous, center_index)]
+    mod, pars = set_params(peaks, previous)
+    out = model_fit(x_data, y_data, mod, pars, backend=backend)
     fit_result = export_fit_data(out)
+    # a vanished peak no longer reaches the detection height
+    before = np.array([pseudo_voigt(peak[2], peak[3], peak[2], peak[1], peak[0])
+                       for peak in previous])
+    after = np.array([pseudo_voigt(peak[2], peak[3], peak[2], peak[1], peak[0])
+                      for peak in fit_result])
+    if np.any((before >= height) & (after < height)):
+        return None
+    # a new peak leaves a peak in the residual where the spectrum has an unfit peak
+    residual_index = peak_detect(x_data, y_data - out.best_fit, height=height,
+                                 prominence=prominence, distance=distance)[1][0]
+    if not residual_index.size:
+        return fit_result
+    data_index = peak_detect(x_data, y_data, height=height, prominence=prominence,
+                             distance=distance)[1][0]
+    for index in data_index:
+        unfit = not center_index.size or np.abs(center_index - index).min() > distance
+        if unfit and np.abs(residual_index - index).min() <= distance:
+            return None
     return fit_result
 
 
-def compound_report(compound):
+def peak_windows(x_data, y_data, peaks, width_scale=3):
+    """
+    Groups peaks into independent fitting windows. Each peak is given a window that extends
+    `width_scale` times its full-width, half-max (measured with scipy.signal.peak_widths) on
+    either side of its center, and peaks whose windows overlap are merged into one cluster.
+
+    Args:
+        x_data (list like): The x-values of the spectrum, in increasing order.
+        y_data (list like): The y-values of the spectrum.
+        peaks (list): A list containing the x and y-values (in tuples) of the peaks, as
+                      returned by `peak_detect`.
+        width_scale (float): (Optional) The half-width of each peak window in multiples of the
+                             peak full-width, half-max.
+
+    Returns:
+        windows (list): A list of (start, stop, cluster) tuples. `start` and `stop` slice
+                        `x_data` and `y_data` and `cluster` is the list of peaks in the window.
+    """
+    # handling errors in inputs
+    if not isinstance(peaks, list):
+        raise TypeError('Passed value of `peaks` is not a list! Instead, it is: '
+                        + str(type(peaks)))
+    if not isinstance(width_scale, (int, float)):
+        raise TypeError('Passed value of `width_scale` is not a int or a float! Instead, it is: '
+                        + str(type(width_scale)))
+    if not peaks:
+        return []
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    peaks = sorted(peaks)
+    centers = np.array([peak[0] for peak in peaks])
+    index = np.clip(np.searchsorted(x_data, centers), 0, len(x_data) - 1)
+    _, _, left_ips, right_ips = peak_widths(y_data, index, rel_height=0.5)
+    samples = np.arange(len(x_data))
+    fwhm = np.interp(right_ips, samples, x_data) - np.interp(left_ips, samples, x_data)
+    # never let a window shrink below a few samples on either side of the peak
+    half_width = np.maximum(width_scale*fwhm, 3*np.abs(np.diff(x_data)).mean())
+    lefts = centers - half_width
+    rights = centers + half_width
+    # merge peaks whose windows overlap into clusters
+    windows = []
+    cluster = [peaks[0]]
+    left, right = lefts[0], rights[0]
+    for i in range(1, len(peaks)):
+        if lefts[i] <= right:
+            cluster.append(peaks[i])
+            right = max(right, rights[i])
+        else:
+            windows.append((left, right, cluster))
+            cluster = [peaks[i]]
+            left, right = lefts[i], rights[i]
+    windows.append((left, right, cluster))
+    windows = [(int(np.searchsorted(x_data, left)), int(np.searchsorted(x_data, right, 'right')),
+                cluster) for left, right, cluster in windows]
+    return windows
+
+
+def _fit_window(x_data, y_data, peaks, backend):
+    """fits a single window of `fit_local`; module level so it can run in a process pool"""
+    mod, pars = set_params(peaks)
+    out = model_fit(x_data, y_data, mod, pars, backend=backend)
+    return export_fit_data(out)
+
+
+def fit_local(x_data, y_data, peaks, width_scale=3, workers=None, backend='lmfit'):
+    """
+    Fits a spectrum one window at a time instead of with a single CompositeModel over the whole
+    x range. The peaks are grouped into clusters of overlapping peaks with `peak_windows`, and
+    each cluster is fit with `set_params` and `model_fit` using only the data in its window.
+    For spectra with many well separated peaks this makes the cost grow roughly linearly with
+    the number of peaks. Windows are independent, so they can be fit in parallel.
+
+    Args:
+        x_data (list like): The x-values of the spectrum, in increasing order.
+        y_data (list like): The y-values of the spectrum.
+        peaks (list): A list containing the x and y-values (in tuples) of the peaks, as
+                      returned by `peak_detect`.
+        width_scale (float): (Optional) The half-width of each peak window in multiples of the
+                             peak full-width, half-max. See `peak_windows`.
+        workers (int): (Optional) The number of processes used to fit windows. If None or 1,
+                       windows are fit one after the other in this process.
+        backend (str): (Optional) The `model_fit` backend used for each window.
+
+    Returns:
+        fit_peak_data (list): The fitted peaks sorted by center, with the same layout as
+                              the output of `export_fit_data`.
+    """
+    # handling errors in inputs
+    if not isinstance(x_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `x_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(x_data)))
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    if workers is not None and not isinstance(workers, int):
+        raise TypeError('Passed value of `workers` is not an int! Instead, it is: '
+                        + str(type(workers)))
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    windows = peak_windows(x_data, y_data, peaks, width_scale)
+    tasks = [(x_data[start:stop], y_data[start:stop], cluster, backend)
+             for start, stop, cluster in windows]
+    if workers is None or workers <= 1:
+        results = [_fit_window(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_fit_window, *zip(*tasks)))
+    fit_peak_data = [peak for result in results for peak in result]
+    return fit_peak_data
+
+
+def pseudo_voigt(x_data, amplitude, center, sigma, fraction):
+    """
+    Vectorized pseudo-Voigt profile that matches `lmfit.lineshapes.pvoigt`, the lineshape
+    used by the models built in `set_params`. All arguments broadcast against each other,
+    so many peaks of many spectra can be evaluated in a single call.
+
+    Args:
+        x_data (numpy array): The x-values at which the profile is evaluated.
+        amplitude (numpy array): The area of each peak.
+        center (numpy array): The center of each peak.
+        sigma (numpy array): The half-width, half-max of each peak.
+        fraction (numpy array): The fraction Lorentzian character of each peak.
+
+    Returns:
+        y_out (numpy array): The broadcast pseudo-Voigt profile(s).
+    """
+    tiny = np.finfo(np.float64).eps
+    sigma_g = sigma / np.sqrt(2*np.log(2))
+    gauss = (amplitude / np.maximum(tiny, np.sqrt(2*np.pi)*sigma_g)
+             * np.exp(-(x_data - center)**2 / np.maximum(tiny, 2*sigma_g**2)))
+    lorentz = (amplitude / (1 + ((x_data - center) / np.maximum(tiny, sigma))**2)
+               / np.maximum(tiny, np.pi*sigma))
+    y_out = (1 - fraction)*gauss + fraction*lorentz
+    return y_out
+
+
+def pseudo_voigt_jacobian(x_data, amplitude, center, sigma, fraction):
+    """
+    Closed-form partial derivatives of `pseudo_voigt` with respect to each of its parameters.
+    Like `pseudo_voigt`, all arguments broadcast against each other.
+
+    Args:
+        x_data (numpy array): The x-values at which the derivatives are evaluated.
+        amplitude (numpy array): The area of each peak.
+        center (numpy array): The center of each peak.
+        sigma (numpy array): The half-width, half-max of each peak.
+        fraction (numpy array): The fraction Lorentzian character of each peak.
+
+    Returns:
+        jacobian (numpy array): The derivatives stacked along the first axis in the order
+                        amplitude, center, sigma, fraction.
+    """
+    tiny = np.finfo(np.float64).eps
+    sigma = np.maximum(tiny, sigma)
+    sigma_g = sigma / np.sqrt(2*np.log(2))
+    offset = x_data - center
+    # unit area gaussian and lorentzian components
+    gauss = np.exp(-offset**2 / (2*sigma_g**2)) / (np.sqrt(2*np.pi)*sigma_g)
+    denominator = sigma**2 + offset**2
+    lorentz = sigma / (np.pi*denominator)
+    d_amplitude = (1 - fraction)*gauss + fraction*lorentz
+    d_center = amplitude*((1 - fraction)*gauss*offset/sigma_g**2
+                          + fraction*lorentz*2*offset/denominator)
+    d_sigma = amplitude*((1 - fraction)*gauss*(offset**2/sigma_g**2 - 1)/sigma
+                         + fraction*lorentz*(offset**2 - sigma**2)/(sigma*denominator))
+    d_fraction = amplitude*(lorentz - gauss)
+    jacobian = np.stack(np.broadcast_arrays(d_amplitude, d_center, d_sigma, d_fraction))
+    return jacobian
+
+
+def _width_ratios():
+    """
+    Returns the ratio of the full width at a quarter of the maximum to the full width at half
+    maximum of a pseudo-Voigt profile, for Lorentzian fractions from 0 to 1. The ratio rises
+    from sqrt(2) for a Gaussian to sqrt(3) for a Lorentzian.
+    """
+    fraction = np.linspace(0, 1, 101)
+    # half of the profile, with a half width at half maximum of 1 (sigma = 1)
+    x_half = np.linspace(0, 10, 4001)
+    profile = pseudo_voigt(x_half, 1., 0., 1., fraction[:, None])
+    profile /= profile[:, :1]
+    ratio = [np.interp(-0.25, -row, x_half) for row in profile]
+    return np.array(ratio), fraction
+
+
+def initial_guess(x_data, y_data, peak_list):
+    """
+    Estimates the shape of every detected peak in one vectorized pass, as starting values
+    for `set_params` in place of its fixed defaults. The full width at half maximum and at
+    a quarter of the maximum come from `scipy.signal.peak_widths`, measured from the
+    prominence of each peak as found by `peak_detect`. The full width at half maximum
+    gives sigma (half of it, for the lmfit pseudo-Voigt), the ratio of the two widths
+    gives the Lorentzian fraction, and the prominence together with sigma and the fraction
+    gives the amplitude. The fraction is kept between 0.05 and 0.95, as a value on its
+    bounds stalls the lmfit fit.
+
+    Args:
+        x_data (list like): The x-values of the spectrum.
+        y_data (list like): The y-values of the spectrum, after baseline subtraction.
+        peak_list (tuple): The second output of `peak_detect`, the peak indices and their
+                           properties from `scipy.signal.find_peaks`.
+
+    Returns:
+        guesses (list): One row per peak in the layout of `export_fit_data`: fraction,
+                        sigma, center, amplitude, fwhm and height, where the height is the
+                        prominence of the peak.
+    """
+    # handling errors in inputs
+    if not isinstance(x_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `x_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(x_data)))
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    if not isinstance(peak_list, tuple):
+        raise TypeError('Passed value of `peak_list` is not a tuple! Instead, it is: '
+                        + str(type(peak_list)))
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    index, properties = peak_list
+    if 'prominences' in properties:
+        prominence_data = (properties['prominences'], properties['left_bases'],
+                           properties['right_bases'])
+    else:
+        prominence_data = peak_prominences(y_data, index)
+    # widths are measured in samples; map their ends onto x, in whatever order x runs
+    samples = np.arange(len(x_data))
+    widths = []
+    for rel_height in (0.5, 0.75):
+        left, right = peak_widths(y_data, index, rel_height, prominence_data)[2:]
+        widths.append(np.abs(np.interp(right, samples, x_data)
+                             - np.interp(left, samples, x_data)))
+    fwhm, quarter_width = widths
+    ratio = quarter_width / np.maximum(fwhm, np.finfo(float).tiny)
+    fraction = np.clip(np.interp(ratio, *_WIDTH_RATIOS), 0.05, 0.95)
+    sigma = np.clip(fwhm / 2, 1e-3, 500)
+    height = prominence_data[0]
+    # the pseudo-Voigt maximum is amplitude/sigma * ((1-f)*sqrt(ln2/pi) + f/pi)
+    amplitude = height * sigma / ((1 - fraction)*np.sqrt(np.log(2)/np.pi) + fraction/np.pi)
+    guesses = [[fraction[i], sigma[i], x_data[index[i]], amplitude[i], 2*sigma[i], height[i]]
+               for i in range(len(index))]
+    return guesses
+
+
+# width ratios and the Lorentzian fractions they belong to, for `initial_guess`
+_WIDTH_RATIOS = _width_ratios()
+
+
+class FitResult():
+    """
+    The result of the 'analytic' backend of `model_fit`. It has the attributes of a
+    lmfit.model.ModelResult that `export_fit_data`, `plot_fit`, `fit_warm` and
+    `FitProfiler` read, without the uncertainties that lmfit propagates to the fwhm and
+    height of every peak after a fit, which take longer than the fit itself once there
+    are tens of peaks.
+
+    Args:
+        model (lmfit.model.CompositeModel): The model that was fit.
+        params (lmfit.parameter.Parameters): The fitted parameters.
+        x_data (numpy array): The x-values the model was fit on.
+        result (scipy.optimize.OptimizeResult): The `scipy.optimize.least_squares` output.
+
+    Attributes:
+        values (dict): The fitted value of every parameter, by name.
+        best_fit (numpy array): The model evaluated at the fitted parameters.
+        residual (numpy array): The model minus the data at the fitted parameters.
+        nfev (int): The number of model evaluations.
+        njev (int): The number of Jacobian evaluations.
+        success (boolean): Whether the fit converged.
+        message (str): The reason the fit stopped.
+        chisqr (float): The sum of the squared residuals.
+    """
+    def __init__(self, model, params, x_data, result):
+        self.model = model
+        self.params = params
+        self.values = params.valuesdict()
+        self.best_fit = model.eval(params=params, x=x_data)
+        self.residual = result.fun
+        self.nfev = result.nfev
+        self.njev = result.njev
+        self.success = result.success
+        self.message = result.message
+        self.chisqr = float(np.sum(result.fun**2))
+
+    def eval_components(self, **kwargs):
+        """Returns the profile of each peak, by prefix, as lmfit's eval_components does."""
+        return self.model.eval_components(params=self.params, **kwargs)
+
+    def fit_report(self):
+        """Returns a text report of the fit statistics and the fitted parameters."""
+        return ('[[Fit Statistics]]\n    # function evals   = {}\n    chi-square         = {}\n'
+                '    message            = {}\n'.format(self.nfev, self.chisqr, self.message)
+                + lmfit.fit_report(self.params))
+
+
+def _analytic_fit(x_data, y_data, mod, pars):
+    """
+    Fits the pseudo-Voigt components of `mod` with `scipy.optimize.least_squares` using the
+    derivatives from `pseudo_voigt_jacobian`, and returns the fit as a `FitResult`.
+    """
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    if isinstance(mod, lmfit.model.CompositeModel):
+        prefixes = [component.prefix for component in mod.components]
+    else:
+        prefixes = [mod.prefix]
+    names = ('amplitude', 'center', 'sigma', 'fraction')
+    keys = [[prefix+name for name in names] for prefix in prefixes]
+    values = np.array([[pars[key].value for key in row] for row in keys])
+    free = np.array([[pars[key].vary and not pars[key].expr for key in row] for row in keys])
+    lower = np.array([[pars[key].min for key in row] for row in keys])[free]
+    upper = np.array([[pars[key].max for key in row] for row in keys])[free]
+
+    def unpack(theta):
+        """place the free parameters back into the (peak, parameter) table"""
+        table = values.copy()
+        table[free] = theta
+        return [column[:, None] for column in table.T]
+
+    def residual(theta):
+        """difference between the summed pseudo-Voigt profiles and the data"""
+        return pseudo_voigt(x_data, *unpack(theta)).sum(axis=0) - y_data
+
+    def jacobian(theta):
+        """derivative of the residual with respect to each free parameter"""
+        derivatives = pseudo_voigt_jacobian(x_data, *unpack(theta))
+        return derivatives.transpose(1, 0, 2)[free].T
+
+    theta_0 = np.clip(values[free], lower, upper)
+    result = least_squares(residual, theta_0, jac=jacobian, bounds=(lower, upper),
+                           x_scale='jac')
+    # copy the fitted values into lmfit parameters so constraints such as fwhm update
+    params = pars.copy()
+    for key, value in zip(np.array(keys)[free], result.x):
+        params[key].value = value
+    params.update_constraints()
+    return FitResult(mod, params, x_data, result)
+
+
+def _fit_stack(x_data, y_stack, centers, guesses=None):
+    """
+    Fits a stack of spectra that share `x_data` as one least squares problem. Each spectrum
+    contributes its own block of residuals and its own amplitude, sigma and fraction values
+    for every peak in `centers`, so the Jacobian is block diagonal and its sparsity lets a
+    single finite difference step perturb one peak in every spectrum at once.
+
+    `guesses`, one `initial_guess` array per spectrum, gives the starting values; without
+    it every peak starts from the `set_params` defaults.
+
+    Returns a list with an (n_peaks, 3) array of (amplitude, sigma, fraction) per spectrum.
+    """
+    n_spectra, n_points = y_stack.shape
+    n_max = max(len(center) for center in centers)
+    if n_max == 0:
+        return [np.zeros((0, 3)) for _ in centers]
+    # pad every spectrum to the same number of peaks; padded peaks keep a zero amplitude
+    center = np.zeros((n_spectra, n_max))
+    mask = np.zeros((n_spectra, n_max), dtype=bool)
+    for i, peaks in enumerate(centers):
+        center[i, :len(peaks)] = peaks
+        mask[i, :len(peaks)] = True
+    owner = np.nonzero(mask)[0]
+    n_free = len(owner)
+
+    def unpack(theta):
+        """scatter the free parameter vector into padded (amplitude, sigma, fraction)"""
+        theta = theta.reshape(3, n_free)
+        amplitude = np.zeros((n_spectra, n_max))
+        sigma = np.ones((n_spectra, n_max))
+        fraction = np.zeros((n_spectra, n_max))
+        amplitude[mask] = theta[0]
+        sigma[mask] = theta[1]
+        fraction[mask] = theta[2]
+        return amplitude, sigma, fraction
+
+    def residual(theta):
+        """stacked residual of every spectrum in the batch"""
+        amplitude, sigma, fraction = unpack(theta)
+        model = pseudo_voigt(x_data, amplitude[..., None], center[..., None],
+                             sigma[..., None], fraction[..., None]).sum(axis=1)
+        return (model - y_stack).ravel()
+
+    # every point of spectrum i depends on every parameter owned by spectrum i
+    owns = sparse.csr_matrix((np.ones(n_free), (owner, np.arange(n_free))),
+                             shape=(n_spectra, n_free))
+    block = sparse.kron(owns, np.ones((n_points, 1)))
+    sparsity = sparse.hstack([block, block, block])
+    # same starting values and bounds as `set_params`
+    theta_0 = np.concatenate([np.ones(n_free), np.full(n_free, 50.), np.full(n_free, 0.5)])
+    if guesses is not None:
+        guess = np.concatenate(guesses)
+        theta_0 = np.concatenate([guess[:, 3], guess[:, 1], guess[:, 0]])
+    lower = np.concatenate([np.zeros(n_free), np.zeros(n_free), np.zeros(n_free)])
+    upper = np.concatenate([np.full(n_free, np.inf), np.full(n_free, 500.), np.ones(n_free)])
+    out = least_squares(residual, theta_0, bounds=(lower, upper), jac_sparsity=sparsity,
+                        x_scale='jac')
+    theta = out.x.reshape(3, n_free)
+    fits = []
+    for i in range(n_spectra):
+        fits.append(theta[:, owner == i].T)
+    return fits
+
+
+def fit_batch(x_data, y_data, height=0.1, prominence=0.1, distance=10, batch_size=32):
+    """
+    Fits many spectra that share a single wavenumber axis. Peaks are detected in every
+    spectrum with `peak_detect`, and then each batch of spectra is fit at once with vectorized
+    pseudo-Voigt evaluation and a single stacked least squares solve, instead of one lmfit
+    CompositeModel per spectrum. Peak centers are held fixed and the starting values and
+    bounds match those of `set_params`.
+
+    Args:
+        x_data (list like): The x-values shared by every spectrum.
+        y_data (numpy array): A 2-D array with one spectrum per row. The number of columns
+                        must match the length of `x_data`.
+        height (float): (Optional) Peak detection height passed to `peak_detect`.
+        prominence (float): (Optional) Peak detection prominence passed to `peak_detect`.
+        distance (float): (Optional) Peak detection distance passed to `peak_detect`.
+        batch_size (int): (Optional) The number of spectra solved together. Larger batches
+                        use fewer solver calls at the cost of memory.
+
+    Returns:
+        fit_peak_data (numpy structured array): One row per fitted peak with the fields
+                        `spectrum` (row index in `y_data`), `peak` (1-based peak number within
+                        that spectrum), and the same values returned by `export_fit_data`:
+                        `fraction`, `sigma`, `center`, `amplitude`, `fwhm` and `height`.
+    """
+    # handling errors in inputs
+    if not isinstance(x_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `x_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(x_data)))
+    if not isinstance(y_data, (list, np.ndarray)):
+        raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
+                        + str(type(y_data)))
+    if not isinstance(batch_size, int):
+        raise TypeError('Passed value of `batch_size` is not an int! Instead, it is: '
+                        + str(type(batch_size)))
+    x_data = np.asarray(x_data, dtype=np.float64)
+    y_data = np.asarray(y_data, dtype=np.float64)
+    if y_data.ndim != 2 or y_data.shape[1] != len(x_data):
+        raise ValueError('`y_data` must be a 2-D array with one spectrum of length {} per row'
+                         .format(len(x_data)))
+    if batch_size < 1:
+        raise ValueError('Passed value of `batch_size` must be at least 1')
+    # detect peaks in each spectrum
+    centers = []
+    heights = []
+    guesses = []
+    for y_spectrum in y_data:
+        peaks, peak_list = peak_detect(x_data, y_spectrum, height=height,
+                                       prominence=prominence, distance=distance)
+        centers.append([peak[0] for peak in peaks])
+        heights.append([peak[1] for peak in peaks])
+        guesses.append(np.array(initial_guess(x_data, y_spectrum, peak_list)).reshape(-1, 6))
+    # fit each batch as a single stacked problem
+    rows = []
+    for start in range(0, len(y_data), batch_size):
+        stop = start + batch_size
+        fits = _fit_stack(x_data, y_data[start:stop], centers[start:stop],
+                          guesses[start:stop])
+        for i, fit in enumerate(fits):
+            for j, (amplitude, sigma, fraction) in enumerate(fit):
+                # like `set_params`, the reported height is the detected peak height
+                rows.append((start + i, j + 1, fraction, sigma, centers[start + i][j],
+                             amplitude, 2*sigma, heights[start + i][j]))
+    fit_peak_data = np.array(rows, dtype=FIT_DTYPE)
+    return fit_peak_data
+
+
+def compound_report(compound, cache=None):
     """
     Wrapper fucntion that utilizes many of the functions
     within spectrafit to give the peak information of a compound
@@ -337,6 +1052,8 @@ def compound_report(compound):
 
     Args:
         compound (dict): a single NIST compound dictionary from shoyu_data_dict.
+        cache (FitCache): (Optional) If passed, a compound that was fit before is
+                          read from the cache instead of fit again.
 
     Returns:
         peak_centers (list): A list with a peak center value for each peak.
@@ -351,16 +1068,20 @@ def compound_report(compound):
                         + str(type(compound)))
     x_data = compound['x']
     y_data = compound['y']
+    if cache is not None:
+        return cache.report(compound_report, x_data, y_data, compound)
+    _start_fit('compound_report', compound.get('title'), x_data)
     # subtract baseline
-    y_data = subtract_baseline(y_data)
+    y_data = _run_stage('baseline', subtract_baseline, y_data)
     # detect peaks
-    peaks = peak_detect(x_data, y_data)[0]
-    # assign parameters for least squares fit
-    mod, pars = set_params(peaks)
+    peaks, peak_list = _run_stage('detect', peak_detect, x_data, y_data)
+    # assign parameters for least squares fit, starting from the shape of each peak
+    guess = _run_stage('guess', initial_guess, x_data, y_data, peak_list)
+    mod, pars = _run_stage('params', set_params, peaks, guess)
     # fit the model to the data
-    out = model_fit(x_data, y_data, mod, pars)
+    out = _run_stage('fit', model_fit, x_data, y_data, mod, pars)
     # export data in logical structure (see docstring)
-    fit_peak_data = export_fit_data(out)
+    fit_peak_data = _run_stage('export', export_fit_data, out)
     # peak_fraction = []
     peak_center = []
     peak_sigma = []
@@ -379,7 +1100,7 @@ def compound_report(compound):
     return peak_center, peak_sigma, peak_ampl, xmin, xmax
 
 
-def data_report(x_data, y_data):
+def data_report(x_data, y_data, cache=None):
     """
     Wrapper fucntion that utilizes many of the functions
     within spectrafit to give the peak information of inputted x
@@ -389,6 +1110,8 @@ def data_report(x_data, y_data):
     Args:
         x_data (list like): the wavenumber data (y) for an experimental sample.
         y_data (list like): the count data (x) for an experimental sample
+        cache (FitCache): (Optional) If passed, a spectrum that was fit before is
+                          read from the cache instead of fit again.
 
     Returns:
         peak_centers (list): A list with a peak center value for each peak.
@@ -404,16 +1127,20 @@ def data_report(x_data, y_data):
     if not isinstance(y_data, (list, np.ndarray)):
         raise TypeError('Passed value of `y_data` is not a list or numpy.ndarray! Instead, it is: '
                         + str(type(y_data)))
+    if cache is not None:
+        return cache.report(data_report, x_data, y_data, x_data, y_data)
+    _start_fit('data_report', None, x_data)
     # subtract baseline
-    y_data = subtract_baseline(y_data)
+    y_data = _run_stage('baseline', subtract_baseline, y_data)
     # detect peaks
-    peaks = peak_detect(x_data, y_data)[0]
-    # assign parameters for least squares fit
-    mod, pars = set_params(peaks)
+    peaks, peak_list = _run_stage('detect', peak_detect, x_data, y_data)
+    # assign parameters for least squares fit, starting from the shape of each peak
+    guess = _run_stage('guess', initial_guess, x_data, y_data, peak_list)
+    mod, pars = _run_stage('params', set_params, peaks, guess)
     # fit the model to the data
-    out = model_fit(x_data, y_data, mod, pars)
+    out = _run_stage('fit', model_fit, x_data, y_data, mod, pars)
     # export data in logical structure (see docstring)
-    fit_peak_data = export_fit_data(out)
+    fit_peak_data = _run_stage('export', export_fit_data, out)
     # peak_fractions = []
     peak_centers = []
     peak_sigma = []
@@ -430,3 +1157,264 @@ def data_report(x_data, y_data):
     xmin = min(x_data)
     xmax = max(x_data)
     return peak_centers, peak_sigma, peak_ampl, xmin, xmax
+
+
+# bump when a change to the fitting makes previously cached reports stale
+FIT_CACHE_VERSION = 2
+
+
+class FitCache():
+    """
+    Content-addressed cache of the reports of `compound_report` and `data_report`, so
+    spectra that were analyzed before are not fit again. An entry is keyed by a sha256 hash
+    of the x and y bytes, the report function, and the default settings of the baseline,
+    peak detection and fit that the reports use, so changed data or settings never read a
+    stale report.
+
+    Reports are kept in memory, up to `max_entries` of the most recently used ones. With
+    a `cache_dir` they are also saved as .npz files, written with an atomic rename so one
+    directory can be shared by many processes. When the files grow past `max_bytes`, the
+    least recently used are deleted.
+
+    Args:
+        cache_dir (str): (Optional) The directory of the disk tier. If None, reports are
+                         only kept in memory.
+        max_entries (int): (Optional) The number of reports kept in memory.
+        max_bytes (int): (Optional) The size cap of the disk tier, in bytes.
+
+    Attributes:
+        hits (int): The number of reports read from the cache.
+        misses (int): The number of reports that had to be fit.
+    """
+    def __init__(self, cache_dir=None, max_entries=256, max_bytes=100*2**20):
+        if cache_dir is not None and not isinstance(cache_dir, str):
+            raise TypeError('Passed value of `cache_dir` is not a string! Instead, it is: '
+                            + str(type(cache_dir)))
+        if not isinstance(max_entries, int):
+            raise TypeError('Passed value of `max_entries` is not an int! Instead, it is: '
+                            + str(type(max_entries)))
+        if not isinstance(max_bytes, int):
+            raise TypeError('Passed value of `max_bytes` is not an int! Instead, it is: '
+                            + str(type(max_bytes)))
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = OrderedDict()
+
+    @staticmethod
+    def key(function, x_data, y_data):
+        """Returns the hexadecimal sha256 key of a report of `function` on x and y."""
+        settings = []
+        for stage in (subtract_baseline, peak_detect, model_fit):
+            for name, parameter in inspect.signature(stage).parameters.items():
+                if parameter.default is not inspect.Parameter.empty:
+                    settings.append((stage.__name__, name, parameter.default))
+        digest = hashlib.sha256()
+        digest.update(np.ascontiguousarray(x_data, dtype=np.float64).tobytes())
+        digest.update(np.ascontiguousarray(y_data, dtype=np.float64).tobytes())
+        digest.update(repr((FIT_CACHE_VERSION, function, settings)).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns the report stored under `key`, or None."""
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key]
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, key + '.npz')
+        try:
+            with np.load(path) as cached:
+                report = (cached['center'].tolist(), cached['sigma'].tolist(),
+                          cached['amplitude'].tolist(), float(cached['xmin']),
+                          float(cached['xmax']))
+            # the modification time orders the files for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # missing, evicted by another process, or unreadable
+            return None
+        self._remember(key, report)
+        return report
+
+    def put(self, key, report):
+        """Stores a report under `key` in memory and, with a `cache_dir`, on disk."""
+        self._remember(key, report)
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        handle, temporary = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        with os.fdopen(handle, 'wb') as cache_file:
+            np.savez(cache_file, center=report[0], sigma=report[1], amplitude=report[2],
+                     xmin=report[3], xmax=report[4])
+        os.replace(temporary, os.path.join(self.cache_dir, key + '.npz'))
+        self._evict()
+
+    def report(self, function, x_data, y_data, *args):
+        """Returns the cached report of `function` on x and y, fitting it on a miss."""
+        key = self.key(function.__name__, x_data, y_data)
+        report = self.get(key)
+        if report is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            report = function(*args)
+            self.put(key, report)
+        # copies, so callers cannot change the cached report
+        return tuple(list(value) if isinstance(value, list) else value for value in report)
+
+    def clear(self):
+        """Removes every report from memory and from the disk tier."""
+        self._memory.clear()
+        if self.cache_dir is not None and os.path.isdir(self.cache_dir):
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith('.npz'):
+                    os.remove(entry.path)
+
+    def _remember(self, key, report):
+        """Adds a report to the memory tier, dropping the least recently used."""
+        self._memory[key] = report
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self):
+        """Deletes the least recently used files until the disk tier fits in `max_bytes`."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def __len__(self):
+        return len(self._memory)
+
+    def __repr__(self):
+        return 'FitCache(cache_dir={!r}, hits={}, misses={})'.format(self.cache_dir, self.hits,
+                                                                    self.misses)
+
+
+# profilers that are recording in each thread, see `FitProfiler`
+_PROFILERS = threading.local()
+
+
+def _active_profilers():
+    """Returns the list of the profilers recording in the calling thread."""
+    if not hasattr(_PROFILERS, 'active'):
+        _PROFILERS.active = []
+    return _PROFILERS.active
+
+
+class FitProfiler():
+    """
+    Context manager that records where the time of every fit goes. While it is active,
+    `compound_report`, `data_report` and `fit_data` record each of their stages (baseline,
+    detect, guess, params, fit and export, or warm and fit_local in `fit_data`) with its wall
+    time, the number of peaks it produced and, for the fit, the number of function
+    evaluations, Jacobian evaluations (the iterations of the 'analytic' backend; lmfit does
+    not report them) and whether the fit converged. Nothing is recorded, and nothing costs
+    extra, when no profiler is active. Stages run in other processes, such as the windows
+    of `fit_local` with `workers`, are recorded as a single stage. A profiler only records
+    the fits made in the thread that entered it.
+
+    Profilers can be nested, and each one gets every record. The records can be exported
+    with `to_dataframe` or `write_log`, or passed one at a time to `callback` as they are
+    made, e.g. to log them as the spectra of a run come in.
+
+    Args:
+        callback (callable): (Optional) Called with each record as it is made.
+        label (str): (Optional) Label of the records of the next fits. `compound_report`
+                     labels its records with the title of the compound instead. Set the
+                     attribute between fits, e.g. to the name of each spectrum.
+
+    Attributes:
+        records (list): One dictionary per stage, with the keys fit (the number of the fit
+                        within this profiler), function, label, n_points, stage, seconds,
+                        n_peaks, nfev, njev and success.
+    """
+    def __init__(self, callback=None, label=None):
+        if callback is not None and not callable(callback):
+            raise TypeError('Passed value of `callback` is not callable! Instead, it is: '
+                            + str(type(callback)))
+        self.callback = callback
+        self.label = label
+        self.records = []
+        self._fit = None
+
+    def __enter__(self):
+        _active_profilers().append(self)
+        return self
+
+    def __exit__(self, *args):
+        _active_profilers().remove(self)
+
+    def _record(self, stage, seconds, result):
+        """Adds the record of a finished stage of the current fit."""
+        record = dict(self._fit or {'fit': None, 'function': None, 'label': self.label,
+                                    'n_points': None},
+                      stage=stage, seconds=seconds, n_peaks=None, nfev=None, njev=None,
+                      success=None)
+        if stage == 'detect':
+            record['n_peaks'] = len(result[0])
+        elif stage == 'params':
+            record['n_peaks'] = sum(name.endswith('_center') for name in result[1])
+        elif stage == 'fit':
+            record['n_peaks'] = sum(name.endswith('_center') for name in result.params)
+            record['nfev'] = int(result.nfev)
+            record['njev'] = getattr(result, 'njev', None)
+            record['success'] = bool(result.success)
+        elif stage in ('guess', 'export', 'warm', 'fit_local') and result is not None:
+            record['n_peaks'] = len(result)
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def to_dataframe(self):
+        """Returns the records as a pandas DataFrame, one row per stage."""
+        return pd.DataFrame(self.records, columns=['fit', 'function', 'label', 'n_points',
+                                                   'stage', 'seconds', 'n_peaks', 'nfev',
+                                                   'njev', 'success'])
+
+    def write_log(self, filename):
+        """Writes the records to `filename` as JSON lines, one record per line."""
+        if not isinstance(filename, str):
+            raise TypeError('Passed value of `filename` is not a string! Instead, it is: '
+                            + str(type(filename)))
+        with open(filename, 'w') as log:
+            for record in self.records:
+                log.write(json.dumps(record) + '\n')
+
+
+def _start_fit(function, label, x_data):
+    """Starts a new fit in every active `FitProfiler`."""
+    for profiler in _active_profilers():
+        fit = profiler._fit['fit'] + 1 if profiler._fit else 1
+        profiler._fit = {'fit': fit, 'function': function,
+                         'label': profiler.label if label is None else label,
+                         'n_points': len(x_data)}
+
+
+def _run_stage(stage, function, *args, **kwargs):
+    """Calls `function` as one stage of a fit, recorded by every active `FitProfiler`."""
+    profilers = _active_profilers()
+    if not profilers:
+        return function(*args, **kwargs)
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    for profiler in profilers:
+        profiler._record(stage, seconds, result)
+    return result
@@ -1,6 +1,10 @@
 """docstring"""
+import asyncio
 import os
+import shutil
 import h5py
+import numpy as np
+import pandas as pd
 from ramannoodles import dataprep
 
 
@@ -115,3 +119,301 @@ def test_plot_fit():
     except TypeError:
         print('A float was passed to the function, and it was handled well with a TypeError.')
     assert key in hdf5, 'input key does not exist within the specified .hdf5 file'
+
+
+def test_add_experiments():
+    """docstring"""
+    shutil.copy('ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv', 'FA_3.6wt__350C_5s.csv')
+    dataprep.new_hdf5('exps_test')
+    dataprep.add_experiments('exps_test.hdf5',
+                             ['ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv',
+                              'FA_3.6wt__350C_5s.csv'], workers=2)
+    exp_file = h5py.File('exps_test.hdf5', 'r')
+    # test generated file
+    assert len(exp_file) == 2, 'incorrect number of 1st order groups'
+    assert '300C/25s' in exp_file, '1st experiment not stored'
+    assert '350C/5s' in exp_file, '2nd experiment not stored'
+    assert len(exp_file['300C/25s']) == 18, 'incorrect number of peaks + raw_data stored'
+    assert len(exp_file['350C/5s']) == 18, 'incorrect number of peaks + raw_data stored'
+    exp_file.close()
+    # test inputs
+    try:
+        dataprep.add_experiments(4.2, ['FA_3.6wt__350C_5s.csv'])
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.add_experiments('exps_test.hdf5', 'FA_3.6wt__350C_5s.csv')
+    except TypeError:
+        print('A str was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.add_experiments('exps_test.hdf5', [4.2])
+    except TypeError:
+        print('A list of floats was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.add_experiments('exps_test.hdf5', ['FA_3.6wt__350C_5s.csv'], workers=1.5)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.add_experiments('exps_test.hdf5', ['FA_3.6wt__350C_5s.csv'], warm_start=1)
+    except TypeError:
+        print('An int was passed to the function, and it was handled well with a TypeError.')
+    os.remove('exps_test.hdf5')
+    # test warm started fits of consecutive time points
+    dataprep.new_hdf5('exps_test')
+    dataprep.add_experiments('exps_test.hdf5',
+                             ['ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv',
+                              'FA_3.6wt__350C_5s.csv'], warm_start=True)
+    exp_file = h5py.File('exps_test.hdf5', 'r')
+    assert len(exp_file['300C/25s']) == 18, 'incorrect number of peaks + raw_data stored'
+    assert len(exp_file['350C/5s']) == 18, 'warm started fit changed the number of peaks'
+    exp_file.close()
+    os.remove('exps_test.hdf5')
+    os.remove('FA_3.6wt__350C_5s.csv')
+
+
+def test_stream_experiments():
+    """docstring"""
+    data = pd.read_csv('ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv',
+                       header=None, names=('x', 'y'))
+    def source():
+        for time in ['5s', '10s', '15s']:
+            yield data['x'].values, data['y'].values, {'temp': '300C', 'time': time,
+                                                       'pressure': 1.5}
+    dataprep.new_hdf5('stream_test')
+    count = dataprep.stream_experiments('stream_test.hdf5', source(), workers=2, max_pending=2)
+    exp_file = h5py.File('stream_test.hdf5', 'r')
+    # test generated file
+    assert count == 3, 'incorrect number of spectra reported'
+    assert list(exp_file['300C'].keys()) == ['10s', '15s', '5s'], '2nd order groups incorrect'
+    assert '300C/5s/wavenumber' in exp_file, 'x data (wavenumber) not stored correctly'
+    assert '300C/5s/counts' in exp_file, 'y data (counts) not stored correctly'
+    assert 'Peak_01' in exp_file['300C/5s'], 'fitted peaks not stored'
+    assert exp_file['300C/5s'].attrs['pressure'] == 1.5, 'metadata not stored correctly'
+    exp_file.close()
+    # test inputs
+    try:
+        dataprep.stream_experiments(4.2, source())
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.stream_experiments('test.txt', source())
+    except TypeError:
+        print('A .txt file was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.stream_experiments('stream_test.hdf5', source(), max_pending=1.5)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.stream_experiments('stream_test.hdf5', iter([(data['x'].values,
+                                                               data['y'].values,
+                                                               {'temp': '350C'})]))
+    except ValueError:
+        print('Metadata without a time was passed to the function, and it was handled well '
+              'with a ValueError.')
+    else:
+        raise AssertionError('metadata without a time was not rejected')
+    exp_file = h5py.File('stream_test.hdf5', 'r')
+    assert '350C' not in exp_file, 'spectrum with bad metadata was written'
+    exp_file.close()
+    os.remove('stream_test.hdf5')
+
+
+def test_stream_experiments_async():
+    """docstring"""
+    data = pd.read_csv('ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv',
+                       header=None, names=('x', 'y'))
+    async def source():
+        for time in ['5s', '10s']:
+            await asyncio.sleep(0)
+            yield data['x'].values, data['y'].values, {'temp': '300C', 'time': time}
+    dataprep.new_hdf5('stream_async_test')
+    count = asyncio.run(dataprep.stream_experiments_async('stream_async_test.hdf5', source(),
+                                                          workers=2, max_pending=1))
+    exp_file = h5py.File('stream_async_test.hdf5', 'r')
+    assert count == 2, 'incorrect number of spectra reported'
+    assert '300C/5s/counts' in exp_file, '1st spectrum not stored'
+    assert '300C/10s/counts' in exp_file, '2nd spectrum not stored'
+    exp_file.close()
+    try:
+        asyncio.run(dataprep.stream_experiments_async(4.2, source()))
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    os.remove('stream_async_test.hdf5')
+
+
+def test_fit_stream_spectrum():
+    """docstring"""
+    data = pd.read_csv('ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv',
+                       header=None, names=('x', 'y'))
+    result = dataprep.fit_stream_spectrum(data['x'].values[::-1], data['y'].values[::-1],
+                                          {'temp': '300C', 'time': '25s'}, baseline=False)
+    temp, time, x_data, y_data, fit_result, _ = result
+    assert (temp, time) == ('300C', '25s'), 'labels not taken from metadata'
+    assert x_data[0] < x_data[-1], 'data not listed from smallest wavenumber first'
+    assert len(fit_result) == 16, 'incorrect number of peaks fit'
+    try:
+        dataprep.fit_stream_spectrum(data['x'].values, data['y'].values, ['300C', '25s'])
+    except TypeError:
+        print('A list was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.fit_stream_spectrum(data['x'].values, data['y'].values, {'time': '25s'})
+    except ValueError:
+        print('Metadata without a temp was passed to the function, and it was handled well '
+              'with a ValueError.')
+
+
+def test_write_peak_table():
+    """docstring"""
+    dataprep.new_hdf5('table_test')
+    hdf5 = h5py.File('table_test.hdf5', 'r+')
+    fit_result = [np.arange(6.0), np.arange(6.0, 12.0)]
+    dataprep.write_peak_table(hdf5.create_group('300C/25s'), fit_result)
+    peaks = hdf5['300C/25s/peaks']
+    assert peaks.shape == (2, 6), 'incorrect table shape'
+    assert list(peaks.attrs['columns']) == list(dataprep.PEAK_COLUMNS), 'columns not named'
+    assert peaks.compression == 'gzip', 'table is not compressed'
+    assert peaks.maxshape == (None, 6), 'table cannot be extended'
+    assert np.array_equal(peaks[()], fit_result), 'peaks not stored correctly'
+    hdf5.close()
+    os.remove('table_test.hdf5')
+
+
+def test_read_peaks():
+    """docstring"""
+    hdf5 = h5py.File('ramannoodles/tests/test_files/dataprep_experiment.hdf5', 'r')
+    peaks = dataprep.read_peaks(hdf5['300C/25s'])
+    assert peaks.shape == (16, 6), 'incorrect number of peaks read'
+    assert np.array_equal(peaks[0], hdf5['300C/25s/Peak_01'][()]), 'peaks read out of order'
+    assert np.array_equal(peaks[9], hdf5['300C/25s/Peak_10'][()]), 'peaks read out of order'
+    hdf5.close()
+
+
+def test_migrate_peak_tables():
+    """docstring"""
+    shutil.copy('ramannoodles/tests/test_files/dataprep_experiment.hdf5', 'migrate_test.hdf5')
+    hdf5 = h5py.File('migrate_test.hdf5', 'r')
+    expected = dataprep.read_peaks(hdf5['300C/25s'])
+    hdf5.close()
+    assert dataprep.migrate_peak_tables('migrate_test.hdf5') == 1, 'spectrum not converted'
+    assert dataprep.migrate_peak_tables('migrate_test.hdf5') == 0, 'spectrum converted twice'
+    hdf5 = h5py.File('migrate_test.hdf5', 'r')
+    assert list(hdf5['300C/25s'].keys()) == ['counts', 'peaks', 'wavenumber'], """
+    Peak_NN datasets were not replaced by a table"""
+    assert np.array_equal(dataprep.read_peaks(hdf5['300C/25s']), expected), """
+    peaks changed during conversion"""
+    hdf5.close()
+    # readers handle the table layout
+    dataprep.view_hdf5('migrate_test.hdf5')
+    dataprep.plot_fit('migrate_test.hdf5', '300C/25s')
+    try:
+        dataprep.migrate_peak_tables(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.migrate_peak_tables('test.txt')
+    except TypeError:
+        print('A .txt was passed to the function, and it was handled well with a TypeError.')
+    os.remove('migrate_test.hdf5')
+
+
+def test_load_spectrum():
+    """docstring"""
+    csv_filename = 'ramannoodles/tests/test_files/FA_3.6wt__300C_25s.csv'
+    x_data, y_data = dataprep.load_spectrum(csv_filename)
+    data = pd.read_csv(csv_filename, header=None, names=('x', 'y'))
+    assert x_data.dtype == np.float64, 'output is not float64'
+    assert x_data.flags['C_CONTIGUOUS'] and y_data.flags['C_CONTIGUOUS'], 'output not contiguous'
+    assert x_data[0] < x_data[-1], 'data not listed from smallest wavenumber first'
+    assert np.allclose(np.sort(data['x'].values), x_data), 'x data (wavenumber) not read correctly'
+    # .txt files with any whitespace between the columns
+    np.savetxt('load_test.txt', np.column_stack((x_data, y_data)), delimiter='\t')
+    assert np.array_equal(dataprep.load_spectrum('load_test.txt')[1], y_data), """
+    .txt file not read correctly"""
+    os.remove('load_test.txt')
+    # .xlsx files are converted once into the cache
+    xlsx_filename = 'ramannoodles/tests/test_files/Methane_Baseline_Calibration.xlsx'
+    x_data, y_data = dataprep.load_spectrum(xlsx_filename, cache_dir='load_cache_test')
+    assert len(os.listdir('load_cache_test')) == 1, 'converted .xlsx file not cached'
+    cached = dataprep.load_spectrum(xlsx_filename, cache_dir='load_cache_test')
+    assert np.array_equal(cached[0], x_data), 'cached x data does not match'
+    assert np.array_equal(cached[1], y_data), 'cached y data does not match'
+    assert np.array_equal(dataprep.load_spectrum(xlsx_filename)[1], y_data), """
+    cached data does not match the workbook"""
+    shutil.rmtree('load_cache_test')
+    # test inputs
+    try:
+        dataprep.load_spectrum(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.load_spectrum('test.hdf5')
+    except TypeError:
+        print('A .hdf5 was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.load_spectrum(csv_filename, cache_dir=4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_write_cube():
+    """docstring"""
+    shutil.copy('ramannoodles/tests/test_files/dataprep_experiment.hdf5', 'cube_test.hdf5')
+    hdf5 = h5py.File('cube_test.hdf5', 'r+')
+    counts = hdf5['300C/25s/counts'][()]
+    hdf5['300C/5s/wavenumber'] = hdf5['300C/25s/wavenumber'][()]
+    hdf5['300C/5s/counts'] = counts / 2
+    hdf5['50C/5s/wavenumber'] = hdf5['300C/25s/wavenumber'][()]
+    hdf5['50C/5s/counts'] = counts / 4
+    hdf5.close()
+    assert dataprep.write_cube('cube_test.hdf5') == (2, 2, len(counts)), 'wrong cube shape'
+    hdf5 = h5py.File('cube_test.hdf5', 'r')
+    cube = hdf5['cube']
+    assert [label.decode() for label in cube['temperature'][()]] == ['50C', '300C'], """
+    temperatures not sorted numerically"""
+    assert [label.decode() for label in cube['time'][()]] == ['5s', '25s'], """
+    times not sorted numerically"""
+    assert cube['counts'].chunks is None, 'cube is not stored contiguously'
+    assert np.array_equal(cube['counts'][1, 1], counts), 'spectrum not copied into the cube'
+    assert np.isnan(cube['counts'][0, 1]).all(), 'missing spectrum not filled with NaN'
+    hdf5.close()
+    try:
+        dataprep.write_cube(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.write_cube('test.txt')
+    except TypeError:
+        print('A .txt was passed to the function, and it was handled well with a TypeError.')
+    os.remove('cube_test.hdf5')
+
+
+def test_spectrum_cube():
+    """docstring"""
+    shutil.copy('ramannoodles/tests/test_files/dataprep_experiment.hdf5', 'cube_test.hdf5')
+    hdf5 = h5py.File('cube_test.hdf5', 'r+')
+    counts = hdf5['300C/25s/counts'][()]
+    hdf5['300C/5s/wavenumber'] = hdf5['300C/25s/wavenumber'][()]
+    hdf5['300C/5s/counts'] = counts / 2
+    hdf5.close()
+    # without a cube dataset, spectra are read one at a time
+    with dataprep.SpectrumCube('cube_test.hdf5') as cube:
+        assert cube.shape == (1, 2, len(counts)), 'wrong cube shape'
+        assert cube.time == ['5s', '25s'], 'times not sorted numerically'
+        lazy = cube[:]
+        assert np.array_equal(cube[0, 1], counts), 'spectrum not read correctly'
+        assert cube[:, :, 10].shape == (1, 2), 'kinetics slice has the wrong shape'
+    dataprep.write_cube('cube_test.hdf5')
+    with dataprep.SpectrumCube('cube_test.hdf5') as cube:
+        assert isinstance(cube[0], np.memmap), 'cube not mapped into memory'
+        assert np.array_equal(cube[:], lazy), 'mapped cube differs from the spectra'
+        assert np.array_equal(cube[0, :, 10], counts[10]*np.array([0.5, 1])), """
+        kinetics slice not read correctly"""
+    try:
+        dataprep.SpectrumCube(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        dataprep.SpectrumCube('test.txt')
+    except TypeError:
+        print('A .txt was passed to the function, and it was handled well with a TypeError.')
+    os.remove('cube_test.hdf5')
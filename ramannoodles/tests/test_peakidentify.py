@@ -2,7 +2,13 @@
 Module used to unit test the functionality and outputs of the peakidentify.py module
 """
 # IMPORTING MODULES
+import contextlib
+import io
+import math
+import os
 import pickle
+import shutil
+import h5py
 import numpy as np
 from ramannoodles import peakidentify
 from ramannoodles import shoyu
@@ -58,6 +64,67 @@ def test_peak_assignment():
         print("An invalid plot value was passed to the function, and it "
               "was handled well with a TypeError.")
 
+    try:
+        peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list, precision,
+                                     False, fit_cache='cache')
+    except TypeError:
+        print("An invalid fit_cache value was passed to the function, and it "
+              "was handled well with a TypeError.")
+
+    contributions = peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list,
+                                                 precision, False, method='unmix')
+    assert sorted(contributions) == sorted(compound['title']
+                                           for compound in known_compound_list), """The
+    contributions are not keyed by the known compounds."""
+    for title, weight in [('WATER', 1), ('CARBON MONOXIDE', 1), ('CARBON DIOXIDE', 0)]:
+        assert math.isclose(contributions[title], weight, abs_tol=1e-6), """The
+        unknown was not unmixed into its compounds."""
+
+    peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list, precision,
+                                 False, top=2)
+
+    try:
+        peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list, precision,
+                                     False, top='2')
+    except TypeError:
+        print("An invalid top value was passed to the function, and it "
+              "was handled well with a TypeError.")
+
+    try:
+        peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list, precision,
+                                     False, method='fit')
+    except ValueError:
+        print("An invalid method value was passed to the function, and it "
+              "was handled well with a ValueError.")
+
+    try:
+        peakidentify.peak_assignment(unknown_x, unknown_y, known_compound_list, precision,
+                                     False, method='unmix', library='library')
+    except TypeError:
+        print("An invalid library value was passed to the function, and it "
+              "was handled well with a TypeError.")
+
+    #The key of n-pentane in shoyu_data_dict is not its title.
+    pentane = shoyu_data_dict['N-PENTANE']
+    library = peakidentify.SpectralLibrary(shoyu_data_dict)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        peakidentify.peak_assignment(pentane['x'], pentane['y'], [compound_1, pentane],
+                                     precision, False, library=library, top=1)
+    assert "The peaks that we found for n-PENTANE" in output.getvalue(), """The
+    screened compound was not matched to its known compound."""
+    assert "The peaks that we found for WATER" not in output.getvalue(), """A
+    compound that was not screened was compared."""
+
+    try:
+        peakidentify.peak_assignment(pentane['x'], pentane['y'], [compound_1], precision,
+                                     False, library=library, top=1)
+    except ValueError:
+        print("No known compound was left after screening, and it "
+              "was handled well with a ValueError.")
+    else:
+        raise AssertionError("An empty screen did not raise a ValueError.")
+
 def test_compare_unknown_to_known():
     """This function tests the operation of the compare_unknown_to_known
     function in peakidentify.py"""
@@ -482,3 +549,334 @@ def test_score_sort():
         is sorted from smallest to largest"""
         assert arrsortedscores[0][0][i] <= arrsortedscores[0][0][i+1], """Output
         values is sorted from smallest to largest"""
+
+
+def test_reference_peaks():
+    """This function tests the operation of the reference_peaks function in peakidentify.py"""
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    compound = shoyu_data_dict['WATER']
+    cache_dir = 'reference_cache_test'
+    report = spectrafit.compound_report(compound)
+    assert np.allclose(peakidentify.reference_peaks(compound)[0], report[0]), """The
+    peaks do not match compound_report."""
+    cached = peakidentify.reference_peaks(compound, spectrafit.FitCache(cache_dir))
+    assert np.allclose(cached[0], report[0]), "The peaks do not match compound_report."
+    assert len(os.listdir(cache_dir)) == 1, "The fit was not saved to the cache."
+    #Overwrite the entry to confirm that the next call reads it instead of refitting.
+    key = spectrafit.FitCache.key('compound_report', compound['x'], compound['y'])
+    np.savez(os.path.join(cache_dir, key + '.npz'), center=[1.0], sigma=[2.0],
+             amplitude=[3.0], xmin=4.0, xmax=5.0)
+    cache = spectrafit.FitCache(cache_dir)
+    assert peakidentify.reference_peaks(compound, cache)[0] == [1.0], """The
+    cached peaks were not used."""
+    #Changed data gets its own entry.
+    changed = dict(compound)
+    changed['y'] = 2*compound['y']
+    peakidentify.reference_peaks(changed, cache)
+    assert len(os.listdir(cache_dir)) == 2, "Changed data did not get a new cache entry."
+    assert (cache.hits, cache.misses) == (1, 1), "The cache did not count its lookups."
+    shutil.rmtree(cache_dir)
+
+    try:
+        peakidentify.reference_peaks('WATER', cache)
+    except TypeError:
+        print("An invalid compound was passed to the function, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.reference_peaks(compound, cache_dir)
+    except TypeError:
+        print("An invalid cache was passed to the function, "
+              "and was handled correctly.")
+
+
+def test_match_library():
+    """This function tests the operation of the match_library
+    function in peakidentify.py"""
+    known_peaks = [[500, 1000, 1500], [1030, 2500], [], [3000.5]]
+    unknown_peaks = [1000, 1505, 2600, 3000]
+
+    try:
+        peakidentify.match_library(1, known_peaks)
+    except TypeError:
+        print("An invalid unknown_peaks value was passed to the function, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.match_library(unknown_peaks, 'known_peaks')
+    except TypeError:
+        print("An invalid known_compound_peaks value was passed to the function, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.match_library(unknown_peaks, known_peaks, 'precision')
+    except TypeError:
+        print("An invalid precision value was passed to the function, and "
+              "was handled correctly.")
+
+    try:
+        peakidentify.match_library(unknown_peaks, known_peaks, score='score')
+    except TypeError:
+        print("An invalid score value was passed to the function, and "
+              "was handled correctly.")
+
+    matches = peakidentify.match_library(unknown_peaks, known_peaks)
+    assert isinstance(matches, np.ndarray), "Function is not returning an ndarray"
+    assert matches.shape == (4, 4), "Output should have one row per compound"
+    #1000 is within 3% of 1030 (30 <= 30.9), but 2600 is not within 3% of 2500.
+    expected = np.array([[1, 1, 0, 0],
+                         [1, 0, 0, 0],
+                         [0, 0, 0, 0],
+                         [0, 0, 0, 1]])
+    assert np.array_equal(matches, expected), "Library matching is not correct"
+
+    scores = peakidentify.match_library(unknown_peaks, known_peaks, score=True)
+    #1 / (distance + 1) to the closest peak, or 0 when that is not above 0.02.
+    expected = np.array([[1, 1/6, 0, 0],
+                         [1/31, 0, 0, 0],
+                         [0, 0, 0, 0],
+                         [0, 0, 0, 1/1.5]])
+    assert np.allclose(scores, expected, rtol=0, atol=1e-12), "Library scores are not correct"
+
+    #Compare a larger random library with the nested loop of math.isclose tests.
+    generator = np.random.RandomState(0)
+    unknown_peaks = generator.uniform(100, 4000, 40).round(1)
+    known_peaks = [generator.uniform(100, 4000, generator.randint(0, 12)).round(1).tolist()
+                   for _ in range(25)]
+    expected = np.zeros((len(known_peaks), len(unknown_peaks)))
+    for i, known in enumerate(known_peaks):
+        for j, unknown in enumerate(unknown_peaks):
+            for peak in known:
+                if math.isclose(unknown, peak, rel_tol=0.03):
+                    expected[i][j] = 1
+    assert np.array_equal(peakidentify.match_library(unknown_peaks, known_peaks), expected), """
+    Library matching does not agree with math.isclose."""
+
+
+def test_peak_index():
+    """This function tests the operation of the PeakIndex class in peakidentify.py"""
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    library = {'WATER': shoyu_data_dict['WATER'],
+               'CARBON MONOXIDE': shoyu_data_dict['CARBON MONOXIDE']}
+    index = peakidentify.PeakIndex(library)
+    assert len(index) == 2, "Not every compound was added to the index."
+    water_peaks = spectrafit.compound_report(library['WATER'])[0]
+    assert index.query(water_peaks)[0] == ('WATER', len(water_peaks)), """The
+    compound was not the best candidate for its own peaks."""
+
+    #Compare the ranking to the rows of match_library.
+    known_peaks = [[500, 1000, 1500], [1030, 2500], [], [3000.5]]
+    unknown_peaks = [1000, 1505, 2600, 3000]
+    index = peakidentify.PeakIndex(bin_width=25)
+    for i, _ in enumerate(known_peaks):
+        index.add_peaks('compound {}'.format(i), known_peaks[i])
+    for score in [False, True]:
+        matches = peakidentify.match_library(unknown_peaks, known_peaks, score=score)
+        expected = {'compound {}'.format(i): matches[i].sum()
+                    for i, _ in enumerate(known_peaks) if matches[i].sum() > 0}
+        assert dict(index.query(unknown_peaks, score=score)) == expected, """The
+        index does not agree with match_library."""
+    assert index.query(unknown_peaks, top=1) == [('compound 0', 2)], """The
+    best candidate was not returned first."""
+    index.add_peaks('compound 2', [2600])
+    assert ('compound 2', 1) in index.query(unknown_peaks), """A compound added
+    to the index was not found."""
+    index.remove('compound 2')
+    assert 'compound 2' not in index, "The compound was not removed."
+    assert index.query([2600]) == [], "A removed compound was still found."
+    assert math.floor(2600 / 25) not in index.bins, "An emptied bin was not dropped."
+    index.add_peaks('compound 0', [2500])
+    assert sorted(entry[0] for entry in index.bins[100]) == ['compound 0', 'compound 1'], """
+    The peaks of a re-added compound were not replaced."""
+    assert index.query([500]) == [], "The replaced peaks of a compound were still found."
+
+    try:
+        peakidentify.PeakIndex(bin_width='10')
+    except TypeError:
+        print("An invalid bin_width was passed to the class, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.PeakIndex(bin_width=0)
+    except ValueError:
+        print("A bin_width out of bounds was passed to the class, "
+              "and was handled correctly.")
+
+    try:
+        index.add('WATER', [1, 2, 3])
+    except TypeError:
+        print("An invalid compound was passed to the index, "
+              "and was handled correctly.")
+
+    try:
+        index.query('unknown_peaks')
+    except TypeError:
+        print("An invalid unknown_peaks value was passed to the index, "
+              "and was handled correctly.")
+
+    try:
+        index.query(unknown_peaks, top=1.5)
+    except TypeError:
+        print("An invalid top value was passed to the index, "
+              "and was handled correctly.")
+
+
+def test_spectral_library():
+    """This function tests the operation of the SpectralLibrary class in peakidentify.py"""
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    library = peakidentify.SpectralLibrary(shoyu_data_dict)
+    assert len(library) == len(shoyu_data_dict), "Not every compound was resampled."
+    grid, spectra = shoyu.resample_spectra(list(shoyu_data_dict.values()))
+    assert np.array_equal(library.grid, grid), "The library grid is not correct."
+    assert np.allclose(library.gram, spectra @ spectra.T), "The Gram matrix is not correct."
+
+    #A mixture of library spectra is unmixed into its known weights.
+    weights = np.zeros(len(library))
+    weights[library.labels.index('WATER')] = 0.7
+    weights[library.labels.index('CARBON MONOXIDE')] = 0.3
+    found, residual = library.unmix(grid, weights @ spectra)
+    assert np.allclose(found, weights, atol=1e-6), "The mixture was not unmixed."
+    assert residual < 1e-6, "The residual of an exact mixture is not zero."
+    batch = np.random.RandomState(0).uniform(0, 1, (3, len(library)))
+    found, residual = library.unmix(grid, batch @ spectra)
+    assert found.shape == batch.shape, "A batch was not unmixed per unknown."
+    assert np.allclose(found, batch, atol=1e-6), "The batch was not unmixed."
+    assert (library.unmix(grid, -spectra[0])[0] == 0).all(), """The contributions
+    are not non-negative."""
+
+    #The resampled library is stored and loaded again.
+    filename = 'spectral_library_test.npz'
+    library.save(filename)
+    loaded = peakidentify.SpectralLibrary.load(filename)
+    os.remove(filename)
+    assert loaded.labels == library.labels, "The labels were not stored."
+    assert np.array_equal(loaded.matrix, library.matrix), "The matrix was not stored."
+    assert np.allclose(loaded.unmix(grid, weights @ spectra)[0], weights, atol=1e-6), """The
+    loaded library does not unmix the mixture."""
+
+    try:
+        peakidentify.SpectralLibrary([1, 2, 3])
+    except TypeError:
+        print("An invalid library was passed to the class, "
+              "and was handled correctly.")
+
+    try:
+        library.unmix(grid, [1, 2, 3])
+    except TypeError:
+        print("An invalid unknown_y was passed to the library, "
+              "and was handled correctly.")
+
+    try:
+        library.unmix(grid, np.zeros(3))
+    except ValueError:
+        print("An unknown_y of the wrong length was passed to the library, "
+              "and was handled correctly.")
+
+
+def test_spectral_library_screen():
+    """This function tests the operation of the screen method of the SpectralLibrary class
+    in peakidentify.py"""
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    library = peakidentify.SpectralLibrary(shoyu_data_dict)
+    unknown_x, unknown_y = shoyu.combine_spectra(shoyu_data_dict['WATER'],
+                                                 shoyu_data_dict['CARBON MONOXIDE'], plot=False)
+    candidates = library.screen(np.asarray(unknown_x), np.asarray(unknown_y), top=3)
+    assert len(candidates) == 3, "The number of candidates is not top."
+    assert candidates[0][0] == 'WATER', "The main compound was not the best candidate."
+    assert [value for _, value in candidates] == sorted([value for _, value in candidates],
+                                                        reverse=True), """The candidates
+    are not ordered by correlation."""
+
+    #A compound shifted by less than max_shift still correlates fully with itself.
+    spectrum = library.matrix[library.labels.index('CARBON DIOXIDE')]
+    label, value = library.screen(library.grid + 4, spectrum, top=1)[0]
+    assert label == 'CARBON DIOXIDE' and np.isclose(value, 1, atol=1e-3), """The shifted
+    compound was not found."""
+    assert library.screen(library.grid + 4, spectrum, max_shift=0)[0][1] < value, """The
+    shift was not searched."""
+    batch = library.screen(library.grid, library.matrix, top=1)
+    assert [candidates[0][0] for candidates in batch] == library.labels, """Each compound of
+    a batch was not its own best candidate."""
+
+    try:
+        library.screen(library.grid, spectrum, top=1.5)
+    except TypeError:
+        print("An invalid top value was passed to the library, "
+              "and was handled correctly.")
+
+    try:
+        library.screen(library.grid, spectrum, max_shift='10')
+    except TypeError:
+        print("An invalid max_shift value was passed to the library, "
+              "and was handled correctly.")
+
+
+def test_embedding_index():
+    """This function tests the operation of the EmbeddingIndex class in peakidentify.py"""
+    shoyu_data_dict = pickle.load(open('raman_spectra/shoyu_data_dict.p', 'rb'))
+    grid, spectra = shoyu.resample_spectra(list(shoyu_data_dict.values()))
+    labels = list(shoyu_data_dict)
+    for projection in ['pca', 'random']:
+        filename = 'embedding_index_test.hdf5'
+        index = peakidentify.EmbeddingIndex(filename, grid, dimensions=4, n_lists=3,
+                                            projection=projection)
+        index.update({label: shoyu_data_dict[label] for label in labels[:6]})
+        assert len(index) == 6, "Not every compound was added to the index."
+        #Compounds added later are embedded with the projection fit to the first ones.
+        for label in labels[6:]:
+            index.add(label, shoyu_data_dict[label])
+        index = peakidentify.EmbeddingIndex(filename)
+        assert sorted(index) == sorted(labels), "The index was not stored in the file."
+        #Compounds in micrometers cover the same few grid points, so only the distance
+        #of each compound to itself is checked.
+        candidates = index.query(grid, spectra, top=None, n_probe=1)
+        assert np.allclose([dict(found).get(label, 1) for label, found in
+                            zip(labels, candidates)], 0, atol=1e-5), """Each compound was
+        not its own nearest neighbour."""
+        assert index.query(grid, spectra[0], top=1)[0][0] == 'WATER', """The compound was
+        not the best candidate for its own spectrum."""
+        assert len(index.query(grid, spectra[0], top=None, n_probe=3)) == len(labels), """Not
+        every list was searched."""
+        index.add('WATER', shoyu_data_dict['WATER'])
+        assert len(index) == len(labels), "A compound added again was not replaced."
+        index.remove('WATER')
+        assert 'WATER' not in index, "The compound was not removed."
+        os.remove(filename)
+
+    #Compounds added one at a time are buffered and searched exactly until the projection
+    #can be fit, and the lists are split as a trained index grows.
+    filename = 'embedding_index_test.hdf5'
+    index = peakidentify.EmbeddingIndex(filename)
+    for label in labels:
+        index.add(label, shoyu_data_dict[label])
+    assert len(index) == len(labels), "Not every compound was added to the index."
+    assert index.query(grid, spectra[0], top=1)[0][0] == 'WATER', """The compound was not
+    found before the index was trained."""
+    os.remove(filename)
+    index = peakidentify.EmbeddingIndex(filename, dimensions=4, projection='random')
+    for label in labels:
+        index.add(label, shoyu_data_dict[label])
+    with h5py.File(filename, 'r') as stored:
+        assert len(stored['centroids']) > 1, "The list was not split as the index grew."
+    assert np.allclose([dict(found).get(label, 1) for label, found in zip(
+        labels, index.query(grid, spectra, top=None))], 0, atol=1e-5), """A compound was
+    lost when a list was split."""
+    os.remove(filename)
+
+    try:
+        peakidentify.EmbeddingIndex('embedding_index_test.h5')
+    except TypeError:
+        print("An invalid filename was passed to the class, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.EmbeddingIndex('embedding_index_test.hdf5', projection='umap')
+    except ValueError:
+        print("An invalid projection was passed to the class, "
+              "and was handled correctly.")
+
+    try:
+        peakidentify.EmbeddingIndex('embedding_index_test.hdf5', dimensions=4.5)
+    except TypeError:
+        print("An invalid dimensions value was passed to the class, "
+              "and was handled correctly.")
@@ -2,9 +2,15 @@
 Test functions for the shoyu.py module
 """
 
+import functools
+import http.server
 import os
 import pickle
+import tempfile
+import threading
+import h5py
 import numpy as np
+from ramannoodles import peakidentify
 from ramannoodles import shoyu
 
 # open spectra library
@@ -45,6 +51,63 @@ def test_add_jdx():
         print('An int was passed to the function, and it was handled well with a TypeError.')
 
 
+def test_read_jdx():
+    """
+    Test function that confirms that read_jdx gives the same data as the jcamp reader used to
+    build the bundled library, and that compressed and (XY..XY) tables are decoded.
+    """
+    for filename in sorted(os.listdir('raman_spectra')):
+        if not filename.endswith('.jdx'):
+            continue
+        data = shoyu.read_jdx('raman_spectra/'+filename)
+        reference = SHOYU_DATA_DICT[data['title'].upper()]
+        assert list(data) == list(reference), 'records not read in order'
+        for label, value in reference.items():
+            if label in ('x', 'filename'):
+                continue
+            if label == 'y':
+                assert np.array_equal(1 - data['y'], value), 'y data not read correctly'
+            elif label != 'yunits':
+                assert value == data[label] and isinstance(data[label], type(value)), \
+                    'record {} not read correctly'.format(label)
+        assert np.array_equal(data['x'], reference['x']), 'x data not read correctly'
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'compressed.jdx')
+        with open(filename, 'w') as jdx_file:
+            # SQZ, DIF and DUP forms, with a y check value starting the second line
+            jdx_file.write('##TITLE=TEST\n##YFACTOR=0.5\n##FIRSTX=100\n##LASTX=109\n'
+                           '##XYDATA=(X++(Y..Y))\nA00A0K%TLm\nA05A1%Rk5%\n##END=\n')
+        data = shoyu.read_jdx(filename)
+        assert np.array_equal(data['x'], np.arange(100, 110)), 'x data not decoded'
+        assert np.array_equal(data['y'], 0.5*np.array([10, 12, 12, 12, 15, 11, 11, 20, -5, -5])), \
+            'y data not decoded'
+        with open(filename, 'w') as jdx_file:
+            jdx_file.write('##TITLE=TEST\n##PEAK TABLE=(XY..XY)\n1.5,-2.0; 3E+01 -4.5e-1\n'
+                           '4-5\n##END=\n')
+        data = shoyu.read_jdx(filename)
+        assert np.array_equal(data['x'], [1.5, 30, 4]), 'x data not read'
+        assert np.array_equal(data['y'], [-2, -0.45, -5]), 'y data not read'
+    try:
+        shoyu.read_jdx(1)
+    except TypeError:
+        print('An int was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_read_jdx_dir():
+    """
+    Test function that confirms that every .jdx file of a directory is read, in parallel,
+    with the same data as read_jdx.
+    """
+    library = shoyu.read_jdx_dir('raman_spectra', workers=2)
+    assert len(library) == 8, 'not every .jdx file read'
+    for filename, data in library.items():
+        assert np.array_equal(data['y'], shoyu.read_jdx(filename)['y']), 'file not read'
+    try:
+        shoyu.read_jdx_dir('raman_spectra', workers='2')
+    except TypeError:
+        print('A string was passed to the function, and it was handled well with a TypeError.')
+
+
 def test_initialize_standard_library():
     """
     Test function that confirms the raman_spectra/ directory is created, the .jdx files are
@@ -72,6 +135,93 @@ def test_more_please():
         print('An int was passed to the function, and it was handled well with a TypeError.')
 
 
+def test_fetch_jdx():
+    """
+    Test function that confirms that .jdx files are fetched from a local directory mirror
+    and from an http mirror, that files already fetched are kept, and that missing CAS
+    numbers are returned with the reason they were not fetched.
+    """
+    cas_nums = ['7732-18-5', '124-38-9', '630-08-0']
+    with tempfile.TemporaryDirectory() as directory:
+        results = shoyu.fetch_jdx(cas_nums + ['1-23-4'], directory=directory,
+                                  mirror='raman_spectra', workers=2)
+        assert [cas_num for cas_num, _, _ in results] == ['7732185', '124389', '630080',
+                                                          '1234'], 'results out of order'
+        for cas_num, filename, error in results[:3]:
+            assert error is None, 'error returned for a fetched file'
+            assert open(filename, 'rb').read() == open(
+                'raman_spectra/'+cas_num+'_NIST_IR.jdx', 'rb').read(), 'file not copied'
+        assert results[3][1] is None and 'not in mirror' in results[3][2], \
+            'missing file not reported'
+        # files already in the directory are not fetched again
+        assert shoyu.fetch_jdx(cas_nums, directory=directory,
+                               mirror=directory+'/missing') == results[:3], 'file refetched'
+        try:
+            shoyu.more_please('1-23-4', mirror='raman_spectra')
+        except OSError:
+            print('A CAS number missing from the mirror was handled well with an OSError.')
+        else:
+            raise AssertionError('a missing file did not raise an OSError')
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler,
+                                directory='raman_spectra')
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        mirror = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        with tempfile.TemporaryDirectory() as directory:
+            results = shoyu.fetch_jdx(cas_nums + ['1-23-4'], directory=directory,
+                                      mirror=mirror, retries=0)
+            assert [filename is not None for _, filename, _ in results] == \
+                [True, True, True, False], 'http fetch failed'
+            assert results[3][2] == 'request status: 404', 'wrong error returned'
+            assert open(results[0][1], 'rb').read() == open(
+                'raman_spectra/7732185_NIST_IR.jdx', 'rb').read(), 'file not downloaded'
+            assert not [name for name in os.listdir(directory) if name.endswith('.tmp')], \
+                'temporary file left behind'
+    finally:
+        server.shutdown()
+        server.server_close()
+    try:
+        shoyu.fetch_jdx('7732185')
+    except TypeError:
+        print('A string was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.fetch_jdx([7732185])
+    except TypeError:
+        print('An int was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.fetch_jdx(cas_nums, mirror=1)
+    except TypeError:
+        print('An int was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_download_library():
+    """
+    Test function that confirms that compounds fetched from a mirror are all added to a new
+    shoyu_data_dict.p, and to a store.
+    """
+    cas_nums = ['7732-18-5', '124-38-9']
+    with tempfile.TemporaryDirectory() as directory:
+        shoyu_data_dict = shoyu.download_library(cas_nums, directory=directory,
+                                                 mirror='raman_spectra')
+        assert sorted(shoyu_data_dict) == ['CARBON DIOXIDE', 'WATER'], 'compounds not added'
+        assert shoyu_data_dict['WATER']['yunits'] == 'ABSORBANCE', 'Incorrect y units stored'
+        assert sorted(pickle.load(open(os.path.join(directory, 'shoyu_data_dict.p'), 'rb'))) \
+            == ['CARBON DIOXIDE', 'WATER'], 'shoyu_data_dict.p not written'
+        store = shoyu.ShoyuStore(os.path.join(directory, 'library.hdf5'))
+        index = peakidentify.EmbeddingIndex(os.path.join(directory, 'index.hdf5'),
+                                            projection='random')
+        shoyu.download_library(cas_nums[:1], store=store, index=index, directory=directory,
+                               mirror='raman_spectra')
+        assert list(store) == ['WATER'], 'compound not added to the store'
+        assert list(index) == ['WATER'], 'compound not added to the index'
+    try:
+        shoyu.download_library(cas_nums, store='store')
+    except TypeError:
+        print('A string was passed to the function, and it was handled well with a TypeError.')
+
+
 def test_clean_spectra():
     """
     Test function for shoyu.clean_spectra. It verifies that the output type is correct,
@@ -153,3 +303,197 @@ def test_combine_spectra():
         shoyu.combine_spectra(compound_1, [1, 2, 3, 4])
     except TypeError:
         print('A list was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_shoyu_store():
+    """
+    Test function that confirms that shoyu.ShoyuStore behaves like shoyu_data_dict. It checks
+    that compounds are returned as the same dictionaries that were added, that keys keep their
+    order, that single compounds can be replaced and deleted, that the library persists when
+    the file is reopened, and that bad input types are handled well.
+    """
+    store = shoyu.ShoyuStore('store_test.hdf5')
+    assert len(store) == 0, 'new store is not empty'
+    store.update(SHOYU_DATA_DICT)
+    assert list(store) == list(SHOYU_DATA_DICT), 'compound keys or their order were not kept'
+    water = store['WATER']
+    assert isinstance(water, dict), 'compound is not returned as a dictionary'
+    assert set(water) == set(SHOYU_DATA_DICT['WATER']), 'compound fields were not all stored'
+    assert np.array_equal(water['x'], SHOYU_DATA_DICT['WATER']['x']), 'x data not stored correctly'
+    assert np.array_equal(water['y'], SHOYU_DATA_DICT['WATER']['y']), 'y data not stored correctly'
+    assert water['title'] == 'WATER', 'header values not stored correctly'
+    store['a/b label'] = SHOYU_DATA_DICT['WATER']
+    assert 'a/b label' in store, 'keys containing a / were not stored'
+    del store['a/b label']
+    assert 'a/b label' not in store, 'compound was not deleted'
+    reopened = shoyu.ShoyuStore('store_test.hdf5')
+    assert len(reopened) == len(SHOYU_DATA_DICT), 'library did not persist in the file'
+    try:
+        store['NOT A COMPOUND']
+    except KeyError:
+        print('A missing key was requested, and it was handled well with a KeyError.')
+    try:
+        store['WATER'] = [1, 2, 3]
+    except TypeError:
+        print('A list was passed to the store, and it was handled well with a TypeError.')
+    try:
+        shoyu.ShoyuStore(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.ShoyuStore('store_test.p')
+    except TypeError:
+        print('A .p file was passed to the function, and it was handled well with a TypeError.')
+    os.remove('store_test.hdf5')
+
+
+def test_library_from_pickle():
+    """
+    Test function that confirms that shoyu.library_from_pickle copies every compound of
+    shoyu_data_dict.p into a ShoyuStore that works with combine_spectra.
+    """
+    store = shoyu.library_from_pickle('raman_spectra/shoyu_data_dict.p', 'pickle_test.hdf5')
+    assert isinstance(store, shoyu.ShoyuStore), 'output is not a ShoyuStore'
+    assert list(store) == list(SHOYU_DATA_DICT), 'not all compounds were copied'
+    data = shoyu.combine_spectra(store['WATER'], store['CARBON MONOXIDE'])
+    expected = shoyu.combine_spectra(SHOYU_DATA_DICT['WATER'], SHOYU_DATA_DICT['CARBON MONOXIDE'])
+    assert np.allclose(data[1], expected[1]), 'stored compounds do not combine like the originals'
+    try:
+        shoyu.library_from_pickle(4.2, 'pickle_test.hdf5')
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    os.remove('pickle_test.hdf5')
+
+
+def test_resample_spectra():
+    """
+    Test function for shoyu.resample_spectra. It checks that every compound is resampled
+    onto the shared integer grid, that it agrees with interpolate_spectra inside the range
+    of the compound and is zero outside it, and that bad input types are handled well.
+    """
+    compounds = [SHOYU_DATA_DICT['WATER'], SHOYU_DATA_DICT['CARBON MONOXIDE']]
+    grid, spectra = shoyu.resample_spectra(compounds)
+    assert spectra.shape == (2, len(grid)), 'output shape not correct'
+    assert np.array_equal(grid, np.arange(grid[0], grid[-1]+1)), 'grid is not integer spaced'
+    comp_data_int = shoyu.interpolate_spectra(shoyu.clean_spectra(compounds[1]))
+    x_comp, y_comp = zip(*comp_data_int)
+    inside = np.isin(grid, x_comp[10:-10])
+    assert np.allclose(spectra[1, inside], y_comp[10:-10]), """
+    resampled spectra do not match interpolate_spectra"""
+    assert not spectra[1, grid < min(x_comp)-2].any(), 'spectra not zero outside their range'
+    grid, spectra = shoyu.resample_spectra(compounds, grid=np.arange(1000, 2000, 0.5))
+    assert spectra.shape == (2, 2000), 'custom grid not used'
+    try:
+        shoyu.resample_spectra(SHOYU_DATA_DICT['WATER'])
+    except TypeError:
+        print('A dictionary was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.resample_spectra([[1, 2, 3, 4]])
+    except TypeError:
+        print('A list of lists was passed to the function, and was handled well with a TypeError.')
+
+
+def test_mix_spectra():
+    """
+    Test function for shoyu.mix_spectra. It checks that the default mixture matches
+    combine_spectra, that weights scale the compounds, that a 2-D array of weights gives
+    one mixture per row, and that bad inputs are handled well.
+    """
+    compounds = [SHOYU_DATA_DICT['WATER'], SHOYU_DATA_DICT['CARBON MONOXIDE']]
+    x_combined, y_combined = shoyu.mix_spectra(compounds)
+    expected = shoyu.combine_spectra(compounds[0], compounds[1])
+    assert np.array_equal(x_combined, expected[0]), 'x values differ from combine_spectra'
+    assert np.allclose(y_combined, expected[1]), 'y values differ from combine_spectra'
+    grid, spectra = shoyu.resample_spectra(compounds)
+    _, y_weighted = shoyu.mix_spectra(compounds, weights=[0.5, 2])
+    assert np.allclose(y_weighted, 0.5*spectra[0] + 2*spectra[1]), 'weights not applied'
+    weights = np.random.rand(50, 2)
+    _, mixtures = shoyu.mix_spectra(compounds, weights=weights)
+    assert mixtures.shape == (50, len(grid)), 'not one mixture per row of weights'
+    assert np.allclose(mixtures[7], weights[7] @ spectra), 'mixture rows not correct'
+    try:
+        shoyu.mix_spectra(compounds, weights=2.0)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.mix_spectra(compounds, weights=[1, 2, 3])
+    except ValueError:
+        print('Too many weights were passed, and it was handled well with a ValueError.')
+
+
+def test_generate_mixtures():
+    """
+    Test function for shoyu.generate_mixtures. It checks that every spectrum is written with
+    its labels, that each mixture holds between one and `max_compounds` compounds, that the
+    same seed writes the same corpus, and that bad inputs are handled well.
+    """
+    library = {key: SHOYU_DATA_DICT[key] for key in ['WATER', 'CARBON MONOXIDE', 'N-PENTANE']}
+    n_spectra = shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 250, batch_size=100,
+                                        max_compounds=2, seed=42)
+    assert n_spectra == 250, 'wrong number of spectra reported'
+    with h5py.File('mixtures_test.hdf5', 'r') as hdf5:
+        grid = hdf5['x'][()]
+        counts = hdf5['counts'][()]
+        weights = hdf5['weights'][()]
+        assert counts.shape == (250, len(grid)), 'not every spectrum was written'
+        assert weights.shape == (250, 3), 'not every label was written'
+        assert hdf5['shift'].shape == (250,), 'not every shift was written'
+        assert [label.decode() for label in hdf5['compounds'][()]] == list(library), """
+        compound labels not written"""
+    n_present = (weights > 0).sum(axis=1)
+    assert n_present.min() >= 1 and n_present.max() <= 2, 'wrong number of compounds mixed'
+    assert weights.max() <= 1, 'concentrations outside the given range'
+    # without shift, drift or noise the spectra are the weighted sums of the compounds
+    shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 20, shift=0, drift=0, noise=0,
+                            seed=42)
+    _, spectra = shoyu.resample_spectra(list(library.values()))
+    with h5py.File('mixtures_test.hdf5', 'r') as hdf5:
+        assert np.allclose(hdf5['counts'][()], hdf5['weights'][()] @ spectra, atol=1e-4), """
+        mixtures are not the weighted sums of the compounds"""
+    shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 250, batch_size=100,
+                            max_compounds=2, seed=42)
+    with h5py.File('mixtures_test.hdf5', 'r') as hdf5:
+        assert np.array_equal(hdf5['counts'][()], counts), 'same seed wrote a different corpus'
+    try:
+        shoyu.generate_mixtures([1, 2, 3], 'mixtures_test.hdf5', 10)
+    except TypeError:
+        print('A list was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 10.5)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 0)
+    except ValueError:
+        print('Zero spectra were requested, and it was handled well with a ValueError.')
+    os.remove('mixtures_test.hdf5')
+
+
+def test_mixture_labels():
+    """
+    Test function for shoyu.mixture_labels. It checks that the labels of a spectrum name the
+    compounds it holds with their concentrations, that the peaks are shifted like the spectrum,
+    and that bad input types are handled well.
+    """
+    library = {key: SHOYU_DATA_DICT[key] for key in ['WATER', 'CARBON MONOXIDE']}
+    shoyu.generate_mixtures(library, 'mixtures_test.hdf5', 10, seed=0)
+    with h5py.File('mixtures_test.hdf5', 'r') as hdf5:
+        weights = hdf5['weights'][4]
+        shift = hdf5['shift'][4]
+        peaks = hdf5['peaks'][()]
+    labels, peak_centers = shoyu.mixture_labels('mixtures_test.hdf5', 4)
+    assert set(labels) == {list(library)[i] for i in np.flatnonzero(weights)}, """
+    labels do not name the compounds in the spectrum"""
+    assert all(labels[label] > 0 for label in labels), 'concentrations not read'
+    expected = peaks[weights > 0]
+    expected = np.sort(expected[~np.isnan(expected)]) + shift
+    assert np.allclose(peak_centers, expected), 'peaks not shifted like the spectrum'
+    try:
+        shoyu.mixture_labels(4.2, 1)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        shoyu.mixture_labels('mixtures_test.hdf5', 1.0)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    os.remove('mixtures_test.hdf5')
@@ -2,9 +2,12 @@
 This is the unit test module for spectrafit.py
 """
 
+import os
 import pickle
+import threading
 import numpy as np
 import lmfit
+from peakutils.baseline import baseline
 from ramannoodles import spectrafit
 
 
@@ -113,6 +116,20 @@ def test_set_params():
     except TypeError:
         print("""A list of ints was passed to the function,
          and it was handled well with a TypeError.""")
+    # starting values taken from a previous fit
+    previous = [np.array([0.3, 20.0, peak[0], 5.0, 40.0, peak[1]]) for peak in peaks]
+    pars = spectrafit.set_params(peaks, previous)[1]
+    assert pars['p1_sigma'].value == 20, 'sigma not started from the previous fit'
+    assert pars['p1_amplitude'].value == 5, 'amplitude not started from the previous fit'
+    assert pars['p1_fraction'].value == 0.3, 'fraction not started from the previous fit'
+    try:
+        spectrafit.set_params(peaks, 1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.set_params(peaks, previous[:-1])
+    except ValueError:
+        print('A short previous fit was passed to the function, and was handled well with a ValueError.')
 
 
 def test_model_fit():
@@ -150,6 +167,57 @@ def test_model_fit():
         spectrafit.model_fit(X_TEST, y_test, mod, pars, report='yup!')
     except TypeError:
         print('A string was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.model_fit(X_TEST, y_test, mod, pars, backend=1)
+    except TypeError:
+        print('An int was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.model_fit(X_TEST, y_test, mod, pars, backend='magic')
+    except ValueError:
+        print('An unknown backend was passed to the function, and was handled well with a ValueError.')
+
+
+def test_model_fit_analytic():
+    """
+    Test function that confirms the analytic Jacobian backend of spectrafit.model_fit returns a
+    FitResult that export_fit_data and plot_fit accept, and that it converges to the same
+    peaks as the lmfit backend with fewer model evaluations.
+    """
+    y_test = spectrafit.subtract_baseline(Y_TEST)
+    peaks = spectrafit.peak_detect(X_TEST, y_test)[0]
+    mod, pars = spectrafit.set_params(peaks)
+    out = spectrafit.model_fit(X_TEST, y_test, mod, pars)
+    out_analytic = spectrafit.model_fit(X_TEST, y_test, mod, pars, backend='analytic')
+    assert isinstance(out_analytic, spectrafit.FitResult), 'output is not a FitResult'
+    assert len(out_analytic.best_fit) == len(y_test), 'size of fit incorrect'
+    assert len(out_analytic.values) == len(pars), """
+    number of output values not equal to number of parameters"""
+    assert np.allclose(spectrafit.export_fit_data(out_analytic), spectrafit.export_fit_data(out),
+                       rtol=1e-2, atol=1e-3), 'analytic fit does not match the lmfit fit'
+    assert out_analytic.nfev < out.nfev, 'analytic fit used more function evaluations'
+    spectrafit.plot_fit(X_TEST, y_test, out_analytic, plot_components=True)
+    assert np.allclose(out_analytic.best_fit, out.best_fit, rtol=1e-2, atol=1e-3), """
+    analytic best fit does not match the lmfit best fit"""
+    assert out_analytic.success and out_analytic.njev > 0, 'fit statistics not kept'
+    assert 'p1_center' in out_analytic.fit_report(), 'parameters missing from the report'
+    spectrafit.model_fit(X_TEST, y_test, mod, pars, report=True, backend='analytic')
+
+
+def test_pseudo_voigt_jacobian():
+    """
+    Test function that confirms spectrafit.pseudo_voigt_jacobian matches central finite
+    differences of spectrafit.pseudo_voigt for every parameter.
+    """
+    params = np.array([3.0, 2000.0, 40.0, 0.3])
+    jacobian = spectrafit.pseudo_voigt_jacobian(X_TEST, *params)
+    assert jacobian.shape == (4, len(X_TEST)), 'jacobian is not the expected shape'
+    for i, _ in enumerate(params):
+        step = np.zeros(4)
+        step[i] = 1e-6*max(1, abs(params[i]))
+        finite_difference = (spectrafit.pseudo_voigt(X_TEST, *(params + step))
+                             - spectrafit.pseudo_voigt(X_TEST, *(params - step))) / (2*step[i])
+        assert np.allclose(jacobian[i], finite_difference, atol=1e-9), """
+        derivative {} does not match finite differences""".format(i)
 
 
 def test_plot_fit():
@@ -239,3 +307,349 @@ def test_data_report():
         spectrafit.data_report(compound['x'], 1.2)
     except TypeError:
         print('A float was passed to the function, and was handled well with a TypeError.')
+
+
+def test_pseudo_voigt():
+    """
+    Test function that confirms spectrafit.pseudo_voigt matches the lineshape of the lmfit
+    PseudoVoigtModel used by spectrafit.set_params, and that it broadcasts over peaks.
+    """
+    model = lmfit.models.PseudoVoigtModel()
+    y_lmfit = model.eval(x=X_TEST, amplitude=20, center=2000, sigma=40, fraction=0.3)
+    y_data = spectrafit.pseudo_voigt(X_TEST, 20, 2000, 40, 0.3)
+    assert np.allclose(y_data, y_lmfit), 'profile does not match lmfit.lineshapes.pvoigt'
+    y_stack = spectrafit.pseudo_voigt(X_TEST, np.ones((3, 1)), np.array([[1000], [2000], [3000]]),
+                                      np.full((3, 1), 50), np.full((3, 1), 0.5))
+    assert y_stack.shape == (3, len(X_TEST)), 'peaks were not broadcast against x_data'
+
+
+def test_fit_batch():
+    """
+    Test function that confirms spectrafit.fit_batch behaves as expected. It confirms that the
+    output is a structured array with the export_fit_data columns, that each spectrum in the
+    batch is fit to the same values as the single spectrum lmfit path, and that input errors
+    are handled.
+    """
+    y_test = spectrafit.subtract_baseline(Y_TEST)
+    y_stack = np.vstack([y_test, 2*y_test, np.zeros(len(y_test))])
+    fit_peak_data = spectrafit.fit_batch(X_TEST, y_stack)
+    assert isinstance(fit_peak_data, np.ndarray), 'output is not a numpy array'
+    assert fit_peak_data.dtype == spectrafit.FIT_DTYPE, 'output does not have the fit columns'
+    peaks = spectrafit.peak_detect(X_TEST, y_test)[0]
+    mod, pars = spectrafit.set_params(peaks)
+    out = spectrafit.model_fit(X_TEST, y_test, mod, pars)
+    expected = np.asarray(spectrafit.export_fit_data(out))
+    first = fit_peak_data[fit_peak_data['spectrum'] == 0]
+    assert len(first) == len(expected), 'incorrect number of peaks fit in the first spectrum'
+    assert np.allclose(first['center'], expected[:, 2]), 'peak centers do not match'
+    assert np.allclose(first['sigma'], expected[:, 1], rtol=1e-2), 'sigma does not match lmfit'
+    assert np.allclose(first['amplitude'], expected[:, 3], rtol=1e-2), """
+    amplitude does not match lmfit"""
+    assert np.allclose(first['fwhm'], 2*first['sigma']), 'fwhm is not twice sigma'
+    second = fit_peak_data[fit_peak_data['spectrum'] == 1]
+    assert np.allclose(second['amplitude'], 2*first['amplitude'], rtol=1e-2), """
+    amplitudes of the scaled spectrum are not scaled"""
+    assert not np.any(fit_peak_data['spectrum'] == 2), 'peaks were fit in an empty spectrum'
+    try:
+        spectrafit.fit_batch(1.1, y_stack)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_batch(X_TEST, 1.2)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_batch(X_TEST, y_test)
+    except ValueError:
+        print('A 1-D array was passed to the function, and was handled well with a ValueError.')
+    try:
+        spectrafit.fit_batch(X_TEST, y_stack, batch_size=1.5)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+
+
+def test_peak_windows():
+    """
+    Test function that confirms spectrafit.peak_windows groups overlapping peaks together,
+    keeps well separated peaks apart, and handles input errors.
+    """
+    y_test = spectrafit.subtract_baseline(Y_TEST)
+    peaks = spectrafit.peak_detect(X_TEST, y_test)[0]
+    windows = spectrafit.peak_windows(X_TEST, y_test, peaks)
+    assert isinstance(windows, list), 'output is not a list'
+    assert sum(len(window[2]) for window in windows) == len(peaks), 'peaks lost from windows'
+    for start, stop, cluster in windows:
+        for peak in cluster:
+            assert X_TEST[start] <= peak[0] <= X_TEST[stop-1], 'peak lies outside its window'
+    x_data = np.arange(0, 3000, 1.0)
+    y_data = spectrafit.pseudo_voigt(x_data, np.full((3, 1), 10), np.array([[500], [520], [2500]]),
+                                     np.full((3, 1), 5), np.full((3, 1), 0.5)).sum(axis=0)
+    peaks = spectrafit.peak_detect(x_data, y_data)[0]
+    windows = spectrafit.peak_windows(x_data, y_data, peaks)
+    assert [len(window[2]) for window in windows] == [2, 1], 'peaks were not clustered correctly'
+    assert spectrafit.peak_windows(x_data, y_data, []) == [], 'no peaks should give no windows'
+    try:
+        spectrafit.peak_windows(x_data, y_data, 1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.peak_windows(x_data, y_data, peaks, width_scale='wide')
+    except TypeError:
+        print('A str was passed to the function, and was handled well with a TypeError.')
+
+
+def test_fit_local():
+    """
+    Test function that confirms spectrafit.fit_local returns one row per peak in the
+    export_fit_data layout, agrees with a full spectrum fit for well separated peaks, gives the
+    same result in a process pool, and handles input errors.
+    """
+    x_data = np.arange(0, 3000, 1.0)
+    centers = np.array([[300], [900], [1500], [2100], [2700]])
+    y_data = spectrafit.pseudo_voigt(x_data, np.full((5, 1), 10), centers, np.full((5, 1), 8),
+                                     np.full((5, 1), 0.2)).sum(axis=0)
+    peaks = spectrafit.peak_detect(x_data, y_data)[0]
+    fit_peak_data = spectrafit.fit_local(x_data, y_data, peaks, width_scale=10)
+    assert isinstance(fit_peak_data, list), 'output is not a list'
+    assert np.asarray(fit_peak_data).shape == (5, 6), 'output is not the correct shape'
+    assert np.allclose(np.asarray(fit_peak_data)[:, 2], centers[:, 0]), 'centers out of order'
+    assert np.allclose(np.asarray(fit_peak_data)[:, 1], 8, rtol=1e-2), 'sigma was not recovered'
+    parallel = spectrafit.fit_local(x_data, y_data, peaks, width_scale=10, workers=2)
+    assert np.allclose(parallel, fit_peak_data), 'parallel fit differs from serial fit'
+    try:
+        spectrafit.fit_local(1.1, y_data, peaks)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_local(x_data, 1.2, peaks)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_local(x_data, y_data, peaks, workers=1.5)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+
+
+def test_baseline_batch():
+    """
+    Test function that confirms spectrafit.baseline_batch gives the same baselines as
+    peakutils for every spectrum in a stack, that the output shape matches the input, and that
+    input errors are handled.
+    """
+    y_stack = np.array([Y_TEST, 0.5*Y_TEST + X_TEST/max(X_TEST), np.zeros(len(Y_TEST))])
+    y_base = spectrafit.baseline_batch(y_stack)
+    assert y_base.shape == y_stack.shape, 'output shape different from input'
+    for i, y_spectrum in enumerate(y_stack[:2]):
+        assert np.allclose(y_base[i], baseline(y_spectrum, deg=3, max_it=200)), """
+        baseline {} does not match peakutils""".format(i)
+    assert not y_base[2].any(), 'baseline of an empty spectrum is not zero'
+    assert spectrafit.baseline_batch(Y_TEST).shape == Y_TEST.shape, '1-D input not handled'
+    try:
+        spectrafit.baseline_batch(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        spectrafit.baseline_batch(y_stack, deg=3.5)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+    try:
+        spectrafit.baseline_batch(y_stack, max_it=2.5)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_subtract_baseline_batch():
+    """
+    Test function that confirms spectrafit.subtract_baseline_batch gives the same output as
+    spectrafit.subtract_baseline for every spectrum in a stack, and that input errors are
+    handled.
+    """
+    y_stack = np.array([Y_TEST, 0.5*Y_TEST + X_TEST/max(X_TEST)])
+    y_out = spectrafit.subtract_baseline_batch(y_stack)
+    assert isinstance(y_out, np.ndarray), 'output is not a numpy array'
+    for i, y_spectrum in enumerate(y_stack):
+        assert np.allclose(y_out[i], spectrafit.subtract_baseline(y_spectrum)), """
+        spectrum {} does not match subtract_baseline""".format(i)
+    try:
+        spectrafit.subtract_baseline_batch(4.2)
+    except TypeError:
+        print('A float was passed to the function, and it was handled well with a TypeError.')
+
+
+def test_fit_warm():
+    """
+    Test function that confirms spectrafit.fit_warm fits a slightly changed spectrum from the
+    previous fit, that it asks for peak detection again when a new peak appears or a peak
+    vanishes, and that input errors are handled.
+    """
+    y_test = spectrafit.subtract_baseline(Y_TEST)
+    peaks = spectrafit.peak_detect(X_TEST, y_test)[0]
+    mod, pars = spectrafit.set_params(peaks)
+    previous = spectrafit.export_fit_data(spectrafit.model_fit(X_TEST, y_test, mod, pars,
+                                                               backend='analytic'))
+    fit_result = spectrafit.fit_warm(X_TEST, 1.02*y_test, previous, height=0.1, prominence=0.1)
+    assert len(fit_result) == len(previous), 'number of peaks changed'
+    for i, _ in enumerate(fit_result):
+        assert fit_result[i][2] == previous[i][2], 'peak centers were not kept'
+    new_peak = 1.02*y_test + gaussian(X_TEST, 0.5, 2700, 10)
+    assert spectrafit.fit_warm(X_TEST, new_peak, previous, height=0.1,
+                               prominence=0.1) is None, 'new peak not found in the residual'
+    vanished = 1.02*y_test - 1.1*gaussian(X_TEST, y_test[np.argmin(abs(X_TEST - 3200))], 3200, 50)
+    assert spectrafit.fit_warm(X_TEST, vanished, previous, height=0.1,
+                               prominence=0.1) is None, 'vanished peak not found'
+    assert spectrafit.fit_warm(X_TEST, y_test, []) is None, """
+    peaks not detected again without previous peaks"""
+    # fit_data detects peaks above a height of 10
+    assert np.allclose(spectrafit.fit_data(X_TEST, 100*y_test, previous=[]),
+                       spectrafit.fit_data(X_TEST, 100*y_test)), """
+    empty previous fit not cold started"""
+    try:
+        spectrafit.fit_data(X_TEST, y_test, previous=np.asarray(previous))
+    except TypeError:
+        print('An array was passed to the function, and was handled well with a TypeError.')
+    else:
+        raise AssertionError('an array previous fit was not rejected')
+    try:
+        spectrafit.fit_warm(X_TEST, y_test, 1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_warm(X_TEST, y_test, previous, distance='10')
+    except TypeError:
+        print('A string was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_warm(1.1, y_test, previous)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_warm(X_TEST, y_test, previous, height='10')
+    except TypeError:
+        print('A string was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.fit_warm(X_TEST, y_test, previous, backend='scipy')
+    except ValueError:
+        print('An unknown backend was passed to the function, and was handled well with a '
+              'ValueError.')
+
+
+def test_fit_profiler():
+    """
+    Test function that confirms spectrafit.FitProfiler records every stage of each fit with
+    its time and peak count, passes the records to the callback, exports them, records
+    nothing once it is closed, and that input errors are handled.
+    """
+    compound = SHOYU_DATA_DICT['WATER']
+    seen = []
+    with spectrafit.FitProfiler(callback=seen.append, label='test') as profiler:
+        spectrafit.data_report(compound['x'], compound['y'])
+        spectrafit.compound_report(compound)
+    records = profiler.to_dataframe()
+    assert list(records['stage'][:6]) == ['baseline', 'detect', 'guess', 'params', 'fit',
+                                          'export'], "stages not recorded in order"
+    assert list(records['fit'].unique()) == [1, 2], 'records not grouped by fit'
+    assert list(records['label'].unique()) == ['test', 'WATER'], 'records not labeled'
+    assert (records['seconds'] >= 0).all(), 'stage times not recorded'
+    fit = records[records['stage'] == 'fit'].iloc[0]
+    assert fit['n_peaks'] == 3 and fit['nfev'] > 0, 'peaks or evaluations not recorded'
+    assert len(seen) == len(records), 'not every record was passed to the callback'
+    guess = records[records['stage'] == 'guess'].iloc[0]
+    assert guess['n_peaks'] == records['n_peaks'][1], 'peak guesses not recorded'
+    # fits in another thread are not recorded by this thread's profiler
+    thread = threading.Thread(target=spectrafit.data_report, args=(compound['x'],
+                                                                   compound['y']))
+    with spectrafit.FitProfiler() as other:
+        thread.start()
+        thread.join()
+    assert not other.records, 'stages of another thread were recorded'
+    spectrafit.data_report(compound['x'], compound['y'])
+    assert len(profiler.records) == 12, 'stages recorded after the profiler was closed'
+    profiler.write_log('profile_test.jsonl')
+    with open('profile_test.jsonl') as log:
+        assert len(log.readlines()) == 12, 'not every record was written to the log'
+    os.remove('profile_test.jsonl')
+    try:
+        spectrafit.FitProfiler(callback=1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        profiler.write_log(1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+
+
+def test_fit_cache():
+    """
+    Test function that confirms spectrafit.FitCache returns the same report as a fresh fit,
+    reads repeated reports from memory and from disk without fitting, keys reports by the
+    data and the report function, keeps its tiers within their limits, and that input errors
+    are handled.
+    """
+    compound = SHOYU_DATA_DICT['WATER']
+    expected = spectrafit.compound_report(compound)
+    cache = spectrafit.FitCache('fit_cache_test', max_entries=1)
+    assert spectrafit.compound_report(compound, cache=cache) == expected, """
+    cached report differs from the fit"""
+    assert spectrafit.compound_report(compound, cache=cache) == expected, """
+    report read from memory differs from the fit"""
+    assert (cache.hits, cache.misses) == (1, 1), 'repeated report was fit again'
+    with spectrafit.FitProfiler() as profiler:
+        report = spectrafit.compound_report(compound, cache=spectrafit.FitCache('fit_cache_test'))
+    assert report == expected, 'report read from disk differs from the fit'
+    assert not profiler.records, 'report read from disk was fit again'
+    assert spectrafit.FitCache.key('data_report', compound['x'], compound['y']) != \
+        spectrafit.FitCache.key('compound_report', compound['x'], compound['y']), """
+    reports of different functions share a key"""
+    assert spectrafit.FitCache.key('data_report', compound['x'], 2*compound['y']) != \
+        spectrafit.FitCache.key('data_report', compound['x'], compound['y']), """
+    different spectra share a key"""
+    spectrafit.data_report(compound['x'], compound['y'], cache=cache)
+    assert len(cache) == 1, 'memory tier grew past max_entries'
+    cache.max_bytes = 0
+    cache.put('0'*64, expected)
+    assert not os.listdir('fit_cache_test'), 'disk tier grew past max_bytes'
+    cache.clear()
+    assert len(cache) == 0, 'cache not cleared'
+    os.rmdir('fit_cache_test')
+    try:
+        spectrafit.FitCache(cache_dir=1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.FitCache(max_entries=1.1)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+
+
+def test_initial_guess():
+    """
+    Test function that confirms spectrafit.initial_guess estimates the sigma, amplitude and
+    Lorentzian fraction of well separated peaks, works with x in either order, gives starting
+    values that set_params accepts, and that input errors are handled.
+    """
+    x_data = np.arange(0, 3000, 0.5)
+    y_data = (spectrafit.pseudo_voigt(x_data, 800, 700, 20, 0.1)
+              + spectrafit.pseudo_voigt(x_data, 300, 1500, 8, 0.5)
+              + spectrafit.pseudo_voigt(x_data, 2000, 2400, 40, 0.9))
+    peaks, peak_list = spectrafit.peak_detect(x_data, y_data)
+    guesses = spectrafit.initial_guess(x_data, y_data, peak_list)
+    assert len(guesses) == 3 and len(guesses[0]) == 6, 'guesses not in export_fit_data layout'
+    for guess, (amplitude, sigma, fraction) in zip(guesses, [(800, 20, 0.1), (300, 8, 0.5),
+                                                              (2000, 40, 0.9)]):
+        assert abs(guess[1] - sigma) < 0.05*sigma, 'sigma not estimated'
+        assert abs(guess[3] - amplitude) < 0.1*amplitude, 'amplitude not estimated'
+        assert abs(guess[0] - fraction) < 0.1, 'fraction not estimated'
+    reverse = spectrafit.peak_detect(x_data[::-1], y_data[::-1])[1]
+    assert np.allclose(spectrafit.initial_guess(x_data[::-1], y_data[::-1], reverse)[0][1],
+                       guesses[2][1]), 'descending x not handled'
+    mod, pars = spectrafit.set_params(peaks, guesses)
+    assert pars['p1_sigma'].value == guesses[0][1], 'guesses not used as starting values'
+    out = spectrafit.model_fit(x_data, y_data, mod, pars)
+    assert np.allclose(out.best_fit, y_data, atol=1e-3), 'fit from the guesses not converged'
+    try:
+        spectrafit.initial_guess(1.1, y_data, peak_list)
+    except TypeError:
+        print('A float was passed to the function, and was handled well with a TypeError.')
+    try:
+        spectrafit.initial_guess(x_data, y_data, [1, 2])
+    except TypeError:
+        print('A list was passed to the function, and was handled well with a TypeError.')